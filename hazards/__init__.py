@@ -1,4 +1,4 @@
-from .hazards import HazardsFile, fetch_events, dt
+from .hazards import HazardsFile, Quarantine, fetch_events, dt
 from . import command_line
 
-__all__ = [command_line, HazardsFile, fetch_events, dt]
+__all__ = ['command_line', 'HazardsFile', 'Quarantine', 'fetch_events', 'dt']
@@ -0,0 +1,510 @@
+"""
+Columnar archive of historical events.
+
+Events are stored as NumPy column files, partitioned by day and issuing
+office, so that a query over years of history only touches the partitions
+and columns that it needs.  Each partition holds four tables:
+
+    events    one row per event
+    segments  one row per bulletin of an event
+    ugc       one row per county or zone of a bulletin
+    points    one row per polygon vertex of a bulletin
+
+The segments refer to their event by row number, and to their UGC codes and
+polygon vertices by a range of rows, so the tables of a partition stand on
+their own.  A partition may be written in several parts as the events
+arrive.  The manifest at the top of the archive lists the parts along with
+their row counts.
+
+Parts are either compressed, one .npz file per table whose columns are
+decompressed individually when asked for, or uncompressed, one .npy file
+per column that is memory mapped when read.
+
+The day of an event is that of its first bulletin.
+"""
+
+import collections
+import json
+import os
+
+import numpy as np
+
+from . import corpus
+from .hazards import HazardsFile
+from .tracker import EventTracker
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+# Columns of each table and their dtypes.  Times are UTC to the second,
+# with NaT where unknown.
+COLUMNS = collections.OrderedDict([
+    ('events', collections.OrderedDict([
+        ('office', 'U4'),
+        ('phenomena', 'U2'),
+        ('significance', 'U1'),
+        ('event_tracking_id', 'i4'),
+        ('product_class', 'U1'),
+        ('state', 'U9'),
+        ('issuance_time', 'M8[s]'),
+        ('expiration_date', 'M8[s]'),
+        ('nbulletins', 'i4'),
+        ('segment_start', 'i8'),
+        ('segment_count', 'i4'),
+    ])),
+    ('segments', collections.OrderedDict([
+        ('event', 'i4'),
+        ('action', 'U3'),
+        ('issuance_time', 'M8[s]'),
+        ('expiration_date', 'M8[s]'),
+        ('ugc_start', 'i8'),
+        ('ugc_count', 'i4'),
+        ('point_start', 'i8'),
+        ('point_count', 'i4'),
+    ])),
+    ('ugc', collections.OrderedDict([
+        ('segment', 'i4'),
+        ('code', 'U6'),
+    ])),
+    ('points', collections.OrderedDict([
+        ('lon', 'f8'),
+        ('lat', 'f8'),
+    ])),
+])
+
+# Columns holding row numbers of another table within the same part.
+_REFERENCES = {
+    ('events', 'segment_start'): 'segments',
+    ('segments', 'event'): 'events',
+    ('segments', 'ugc_start'): 'ugc',
+    ('segments', 'point_start'): 'points',
+    ('ugc', 'segment'): 'segments',
+}
+
+# A part of a partition as listed in the manifest.  The day is a
+# "YYYY-MM-DD" string, or None if the event had no dates at all, and the
+# path is relative to the archive directory.  The row counts are by table.
+ArchivePart = collections.namedtuple('ArchivePart',
+                                     ['day', 'office', 'path', 'rows'])
+
+
+class ArchiveError(Exception):
+    """
+    Raised when an archive directory is missing or not understood.
+    """
+    def __init__(self, message):
+        super(ArchiveError, self).__init__(message)
+        self.message = message
+
+
+def _time(value):
+    if value is None:
+        return np.datetime64('NaT', 's')
+    return np.datetime64(value, 's')
+
+
+def _event_day(event):
+    """
+    Day that an event belongs to, that of its first bulletin.
+    """
+    for item in event.history:
+        if item.issuance_time is not None:
+            return item.issuance_time.date()
+    if event.vtec_code.event_beginning_time is not None:
+        return event.vtec_code.event_beginning_time.date()
+    if event.expiration_date is not None:
+        return event.expiration_date.date()
+    return None
+
+
+def _event_action(event, bulletin):
+    for vtec_code in bulletin.vtec:
+        if event.contains(vtec_code):
+            return vtec_code.action
+    return ''
+
+
+def _tables(events):
+    """
+    Columns of the four tables for some events.
+    """
+    rows = dict((table, dict((name, []) for name in columns))
+                for table, columns in COLUMNS.items())
+    nsegments = 0
+    nugc = 0
+    npoints = 0
+    for j, event in enumerate(events):
+        vtec_code = event.vtec_code
+        history = event.history
+        row = rows['events']
+        row['office'].append(vtec_code.office)
+        row['phenomena'].append(vtec_code.phenomena)
+        row['significance'].append(vtec_code.significance)
+        row['event_tracking_id'].append(vtec_code.event_tracking_id)
+        row['product_class'].append(vtec_code.product)
+        row['state'].append(event.state)
+        row['issuance_time'].append(_time(history[0].issuance_time
+                                          if len(history) > 0 else None))
+        row['expiration_date'].append(_time(event.expiration_date))
+        row['nbulletins'].append(len(history))
+        row['segment_start'].append(nsegments)
+        row['segment_count'].append(len(event))
+
+        for bulletin in event:
+            codes = bulletin.ugc_codes
+            # Decoded from the wire, the polygon is an array.
+            polygon = getattr(bulletin, 'polygon', None)
+            if polygon is None:
+                polygon = []
+
+            row = rows['segments']
+            row['event'].append(j)
+            row['action'].append(_event_action(event, bulletin))
+            row['issuance_time'].append(
+                _time(getattr(bulletin, 'mnd_issuance_time', None)))
+            row['expiration_date'].append(_time(bulletin.expiration_date))
+            row['ugc_start'].append(nugc)
+            row['ugc_count'].append(len(codes))
+            row['point_start'].append(npoints)
+            row['point_count'].append(len(polygon))
+
+            rows['ugc']['segment'].extend([nsegments] * len(codes))
+            rows['ugc']['code'].extend(codes)
+            rows['points']['lon'].extend(float(x) for x, _ in polygon)
+            rows['points']['lat'].extend(float(y) for _, y in polygon)
+
+            nsegments += 1
+            nugc += len(codes)
+            npoints += len(polygon)
+
+    return dict((table, dict((name, np.array(rows[table][name], dtype=dtype))
+                             for name, dtype in columns.items()))
+                for table, columns in COLUMNS.items())
+
+
+class ArchiveWriter(object):
+    """
+    Write events to a columnar archive.  It can be handed to an EventTracker
+    as the archive of retired events.
+
+    Attributes
+    ----------
+    dirname : str
+        Top of the archive.
+    compress : bool
+        Whether the parts are compressed.
+    parts : list
+        ArchivePart of everything written so far.
+    """
+    def __init__(self, dirname, compress=True, max_events=10000):
+        """
+        Parameters
+        ----------
+        dirname : str
+            Top of the archive.  An existing archive is added to.
+        compress : bool
+            If True, write compressed .npz files, otherwise .npy files that
+            can be memory mapped.
+        max_events : int
+            Write out the pending events once there are this many.
+        """
+        self.dirname = dirname
+        self.compress = compress
+        self.max_events = max_events
+        self.parts = []
+
+        path = os.path.join(dirname, MANIFEST)
+        if os.path.exists(path):
+            manifest = _read_manifest(dirname)
+            if manifest['compressed'] != compress:
+                msg = 'Cannot mix compressed and uncompressed parts in {}'
+                raise ArchiveError(msg.format(dirname))
+            self.parts = _manifest_parts(manifest)
+
+        self._pending = collections.defaultdict(list)
+        self._npending = 0
+
+    def __call__(self, event):
+        self.add(event)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, event):
+        """
+        Add an event, written out with the next flush.
+        """
+        day = _event_day(event)
+        key = (None if day is None else day.isoformat(),
+               event.vtec_code.office)
+        self._pending[key].append(event)
+        self._npending += 1
+        if self._npending >= self.max_events:
+            self.flush()
+
+    def flush(self):
+        """
+        Write out the pending events as a new part of each partition, then
+        the manifest.
+        """
+        if self._npending == 0:
+            return
+        counts = collections.Counter((part.day, part.office)
+                                     for part in self.parts)
+        for key in sorted(self._pending, key=lambda x: (str(x[0]), x[1])):
+            day, office = key
+            path = os.path.join(day if day is not None else 'undated',
+                                office,
+                                'part-{:05d}'.format(counts[key]))
+            tables = _tables(self._pending[key])
+            self._write_part(path, tables)
+            rows = dict((table, len(columns[next(iter(columns))]))
+                        for table, columns in tables.items())
+            self.parts.append(ArchivePart(day, office, path, rows))
+        self._pending.clear()
+        self._npending = 0
+        self._write_manifest()
+
+    def close(self):
+        """
+        Write out everything that is pending.
+        """
+        self.flush()
+        if not os.path.exists(os.path.join(self.dirname, MANIFEST)):
+            self._write_manifest()
+
+    def _write_part(self, path, tables):
+        dirname = os.path.join(self.dirname, path)
+        os.makedirs(dirname, exist_ok=True)
+        for table, columns in tables.items():
+            if self.compress:
+                np.savez_compressed(os.path.join(dirname, table + '.npz'),
+                                    **columns)
+            else:
+                for name, values in columns.items():
+                    filename = '{}.{}.npy'.format(table, name)
+                    np.save(os.path.join(dirname, filename), values)
+
+    def _write_manifest(self):
+        manifest = {
+            'version': VERSION,
+            'compressed': self.compress,
+            'columns': dict((table, list(columns.items()))
+                            for table, columns in COLUMNS.items()),
+            'parts': [part._asdict() for part in self.parts],
+        }
+        os.makedirs(self.dirname, exist_ok=True)
+        path = os.path.join(self.dirname, MANIFEST)
+        # Replace the manifest in one step so that readers never see half
+        # of one.
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+def _read_manifest(dirname):
+    path = os.path.join(dirname, MANIFEST)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        msg = 'Cannot read the archive manifest {}:  {}'
+        raise ArchiveError(msg.format(path, e))
+    if manifest.get('version') != VERSION:
+        msg = 'Unsupported archive version {} in {}'
+        raise ArchiveError(msg.format(manifest.get('version'), path))
+    return manifest
+
+
+def _manifest_parts(manifest):
+    return [ArchivePart(**item) for item in manifest['parts']]
+
+
+def _day(value):
+    if value is None or isinstance(value, str):
+        return value
+    return value.isoformat()[:10]
+
+
+class ArchiveReader(object):
+    """
+    Read back the columns of an archive.
+
+    Attributes
+    ----------
+    dirname : str
+        Top of the archive.
+    compressed : bool
+        Whether the parts are compressed.
+    parts : list
+        ArchivePart of everything in the archive.
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        manifest = _read_manifest(dirname)
+        self.compressed = manifest['compressed']
+        self.parts = _manifest_parts(manifest)
+
+    def select(self, since=None, until=None, offices=None):
+        """
+        Parts of the partitions within a range of days and offices, without
+        opening any of them.
+
+        Parameters
+        ----------
+        since, until : datetime.date or str
+            First and last day to include, as dates or "YYYY-MM-DD".  Parts
+            without a day are only included without either.
+        offices : iterable of str
+            If provided, only these offices, e.g. "KDDC".
+
+        Returns
+        -------
+        list
+            ArchivePart objects
+        """
+        since, until = _day(since), _day(until)
+        if offices is not None:
+            offices = frozenset(offices)
+        parts = []
+        for part in self.parts:
+            if since is not None or until is not None:
+                if part.day is None:
+                    continue
+                if since is not None and part.day < since:
+                    continue
+                if until is not None and part.day > until:
+                    continue
+            if offices is not None and part.office not in offices:
+                continue
+            parts.append(part)
+        return parts
+
+    def _columns(self, part, table, columns):
+        if table not in COLUMNS:
+            msg = 'Unknown table {}, must be one of {}'
+            raise ValueError(msg.format(table, ', '.join(COLUMNS)))
+        if columns is None:
+            columns = list(COLUMNS[table])
+        unknown = set(columns) - set(COLUMNS[table])
+        if len(unknown) > 0:
+            msg = 'Unknown column(s) of {}:  {}'
+            raise ValueError(msg.format(table, ', '.join(sorted(unknown))))
+
+        dirname = os.path.join(self.dirname, part.path)
+        if self.compressed:
+            # Only the requested members of the .npz are decompressed.
+            with np.load(os.path.join(dirname, table + '.npz')) as npz:
+                return dict((name, npz[name]) for name in columns)
+        return dict((name,
+                     np.load(os.path.join(dirname,
+                                          '{}.{}.npy'.format(table, name)),
+                             mmap_mode='r'))
+                    for name in columns)
+
+    def read(self, table, columns=None, since=None, until=None,
+             offices=None):
+        """
+        Columns of a table one part at a time.  The row numbers in the
+        reference columns are relative to the part.
+
+        Parameters
+        ----------
+        table : str
+            One of "events", "segments", "ugc", or "points".
+        columns : iterable of str
+            If provided, only read these columns.
+        since, until, offices
+            See select.
+
+        Yields
+        ------
+        tuple
+            ArchivePart and a dict of its columns.  The columns of an
+            uncompressed archive are memory mapped.
+        """
+        for part in self.select(since=since, until=until, offices=offices):
+            yield part, self._columns(part, table, columns)
+
+    def table(self, table, columns=None, since=None, until=None,
+              offices=None):
+        """
+        Columns of a table over all of the selected parts.  The row numbers
+        in the reference columns are shifted to refer to the corresponding
+        tables over the same parts.
+
+        Parameters
+        ----------
+        table, columns, since, until, offices
+            See read.
+
+        Returns
+        -------
+        dict
+            numpy arrays by column name
+        """
+        if columns is None:
+            columns = list(COLUMNS[table])
+        lists = dict((name, []) for name in columns)
+        offsets = collections.Counter()
+        for part, values in self.read(table, columns=columns, since=since,
+                                      until=until, offices=offices):
+            for name in columns:
+                target = _REFERENCES.get((table, name))
+                if target is None or offsets[target] == 0:
+                    lists[name].append(values[name])
+                else:
+                    lists[name].append(values[name] + offsets[target])
+            offsets.update(part.rows)
+
+        return dict((name, np.concatenate(lists[name]) if len(lists[name]) > 0
+                     else np.zeros(0, dtype=COLUMNS[table][name]))
+                    for name in columns)
+
+
+def write_archive(source, dirname, compress=True, recursive=True,
+                  quarantine=None):
+    """
+    Parse bulletin files and archive every event in them.
+
+    Parameters
+    ----------
+    source : str
+        A directory, archive, or file of bulletins, read in the order of the
+        dates in the file names.
+    dirname : str
+        Top of the columnar archive.  An existing archive is added to.
+    compress : bool
+        If True, write compressed .npz files, otherwise .npy files that can
+        be memory mapped.
+    recursive : bool
+        If True, also read the subdirectories of source.
+    quarantine : Quarantine
+        If provided, products and segments that fail to parse are recorded
+        here and skipped, otherwise the exception propagates.
+
+    Returns
+    -------
+    int
+        Number of events archived.
+    """
+    count = [0]
+    with ArchiveWriter(dirname, compress=compress) as writer:
+        def archive(event):
+            writer.add(event)
+            count[0] += 1
+
+        tracker = EventTracker(archive=archive, max_bulletins=None)
+        entries = corpus.iter_entries(source, recursive=recursive)
+        for entry in corpus.select_entries(entries):
+            with entry.open() as fileobj:
+                tracker.add_file(HazardsFile(entry.name, fileobj=fileobj,
+                                             quarantine=quarantine))
+
+        # The events still open at the end of the bulletins.
+        for event in tracker:
+            archive(event)
+    return count[0]
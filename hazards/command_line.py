@@ -1,7 +1,9 @@
 import argparse
+import datetime as dt
 import os
+import sys
 
-from .hazards import HazardsFile, UGCParsingError
+from .hazards import HazardsFile, Quarantine, UGCParsingError
 
 
 class DirectoryNotFoundException(Exception):
@@ -16,22 +18,183 @@ def hzparse():
     parser = argparse.ArgumentParser(description=description)
 
     parser.add_argument(dest='directory', type=str)
+    help = ('skip malformed products and segments, and report them at the '
+            'end instead of stopping')
+    parser.add_argument('--quarantine', action='store_true', help=help)
+    help = ('write one record per segment and VTEC code in this format '
+            'instead of a summary of each file')
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default=None,
+                        help=help)
+    parser.add_argument('--output', type=str, default=None,
+                        help='write the records here instead of stdout')
 
     args = parser.parse_args()
 
     if not os.path.exists(args.directory):
         raise DirectoryNotFoundException
 
-    for file in os.listdir(args.directory):
+    quarantine = Quarantine() if args.quarantine else None
 
-        # Skip any files with names like ".scour*"
-        if file.startswith('.'):
-            continue
+    # With records going to stdout, everything else goes to stderr.
+    log = sys.stdout
+    writer = None
+    stream = None
+    if args.format is not None:
+        from .export import RecordWriter
+        if args.output is None:
+            log = sys.stderr
+            writer = RecordWriter(sys.stdout, format=args.format)
+        else:
+            stream = open(args.output, 'w', buffering=1 << 16, newline='')
+            writer = RecordWriter(stream, format=args.format)
 
-        try:
-            hzf = HazardsFile(os.path.join(args.directory, file))
-        except UGCParsingError as e:
-            print('File:  {}'.format(file))
-            print(e.message)
-            continue
-        print('File:  {} ({} products)'.format(file, len(hzf)))
+    try:
+        for file in os.listdir(args.directory):
+
+            # Skip any files with names like ".scour*"
+            if file.startswith('.'):
+                continue
+
+            path = os.path.join(args.directory, file)
+            try:
+                hzf = HazardsFile(path, quarantine=quarantine)
+            except UGCParsingError as e:
+                print('File:  {}'.format(file), file=log)
+                print(e.message, file=log)
+                continue
+            except Exception as e:
+                # The file could not even be read.
+                if quarantine is None:
+                    raise
+                quarantine.add(path, None, e)
+                continue
+
+            if writer is None:
+                print('File:  {} ({} products)'.format(file, len(hzf)))
+            else:
+                # One file at a time, none of them are held on to.
+                for product in hzf:
+                    writer.write_product(product)
+    finally:
+        if stream is not None:
+            stream.close()
+
+    if quarantine is not None:
+        for record in quarantine:
+            print('Quarantined:  {} offset {} segment {}:  {}:  {}'.format(
+                *record), file=log)
+        print(quarantine.report(), file=log)
+
+
+def hzsynth():
+    """
+    Write a synthetic corpus of bulletins for load testing
+    """
+    description = 'Command line tool for generating synthetic bulletins.'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument(dest='directory', type=str)
+    parser.add_argument('--start', type=str, default='2015071900',
+                        help='first hour, as YYYYMMDDHH')
+    parser.add_argument('--hours', type=int, default=24,
+                        help='number of hourly files')
+    parser.add_argument('--rate', type=int, default=20,
+                        help='mean number of new events per hour')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--suffix', type=str, default='synth')
+
+    args = parser.parse_args()
+
+    from . import synthetic
+
+    start = dt.datetime.strptime(args.start, '%Y%m%d%H')
+    generator = synthetic.generate_corpus(args.directory, start, args.hours,
+                                          seed=args.seed,
+                                          events_per_hour=args.rate,
+                                          suffix=args.suffix)
+    print('{} products, {} segments, {} events'.format(generator.nproducts,
+                                                       generator.nsegments,
+                                                       generator.nevents))
+
+
+def hzserve():
+    """
+    Serve the active events of a directory of bulletins over HTTP
+    """
+    description = ('Command line tool for serving the active events of a '
+                   'directory of bulletins as JSON.  Query GET /events '
+                   'with office, phenomena, significance, ugc, or lat and '
+                   'lon, longitudes signed, negative west, e.g. '
+                   '/events?lat=39.1&lon=-94.6')
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument(dest='directory', type=str)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--interval', type=float, default=10.0,
+                        help='seconds between polls of the directory')
+    parser.add_argument('--recursive', action='store_true',
+                        help='also watch subdirectories')
+    parser.add_argument('--keep-expired', action='store_true',
+                        help='do not retire events by the clock, e.g. when '
+                             'serving an archive')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log each request')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.directory):
+        raise DirectoryNotFoundException
+
+    import threading
+    from . import server
+
+    feed = server.DirectoryFeed(args.directory, recursive=args.recursive,
+                                expire=not args.keep_expired)
+    feed.poll()
+
+    stop = threading.Event()
+    poller = threading.Thread(target=feed.run, args=(args.interval, stop))
+    poller.daemon = True
+    poller.start()
+
+    httpd = server.EventServer(feed, address=(args.host, args.port),
+                               verbose=args.verbose)
+    print('Serving {} active events on http://{}:{}/events'.format(
+        len(feed.snapshot), *httpd.server_address[:2]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        httpd.server_close()
+
+
+def hzreplay():
+    """
+    Replay a directory of bulletins in issuance order and report how the
+    ingest kept up
+    """
+    description = ('Command line tool for replaying a directory of bulletins '
+                   'through the event aggregator.')
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument(dest='directory', type=str)
+    parser.add_argument('--speed', type=float, default=None,
+                        help='multiple of real time, as fast as possible if '
+                             'not given')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.directory):
+        raise DirectoryNotFoundException
+
+    from .replay import Replay
+
+    replay = Replay(args.directory, speed=args.speed)
+    stats = replay.run()
+    print(stats.report())
+    print('{} live events'.format(len(replay.tracker)))
+    if len(replay.quarantine) > 0:
+        print(replay.quarantine.report())
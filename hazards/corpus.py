@@ -0,0 +1,345 @@
+"""
+Enumerate bulletin files in directory trees and archives.
+
+Bulletin files may be compressed with gzip, bzip2, or xz, and may be bundled
+into tar or zip archives.  Archive members are read in place without being
+extracted to disk.
+"""
+
+import collections
+import datetime as dt
+import heapq
+import os
+import weakref
+
+# The compression and archive modules are imported when first needed, so
+# that plain bulletin files do not pay for them at startup.
+
+# Compression suffixes recognized on bulletin files.
+_COMPRESSION_SUFFIXES = ('.gz', '.bz2', '.xz')
+
+_TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz',
+                 '.txz')
+
+_ZIP_SUFFIXES = ('.zip',)
+
+# A bulletin file found in the corpus.  The name is a path, possibly running
+# through an archive, whose basename carries the YYYYMMDDHH date.  The open
+# attribute is a callable taking no arguments that returns a binary file
+# object with the raw, possibly still compressed, contents, which the caller
+# closes.  Pass both to HazardsFile, or to read_bulletin for the decompressed
+# contents.
+CorpusEntry = collections.namedtuple('CorpusEntry', ['name', 'open'])
+
+
+def file_date(name):
+    """
+    Date encoded in a bulletin file name.
+
+    Parameters
+    ----------
+    name : str
+        Path whose basename has the format YYYYMMDDHH.xxxx
+
+    Returns
+    -------
+    datetime.datetime or None
+        None if the name does not start with a date.
+    """
+    basename = os.path.basename(name)
+    try:
+        return dt.datetime(int(basename[0:4]), int(basename[4:6]),
+                           int(basename[6:8]), int(basename[8:10]), 0, 0)
+    except ValueError:
+        # Have not seen this case yet in the wild, but maybe...
+        return None
+
+
+def compression(name):
+    """
+    Compression suffix of a bulletin file name, or None.
+    """
+    for suffix in _COMPRESSION_SUFFIXES:
+        if name.endswith(suffix):
+            return suffix
+    return None
+
+
+def open_bulletin(name, fileobj=None):
+    """
+    Open a possibly compressed bulletin file for binary reading.
+
+    Parameters
+    ----------
+    name : str
+        Name of the bulletin file.  The suffix decides the decompression.
+    fileobj : file-like object
+        If provided, read the raw contents from here instead of opening the
+        named file, e.g. a member of an archive.  It is left open when the
+        returned stream is closed.
+
+    Returns
+    -------
+    file-like object
+        Binary stream of the decompressed contents.  Closing it closes the
+        file if it was opened here.
+    """
+    suffix = compression(name)
+    if suffix == '.gz':
+        import gzip
+        if fileobj is None:
+            return gzip.open(name, 'rb')
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif suffix == '.bz2':
+        import bz2
+        return bz2.open(name if fileobj is None else fileobj, 'rb')
+    elif suffix == '.xz':
+        try:
+            import lzma
+        except ImportError:
+            msg = 'xz decompression is not available for {}'
+            raise RuntimeError(msg.format(name))
+        return lzma.open(name if fileobj is None else fileobj, 'rb')
+    if fileobj is None:
+        return open(name, 'rb')
+    return fileobj
+
+
+def read_bulletin(entry):
+    """
+    Decompressed contents of a bulletin file.  Everything that was opened
+    to read it is closed again.
+
+    Parameters
+    ----------
+    entry : CorpusEntry
+
+    Returns
+    -------
+    bytes
+    """
+    with entry.open() as fileobj:
+        with open_bulletin(entry.name, fileobj=fileobj) as f:
+            return f.read()
+
+
+def _is_hidden(name):
+    """
+    Skip any files with names like ".scour*"
+    """
+    return os.path.basename(name).startswith('.')
+
+
+def _file_opener(path):
+    return lambda: open(path, 'rb')
+
+
+class _Archive(object):
+    """
+    Archive shared by the entries found in it.  It is opened once when it
+    is first needed and stays open until closed, or until nothing refers to
+    it any more, so that the members are read in a single pass.
+
+    Attributes
+    ----------
+    path : str
+        Path of the archive.
+    last : TarInfo or ZipInfo
+        Last member found in the archive, once all of them have been.
+        Closing that member closes the archive.
+    """
+    def __init__(self, path, opener):
+        self.path = path
+        self.last = None
+        self._opener = opener
+        self._handle = None
+        self._finalizer = None
+
+    def handle(self):
+        """
+        The open archive, opened again if it was closed.
+        """
+        if self._handle is None:
+            self._handle = self._opener(self.path)
+            self._finalizer = weakref.finalize(self, self._handle.close)
+        return self._handle
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+        self._handle = None
+        self._finalizer = None
+
+
+class _MemberFile(object):
+    """
+    Member of an archive.  Closing the last member closes the archive.
+    """
+    def __init__(self, fileobj, archive, member):
+        self._fileobj = fileobj
+        self._archive = archive
+        self._member = member
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        try:
+            self._fileobj.close()
+        finally:
+            if self._member is self._archive.last:
+                self._archive.close()
+
+
+def _member_opener(archive, member, extract):
+    def opener():
+        fileobj = extract(archive.handle(), member)
+        return _MemberFile(fileobj, archive, member)
+    return opener
+
+
+def _open_tar(path):
+    import tarfile
+    return tarfile.open(path, 'r:*')
+
+
+def _extract_tar(tar, member):
+    return tar.extractfile(member)
+
+
+def _open_zip(path):
+    import zipfile
+    return zipfile.ZipFile(path)
+
+
+def _extract_zip(zf, info):
+    return zf.open(info)
+
+
+def _iter_tar(path):
+    # The members are found one at a time while the archive is read, and
+    # an entry opened before the next one is found is read from there, so
+    # that a compressed archive is decompressed only once.  Entries opened
+    # afterwards share the archive opened again, see _Archive.
+    archive = _Archive(path, _open_tar)
+    try:
+        last = None
+        for member in archive.handle():
+            if not member.isfile() or _is_hidden(member.name):
+                continue
+            last = member
+            name = os.path.join(path, member.name)
+            yield CorpusEntry(name,
+                              _member_opener(archive, member, _extract_tar))
+        archive.last = last
+    finally:
+        archive.close()
+
+
+def _iter_zip(path):
+    # See _iter_tar.
+    archive = _Archive(path, _open_zip)
+    try:
+        last = None
+        for info in archive.handle().infolist():
+            if info.filename.endswith('/') or _is_hidden(info.filename):
+                continue
+            last = info
+            name = os.path.join(path, info.filename)
+            yield CorpusEntry(name,
+                              _member_opener(archive, info, _extract_zip))
+        archive.last = last
+    finally:
+        archive.close()
+
+
+def iter_entries(path, recursive=True):
+    """
+    Enumerate the bulletin files of a corpus.
+
+    Parameters
+    ----------
+    path : str
+        A directory, an archive, or a single bulletin file.
+    recursive : bool
+        If True, descend into subdirectories.  Archives are always read.
+
+    Yields
+    ------
+    CorpusEntry
+    """
+    if os.path.isdir(path):
+        # The directory entries say whether they are directories without
+        # having to stat each file.
+        items = sorted((item.name, item.is_dir())
+                       for item in os.scandir(path)
+                       if not _is_hidden(item.name))
+        for item, is_dir in items:
+            child = os.path.join(path, item)
+            if is_dir:
+                if recursive:
+                    for entry in iter_entries(child, recursive=True):
+                        yield entry
+            else:
+                for entry in iter_entries(child, recursive=recursive):
+                    yield entry
+    elif path.endswith(_TAR_SUFFIXES):
+        for entry in _iter_tar(path):
+            yield entry
+    elif path.endswith(_ZIP_SUFFIXES):
+        for entry in _iter_zip(path):
+            yield entry
+    else:
+        yield CorpusEntry(path, _file_opener(path))
+
+
+def _sort_key(entry):
+    date = file_date(entry.name)
+    if date is None:
+        date = dt.datetime.min
+    return date, entry.name
+
+
+def select_entries(entries, since=None, until=None, numlast=None):
+    """
+    Select bulletin files by the date in their names, without opening them.
+
+    Parameters
+    ----------
+    entries : iterable of CorpusEntry
+        Bulletin files, e.g. from iter_entries.
+    since, until : datetime.datetime
+        Only keep files dated at or after since, and before until.  Files
+        without a date in their name are dropped when either is given.
+    numlast : int
+        Only keep this many of the most recent files.
+
+    Returns
+    -------
+    list of CorpusEntry
+        Ordered by date, oldest first.
+    """
+    if since is not None or until is not None:
+        selected = []
+        for entry in entries:
+            date = file_date(entry.name)
+            if date is None:
+                continue
+            if since is not None and date < since:
+                continue
+            if until is not None and date >= until:
+                continue
+            selected.append(entry)
+        entries = selected
+
+    if numlast is None:
+        return sorted(entries, key=_sort_key)
+
+    # Only the most recent few are wanted, no need to sort all of them.
+    return heapq.nlargest(numlast, entries, key=_sort_key)[::-1]
@@ -0,0 +1,140 @@
+"""
+Flat records of parsed bulletins for bulk loaders.
+
+Each segment yields one record per VTEC code, or a single record with empty
+VTEC fields if it has none.  The records are written out one product at a
+time as newline-delimited JSON or CSV, so a whole directory can be exported
+in a single pass without holding on to it.
+
+Times are UTC in ISO 8601 format.
+"""
+
+import collections
+import csv
+import json
+
+# Fields of each record, in order.
+FIELDS = ('filename', 'awips_product', 'wmo_issuance_time', 'segment',
+          'product_class', 'office', 'phenomena', 'significance', 'action',
+          'event_tracking_id', 'event_beginning_time', 'event_ending_time',
+          'mnd_issuance_time', 'expiration_date', 'ugc', 'polygon')
+
+FORMATS = ('ndjson', 'csv')
+
+
+def _isoformat(value):
+    return None if value is None else value.isoformat()
+
+
+def segment_records(product):
+    """
+    Records of the segments of a product.
+
+    Parameters
+    ----------
+    product : Product
+
+    Yields
+    ------
+    collections.OrderedDict
+        Values by the names in FIELDS.  The UGC codes are a list, and the
+        polygon a list of [longitude, latitude] pairs, or None.
+    """
+    for j, segment in enumerate(product.segments):
+        polygon = getattr(segment, 'polygon', None)
+        if polygon is not None and len(polygon) > 0:
+            polygon = [[float(x), float(y)] for x, y in polygon]
+        else:
+            polygon = None
+        common = (
+            ('mnd_issuance_time',
+             _isoformat(getattr(segment, 'mnd_issuance_time', None))),
+            ('expiration_date', _isoformat(segment.expiration_date)),
+            ('ugc', segment.ugc_codes),
+            ('polygon', polygon),
+        )
+
+        for vtec_code in segment.vtec or [None]:
+            record = collections.OrderedDict([
+                ('filename', product.filename),
+                ('awips_product', product.awips_product),
+                ('wmo_issuance_time', _isoformat(product.wmo_issuance_time)),
+                ('segment', j),
+            ])
+            if vtec_code is None:
+                for name in FIELDS[4:12]:
+                    record[name] = None
+            else:
+                record['product_class'] = vtec_code.product
+                record['office'] = vtec_code.office
+                record['phenomena'] = vtec_code.phenomena
+                record['significance'] = vtec_code.significance
+                record['action'] = vtec_code.action
+                record['event_tracking_id'] = vtec_code.event_tracking_id
+                record['event_beginning_time'] = _isoformat(
+                    vtec_code.event_beginning_time)
+                record['event_ending_time'] = _isoformat(
+                    vtec_code.event_ending_time)
+            record.update(common)
+            yield record
+
+
+class RecordWriter(object):
+    """
+    Write segment records to a text stream as they come.
+
+    Attributes
+    ----------
+    format : str
+        Either "ndjson" or "csv".
+    count : int
+        Number of records written.
+    """
+    def __init__(self, stream, format='ndjson'):
+        """
+        Parameters
+        ----------
+        stream : file-like object
+            Text stream to write to.  A file should be opened with
+            newline='' for CSV.
+        format : str
+            Either "ndjson" or "csv".  In CSV, the UGC codes are separated
+            by spaces and the polygon is well known text.
+        """
+        if format not in FORMATS:
+            msg = 'Unknown format {}, must be one of {}'
+            raise ValueError(msg.format(format, ', '.join(FORMATS)))
+        self.format = format
+        self.count = 0
+        self._stream = stream
+        self._csv = None
+        if format == 'csv':
+            self._csv = csv.writer(stream)
+            self._csv.writerow(FIELDS)
+
+    def write_product(self, product):
+        """
+        Write the records of all of the segments of a product.
+        """
+        for record in segment_records(product):
+            self.write(record)
+
+    def write(self, record):
+        """
+        Write one record, see segment_records.
+        """
+        if self._csv is None:
+            self._stream.write(json.dumps(record))
+            self._stream.write('\n')
+        else:
+            row = []
+            for name, value in record.items():
+                if name == 'ugc':
+                    value = ' '.join(value)
+                elif name == 'polygon' and value is not None:
+                    points = ['{} {}'.format(x, y) for x, y in value]
+                    points.append(points[0])
+                    value = 'POLYGON(({}))'.format(', '.join(points))
+                row.append('' if value is None else value)
+            self._csv.writerow(row)
+        self.count += 1
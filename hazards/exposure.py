@@ -0,0 +1,165 @@
+"""
+Exposure of large sets of fixed assets to the polygons of events.
+
+The assets are given once as arrays of coordinates and sorted by longitude,
+so that the assets within the bounding box of a polygon are found with a
+binary search.  Only those are then tested against the polygon, all at
+once.  As bulletins arrive, only the events whose polygons changed are
+evaluated again, and only over the assets around them.
+
+The membership of assets in events comes out as a sparse matrix in
+coordinate format, i.e. parallel arrays of asset rows and event columns.
+"""
+
+import collections
+
+import numpy as np
+
+from .geometry import frozen_polygon, points_in_polygon, polygon_metrics
+from .tracker import EventIndex
+
+# Sparse asset to event membership in coordinate format.  Asset rows[k] is
+# within the polygon of the event in column cols[k], whose key is
+# keys[cols[k]].  The shape is (number of assets, number of events).  With
+# scipy, scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, cols)),
+# shape=shape) is the matrix.
+Membership = collections.namedtuple('Membership',
+                                    ['rows', 'cols', 'keys', 'shape'])
+
+
+class AssetExposure(EventIndex):
+    """
+    Which assets are within the polygon of each event, see EventIndex for
+    keeping it up to date.
+
+    Attributes
+    ----------
+    x, y : ndarray
+        Longitudes and latitudes of the assets.
+    """
+    def __init__(self, x, y):
+        """
+        Parameters
+        ----------
+        x, y : array_like
+            Longitudes and latitudes of the assets, longitude positive west.
+        """
+        super(AssetExposure, self).__init__()
+        self.x = np.asarray(x, dtype=np.float64).ravel()
+        self.y = np.asarray(y, dtype=np.float64).ravel()
+        if self.x.shape != self.y.shape:
+            msg = 'Got {} longitudes but {} latitudes'
+            raise ValueError(msg.format(len(self.x), len(self.y)))
+        self._order = np.argsort(self.x, kind='stable')
+        self._sorted_x = self.x[self._order]
+
+        # The sorted indices of the assets within the polygon of each event.
+        self._assets = collections.OrderedDict()
+
+    def candidates(self, bbox):
+        """
+        Assets within a bounding box.
+
+        Parameters
+        ----------
+        bbox : tuple
+            (xmin, ymin, xmax, ymax)
+
+        Returns
+        -------
+        ndarray
+            Indices of the assets.
+        """
+        xmin, ymin, xmax, ymax = bbox
+        lo = np.searchsorted(self._sorted_x, xmin, side='left')
+        hi = np.searchsorted(self._sorted_x, xmax, side='right')
+        index = self._order[lo:hi]
+        y = self.y[index]
+        return index[(y >= ymin) & (y <= ymax)]
+
+    def within(self, polygon):
+        """
+        Assets within a polygon.
+
+        Parameters
+        ----------
+        polygon : list of tuples
+            (longitude, latitude) pairs as found in Segment.polygon
+
+        Returns
+        -------
+        ndarray
+            Sorted indices of the assets.
+        """
+        bbox, _, _ = polygon_metrics(polygon)
+        index = self.candidates(bbox)
+        inside = points_in_polygon(polygon, self.x[index], self.y[index])
+        return np.sort(index[inside])
+
+    def _value(self, bulletin):
+        return getattr(bulletin, 'polygon', None)
+
+    def _normalize(self, polygon):
+        return frozen_polygon(polygon)
+
+    def _set(self, key, polygon):
+        self._assets[key] = self.within(polygon)
+
+    def _clear(self, key):
+        del self._assets[key]
+
+    def assets(self, key):
+        """
+        Sorted indices of the assets within the polygon of an event.
+        """
+        return self._assets.get(key, np.zeros(0, dtype=np.intp))
+
+    def events(self, asset):
+        """
+        Keys of the events whose polygons contain an asset.
+        """
+        keys = []
+        for key, index in self._assets.items():
+            k = np.searchsorted(index, asset)
+            if k < len(index) and index[k] == asset:
+                keys.append(key)
+        return keys
+
+    def membership(self):
+        """
+        Sparse asset to event membership of all of the events.
+
+        Returns
+        -------
+        Membership
+        """
+        keys = list(self._assets)
+        counts = [len(index) for index in self._assets.values()]
+        if len(keys) > 0:
+            rows = np.concatenate(list(self._assets.values()))
+        else:
+            rows = np.zeros(0, dtype=np.intp)
+        cols = np.repeat(np.arange(len(keys), dtype=np.intp), counts)
+        return Membership(rows=rows, cols=cols, keys=keys,
+                          shape=(len(self.x), len(keys)))
+
+
+def exposure(x, y, events):
+    """
+    Sparse membership of assets in the polygons of some events.
+
+    Parameters
+    ----------
+    x, y : array_like
+        Longitudes and latitudes of the assets, longitude positive west.
+    events : iterable of Event
+        E.g. the live events of an EventTracker.
+
+    Returns
+    -------
+    Membership
+    """
+    assets = AssetExposure(x, y)
+    for event in events:
+        assets.add_event(event)
+    return assets.membership()
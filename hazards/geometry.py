@@ -0,0 +1,348 @@
+"""
+Polygon metrics and bulk serialization of event polygons.
+
+Coordinates are used exactly as they are stored in Segment.polygon, i.e.
+(longitude, latitude) pairs in decimal degrees, so the output agrees with
+Segment.wkt.  As in the LAT...LON lines of the bulletins, longitude is
+positive west, and so it is wherever locations are taken or given
+throughout this package.  The one exception is GeoJSON, which by default
+has longitude negative west as RFC 7946 requires.
+
+References
+----------
+[1] The GeoJSON Format, RFC 7946, https://tools.ietf.org/html/rfc7946
+[2] OpenGIS Simple Features Access, Part 1, Well-known Binary Representation
+"""
+
+import json
+import struct
+
+import numpy as np
+
+# WKB geometry type code for a polygon.
+_WKB_POLYGON = 3
+
+_WKB_BYTE_ORDER = {
+    '<': 1,
+    '>': 0,
+}
+
+
+def polygon_ring(polygon):
+    """
+    Closed ring of coordinates.
+
+    Parameters
+    ----------
+    polygon : list of tuples
+        (longitude, latitude) pairs as found in Segment.polygon
+
+    Returns
+    -------
+    ndarray
+        Array of shape (N + 1, 2), the first point is repeated as the last.
+    """
+    ring = np.empty((len(polygon) + 1, 2), dtype=np.float64)
+    ring[:-1] = polygon
+    ring[-1] = ring[0]
+    return ring
+
+
+def frozen_polygon(polygon):
+    """
+    Hashable copy of a polygon, e.g. to tell whether it changed.
+
+    Parameters
+    ----------
+    polygon : list of tuples
+        (longitude, latitude) pairs as found in Segment.polygon, or None.
+
+    Returns
+    -------
+    tuple or None
+        Tuple of (longitude, latitude) float pairs, None if the polygon is
+        None or has no vertices.
+    """
+    if polygon is None or len(polygon) == 0:
+        return None
+    return tuple((float(x), float(y)) for x, y in polygon)
+
+
+def polygon_metrics(polygon):
+    """
+    Bounding box, signed area, and centroid of a polygon.
+
+    The area and centroid are computed with the shoelace formula.  The area
+    is positive when the vertices are ordered counter-clockwise in the
+    coordinate system of the polygon.
+
+    Parameters
+    ----------
+    polygon : list of tuples
+        (longitude, latitude) pairs as found in Segment.polygon
+
+    Returns
+    -------
+    bbox : tuple
+        (xmin, ymin, xmax, ymax)
+    area : float
+        Signed area in square degrees.
+    centroid : tuple
+        (x, y) of the centroid.  For a degenerate polygon with no area, the
+        mean of the vertices is used instead.
+    """
+    ring = polygon_ring(polygon)
+    x = ring[:, 0]
+    y = ring[:, 1]
+
+    xmin, ymin = ring.min(axis=0)
+    xmax, ymax = ring.max(axis=0)
+    bbox = (float(xmin), float(ymin), float(xmax), float(ymax))
+
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area = cross.sum() / 2.0
+
+    if area == 0:
+        cx, cy = ring[:-1].mean(axis=0)
+    else:
+        cx = ((x[:-1] + x[1:]) * cross).sum() / (6.0 * area)
+        cy = ((y[:-1] + y[1:]) * cross).sum() / (6.0 * area)
+
+    return bbox, float(area), (float(cx), float(cy))
+
+
+def union_bbox(bboxes):
+    """
+    Smallest bounding box containing all of the given bounding boxes.
+
+    Parameters
+    ----------
+    bboxes : list of tuples
+        (xmin, ymin, xmax, ymax) tuples.  None entries are ignored.
+
+    Returns
+    -------
+    tuple or None
+        (xmin, ymin, xmax, ymax), or None if there were no bounding boxes.
+    """
+    bboxes = [bbox for bbox in bboxes if bbox is not None]
+    if len(bboxes) == 0:
+        return None
+    a = np.array(bboxes, dtype=np.float64)
+    xmin, ymin = a[:, 0:2].min(axis=0)
+    xmax, ymax = a[:, 2:4].max(axis=0)
+    return (float(xmin), float(ymin), float(xmax), float(ymax))
+
+
+def bbox_intersects(bbox1, bbox2):
+    """
+    Do two bounding boxes overlap?  Touching counts as overlapping.
+    """
+    return not (bbox1[2] < bbox2[0] or bbox2[2] < bbox1[0] or
+                bbox1[3] < bbox2[1] or bbox2[3] < bbox1[1])
+
+
+def point_in_polygon(polygon, x, y):
+    """
+    Is a point inside a polygon?  Uses the even-odd rule, so points exactly
+    on an edge may go either way.
+
+    Parameters
+    ----------
+    polygon : list of tuples
+        (longitude, latitude) pairs as found in Segment.polygon
+    x, y : float
+        Longitude and latitude of the point, in the same convention as the
+        polygon, i.e. longitude positive west.
+
+    Returns
+    -------
+    bool
+    """
+    return bool(points_in_polygon(polygon, x, y))
+
+
+def points_in_polygon(polygon, x, y):
+    """
+    Which points are inside a polygon?  Uses the even-odd rule, the same as
+    point_in_polygon, one edge at a time over all of the points at once.
+
+    Parameters
+    ----------
+    polygon : list of tuples
+        (longitude, latitude) pairs as found in Segment.polygon
+    x, y : array_like
+        Longitudes and latitudes of the points, in the same convention as
+        the polygon, i.e. longitude positive west.
+
+    Returns
+    -------
+    ndarray
+        Boolean array of the broadcast shape of x and y.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    inside = np.zeros(np.broadcast(x, y).shape, dtype=bool)
+
+    ring = polygon_ring(polygon)
+    for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+        if y1 == y2:
+            # A horizontal edge never straddles the line through a point.
+            continue
+        # Points whose horizontal line the edge straddles, and whose x is
+        # less than where the edge crosses that line.
+        straddles = (y1 > y) != (y2 > y)
+        xcross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= straddles & (x < xcross)
+    return inside
+
+
+def polygon_wkb(polygon, byteorder='<'):
+    """
+    Encode a polygon as well known binary.
+
+    Parameters
+    ----------
+    polygon : list of tuples
+        (longitude, latitude) pairs as found in Segment.polygon
+    byteorder : str
+        Either '<' for little endian (NDR) or '>' for big endian (XDR).
+
+    Returns
+    -------
+    bytes
+    """
+    ring = polygon_ring(polygon)
+    header = struct.pack(byteorder + 'BIII', _WKB_BYTE_ORDER[byteorder],
+                         _WKB_POLYGON, 1, ring.shape[0])
+    return header + ring.astype(byteorder + 'f8').tobytes()
+
+
+def iter_polygons(events):
+    """
+    Generate the bulletins of a collection of events that have a polygon.
+
+    Parameters
+    ----------
+    events : list
+        Event objects as returned by fetch_events
+
+    Yields
+    ------
+    tuple
+        The event and the bulletin (segment).
+    """
+    for event in events:
+        for bulletin in event:
+            if len(bulletin.polygon) > 0:
+                yield event, bulletin
+
+
+def iter_wkb(events, byteorder='<'):
+    """
+    Encode the polygons of a collection of events as well known binary.
+
+    Parameters
+    ----------
+    events : list
+        Event objects as returned by fetch_events
+    byteorder : str
+        Either '<' for little endian (NDR) or '>' for big endian (XDR).
+
+    Yields
+    ------
+    tuple
+        The event, the bulletin (segment), and the WKB bytes.
+    """
+    for event, bulletin in iter_polygons(events):
+        yield event, bulletin, polygon_wkb(bulletin.polygon,
+                                           byteorder=byteorder)
+
+
+def feature_properties(event, bulletin):
+    """
+    GeoJSON properties describing one bulletin of an event.
+    """
+    vtec_code = event.vtec_code
+    action = None
+    for code in bulletin.vtec:
+        if event.contains(code):
+            action = code.action
+            break
+
+    expiration_date = bulletin.expiration_date
+    if expiration_date is not None:
+        expiration_date = expiration_date.isoformat()
+
+    return {
+        'product': vtec_code.product,
+        'action': action,
+        'office': vtec_code.office,
+        'phenomena': vtec_code.phenomena,
+        'significance': vtec_code.significance,
+        'event_tracking_id': vtec_code.event_tracking_id,
+        'expiration_date': expiration_date,
+    }
+
+
+def geojson_ring(polygon):
+    """
+    Exterior ring of a polygon as RFC 7946 has it, i.e. WGS84 longitude
+    negative west, and counter-clockwise.
+
+    Parameters
+    ----------
+    polygon : list of tuples
+        (longitude, latitude) pairs as found in Segment.polygon
+
+    Returns
+    -------
+    ndarray
+        Array of shape (N + 1, 2), the first point is repeated as the last.
+    """
+    ring = polygon_ring(polygon)
+    ring[:, 0] = -ring[:, 0]
+    x = ring[:, 0]
+    y = ring[:, 1]
+    if (x[:-1] * y[1:] - x[1:] * y[:-1]).sum() < 0:
+        ring = ring[::-1]
+    return ring
+
+
+def write_geojson(events, f, positive_west=False):
+    """
+    Stream the polygons of a collection of events to a GeoJSON
+    FeatureCollection, one feature per bulletin.
+
+    Parameters
+    ----------
+    events : list
+        Event objects as returned by fetch_events
+    f : str or file-like object
+        Path to the output file, or an object opened for writing text.
+    positive_west : bool
+        If True, write the coordinates exactly as stored, longitude positive
+        west, rather than as RFC 7946 requires.
+    """
+    if not hasattr(f, 'write'):
+        with open(f, 'w') as fp:
+            write_geojson(events, fp, positive_west=positive_west)
+        return
+
+    ring = polygon_ring if positive_west else geojson_ring
+
+    f.write('{"type": "FeatureCollection", "features": [')
+    separator = '\n'
+    for event, bulletin in iter_polygons(events):
+        feature = {
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [ring(bulletin.polygon).tolist()],
+            },
+            'properties': feature_properties(event, bulletin),
+        }
+        f.write(separator)
+        f.write(json.dumps(feature))
+        separator = ',\n'
+    f.write('\n]}\n')
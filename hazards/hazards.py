@@ -9,16 +9,43 @@ and Services, Dissemination Services NWSPD 10-17, Universal Geographic CODE
 import collections
 import copy
 import datetime as dt
-import os
 import re
-import sys
-if sys.hexversion < 0x03000000:
-    from StringIO import StringIO
-else:
-    from io import BytesIO
 import warnings
 
-import numpy as np
+from . import corpus
+
+# NumPy and the geometry module are only imported once a polygon turns up, so
+# that the command line tools start quickly.
+
+
+# Bulletins are parsed as bytes, only the fields that are returned are decoded.
+_ENCODING = 'utf-8'
+
+
+class _LazyRegex(object):
+    """
+    Regular expression that is only compiled when first used.
+
+    Once compiled, the matching methods are bound directly onto the instance
+    so that later calls do not go through __getattr__.
+    """
+    _METHODS = ('match', 'search', 'finditer', 'findall', 'split', 'sub',
+                'subn', 'fullmatch')
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        regex = re.compile(self.pattern, self.flags)
+        for method in self._METHODS:
+            if hasattr(regex, method):
+                setattr(self, method, getattr(regex, method))
+        self.groupindex = regex.groupindex
+        self.groups = regex.groups
+        return getattr(regex, name)
 
 
 # Dictionary of time zone abbreviations (keys) and their UTC offsets (values)
@@ -77,6 +104,24 @@ _VTEC_ACTION_CODE = {
     'ROU':  'Routine',
 }
 
+# Lifecycle state that an event enters upon receiving each action code.
+# Corrections and routine issuances leave the state alone.
+_VTEC_ACTION_STATE = {
+    'NEW':  'new',
+    'CON':  'continued',
+    'EXT':  'extended',
+    'EXA':  'extended',
+    'EXB':  'extended',
+    'UPG':  'upgraded',
+    'CAN':  'cancelled',
+    'EXP':  'expired',
+    'COR':  None,
+    'ROU':  None,
+}
+
+# Lifecycle states in which an event is finished.
+_CLOSED_STATES = frozenset(['upgraded', 'cancelled', 'expired'])
+
 _VTEC_SIGNIFICANCE = {
     'W':  'Warning',
     'A':  'Watch',
@@ -164,10 +209,10 @@ vtec_pattern = r'''\/
                    (?P<start>\d{6}T\d{4}Z)-
                    (?P<stop>\d{6}T\d{4}Z)
                  '''
-vtec_regex = re.compile(vtec_pattern, re.VERBOSE)
+vtec_regex = _LazyRegex(vtec_pattern.encode(), re.VERBOSE)
 
 # Regular expression for parsing a UGC string.  See NWSI 10-1702 for details.
-UGC_regex = re.compile(r'''(\w{2}[CZ](\d{3}((-|>)\s?(\n\n)?))+)+
+UGC_regex = _LazyRegex(br'''(\w{2}[CZ](\d{3}((-|>)\s?(\n\n)?))+)+
                            (?P<day>\d{2})
                            (?P<hour>\d{2})
                            (?P<minute>\d{2})-
@@ -177,7 +222,7 @@ UGC_regex = re.compile(r'''(\w{2}[CZ](\d{3}((-|>)\s?(\n\n)?))+)+
 # identifier.  See NWSI 10-1701.
 # The location ID will sometimes have line feeds instead of trailing spaces,
 # which violates the spec.
-WMO_AWIPS_regex = re.compile(r'''(?P<dtype_form>\w{2})
+WMO_AWIPS_regex = _LazyRegex(br'''(?P<dtype_form>\w{2})
                                  (?P<geog>\w{2})
                                  (?P<code>\d{2})\s
                                  (?P<office>\w{4})\s
@@ -186,10 +231,76 @@ WMO_AWIPS_regex = re.compile(r'''(?P<dtype_form>\w{2})
                                  (?P<awips_product>\w{3})
                                  (?P<awips_loc_id>[\w\s]{3})''', re.VERBOSE)
 
+# Segment attributes that can be selected with the "fields" argument, and
+# the optional parsing steps that produce them.  The UGC and VTEC attributes
+# come from the segment header and are always parsed.
+_PARSE_HEADLINES_FIELDS = frozenset(['headline'])
+_PARSE_LAT_LON_FIELDS = frozenset(['polygon', 'wkt', 'bbox', 'area',
+                                   'centroid'])
+_PARSE_TIME_MOTION_LOCATION_FIELDS = frozenset(['time_motion_location'])
+_PARSE_MND_ISSUANCE_TIME_FIELDS = frozenset(['mnd_issuance_time'])
+_OPTIONAL_FIELDS = (_PARSE_HEADLINES_FIELDS |
+                    _PARSE_LAT_LON_FIELDS |
+                    _PARSE_TIME_MOTION_LOCATION_FIELDS |
+                    _PARSE_MND_ISSUANCE_TIME_FIELDS)
+SEGMENT_FIELDS = _OPTIONAL_FIELDS | frozenset(['expiration_date', 'states',
+                                               'ugc_format', 'ugc_groups',
+                                               'vtec'])
+
+# Scheduling priority of products, lower goes first.  The keys are either
+# (phenomena, significance) VTEC code pairs or three-letter AWIPS product
+# categories, a product gets the lowest priority of any key that it matches
+# and ROUTINE_PRIORITY if it matches none.  Life-safety warnings, along with
+# the statements that follow them up, jump ahead of the routine products.
+ROUTINE_PRIORITY = 100
+PRIORITIES = {
+    ('TO', 'W'): 0,
+    ('SV', 'W'): 1,
+    ('FF', 'W'): 1,
+}
+
+# Points along the way from a bulletin file to an event that a product is
+# timestamped at, see Product.ingest_times.  The file is seen when it is
+# read, the product is framed when it is split from the file, and it is
+# aggregated when handed to an event tracker.
+INGEST_STAGES = ('seen', 'framed', 'parsed', 'aggregated')
+
+# How far into a product to look for the WMO heading and AWIPS identifier.
+_PEEK_BYTES = 256
+
+# Compact record of one bulletin in the life of an event.
+EventHistory = collections.namedtuple('EventHistory',
+                                      ['action', 'issuance_time',
+                                       'expiration_date'])
+
 TimeMotionLocation = collections.namedtuple('TimeMotionLocation',
                                             ['time', 'direction',
                                              'speed', 'location'])
 
+# A product or segment that failed to parse.  The offset is that of the
+# product within the decompressed file, and the segment is its index within
+# the product, or None if the whole product failed.
+QuarantineRecord = collections.namedtuple('QuarantineRecord',
+                                          ['filename', 'offset', 'segment',
+                                           'error', 'message'])
+
+
+def _decode(value):
+    """
+    Decode bytes matched within a bulletin.  None and str pass through.
+    """
+    if isinstance(value, bytes):
+        return value.decode(_ENCODING, 'replace')
+    return value
+
+
+def _universal_newlines(raw):
+    """
+    Translate the line endings of raw bytes the way that text mode with
+    universal newlines would, so "\r\r\n" becomes "\n\n".
+    """
+    return raw.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
 
 class VtecCode(object):
     """
@@ -229,11 +340,12 @@ class VtecCode(object):
         Parameters
         ----------
         match : regular expression match object
-            Matches vtec code
+            Matches vtec code, either str or bytes
         """
-        self.code = match.group()
+        self.code = _decode(match.group())
 
-        gd = match.groupdict()
+        gd = dict((key, _decode(value))
+                  for key, value in match.groupdict().items())
         if gd['start'] == '000000T0000Z':
             self.event_beginning_time = None
         else:
@@ -263,6 +375,25 @@ class VtecCode(object):
         self.significance = gd['significance']
         self.event_tracking_id = int(gd['event_tracking_id'])
 
+    def encode(self):
+        """
+        Encode in the compact binary wire format, see hazards.wire.
+
+        Returns
+        -------
+        bytes
+        """
+        from . import wire
+        return wire.encode_vtec(self)
+
+    @classmethod
+    def decode(cls, buf):
+        """
+        Decode from the compact binary wire format, see hazards.wire.
+        """
+        from . import wire
+        return wire.decode_vtec(buf)
+
 
 class NoVtecCodeException(Exception):
     def __init__(self, message):
@@ -274,30 +405,242 @@ class UGCParsingError(Exception):
         self.message = message
 
 
-def fetch_events(dirname, numlast=None, current=None):
+class FieldNotParsedError(AttributeError):
+    """
+    Raised when accessing a segment attribute that was excluded from parsing
+    by the "fields" argument.
+    """
+    def __init__(self, message):
+        self.message = message
+        super(FieldNotParsedError, self).__init__(message)
+
+
+class Quarantine(object):
+    """
+    Collect the products and segments that fail to parse instead of giving
+    up on them.
+
+    Pass one to HazardsFile or fetch_events so that a malformed bulletin is
+    recorded and skipped, and the rest of the file is still parsed.
+
+    Attributes
+    ----------
+    counts : collections.Counter
+        Number of failures by exception class name.
+    records : list
+        QuarantineRecord for each failure, up to max_records of them.
+    max_records : int
+        Only keep this many records, the counts go on regardless.  None
+        means keep all of them.
+    """
+    def __init__(self, max_records=None):
+        self.max_records = max_records
+        self.counts = collections.Counter()
+        self.records = []
+
+    def __len__(self):
+        """
+        Implements built-in len(), returns the number of failures.
+        """
+        return sum(self.counts.values())
+
+    def __iter__(self):
+        """
+        Implements iterator protocol over the records.
+        """
+        return iter(self.records)
+
+    def add(self, filename, offset, error, segment=None):
+        """
+        Record a failure.
+
+        Parameters
+        ----------
+        filename : str
+            Bulletin file of the product.
+        offset : int
+            Byte offset of the product within the decompressed file.
+        error : Exception
+            What went wrong.
+        segment : int
+            Index of the segment within the product, if only the segment
+            failed.
+        """
+        name = type(error).__name__
+        self.counts[name] += 1
+        if self.max_records is None or len(self.records) < self.max_records:
+            message = getattr(error, 'message', None)
+            if message is None:
+                message = str(error)
+            record = QuarantineRecord(filename, offset, segment, name,
+                                      message)
+            self.records.append(record)
+
+    def merge(self, other):
+        """
+        Take in the failures recorded by another quarantine, e.g. one filled
+        in a worker process.
+        """
+        self.counts.update(other.counts)
+        for record in other.records:
+            if (self.max_records is not None and
+                    len(self.records) >= self.max_records):
+                break
+            self.records.append(record)
+
+    def report(self):
+        """
+        Summary of the failures by exception class, most frequent first.
+
+        Returns
+        -------
+        str
+        """
+        lines = ['{} quarantined'.format(len(self))]
+        for name, count in sorted(self.counts.items(),
+                                  key=lambda item: (-item[1], item[0])):
+            lines.append('{:8d}  {}'.format(count, name))
+        return '\n'.join(lines)
+
+
+def _check_fields(fields):
+    """
+    Validate a field projection.
+
+    Parameters
+    ----------
+    fields : iterable of str or None
+        Segment attributes that the caller wants parsed.  None means all of
+        them.
+
+    Returns
+    -------
+    frozenset or None
+    """
+    if fields is None:
+        return None
+    fields = frozenset(fields)
+    unknown = fields - SEGMENT_FIELDS
+    if len(unknown) > 0:
+        msg = 'Unknown segment field(s):  {}.  Valid fields are {}.'
+        raise ValueError(msg.format(', '.join(sorted(unknown)),
+                                    ', '.join(sorted(SEGMENT_FIELDS))))
+    return fields
+
+
+def _check_priorities(priorities):
+    """
+    Validate a priority table, see PRIORITIES.
+
+    Returns
+    -------
+    dict or None
+    """
+    if priorities is None:
+        return None
+    priorities = dict(priorities)
+    for key, value in priorities.items():
+        if isinstance(key, tuple):
+            valid = (len(key) == 2 and key[0] in _VTEC_PHENOMENA and
+                     key[1] in _VTEC_SIGNIFICANCE)
+        else:
+            valid = isinstance(key, str) and len(key) == 3
+        if not valid:
+            msg = 'Invalid priority key:  {!r}'
+            raise ValueError(msg.format(key))
+        if not isinstance(value, int):
+            msg = 'Priority of {!r} is not an integer:  {!r}'
+            raise ValueError(msg.format(key, value))
+    return priorities
+
+
+def peek_product(raw_item):
+    """
+    Identify a product without parsing it.  Only the WMO heading at the top
+    and the VTEC codes are scanned for.
+
+    Parameters
+    ----------
+    raw_item : bytes
+        Raw bytes of the product, see split_products.
+
+    Returns
+    -------
+    tuple
+        The AWIPS product category, e.g. "TOR", or None if there is no WMO
+        heading, and the set of (phenomena, significance) pairs of the VTEC
+        codes.
+    """
+    m = WMO_AWIPS_regex.search(_universal_newlines(raw_item[:_PEEK_BYTES]))
+    awips_product = None if m is None else _decode(m.group('awips_product'))
+    codes = set((_decode(m.group('phenomena')),
+                 _decode(m.group('significance')))
+                for m in vtec_regex.finditer(raw_item))
+    return awips_product, codes
+
+
+def product_priority(raw_item, priorities=PRIORITIES):
+    """
+    Scheduling priority of a product, lower goes first.
+
+    Parameters
+    ----------
+    raw_item : bytes
+        Raw bytes of the product, see split_products.
+    priorities : dict
+        Priority table, see PRIORITIES.
+
+    Returns
+    -------
+    int
+    """
+    awips_product, codes = peek_product(raw_item)
+    candidates = [priorities[code] for code in codes if code in priorities]
+    if awips_product in priorities:
+        candidates.append(priorities[awips_product])
+    return min(candidates) if len(candidates) > 0 else ROUTINE_PRIORITY
+
+
+def fetch_events(dirname, numlast=None, current=None, fields=None,
+                 recursive=False, since=None, until=None, quarantine=None):
     """
     Parameters
     ----------
     dirname : str
-        Directory of hazard bulletin files
+        Directory of hazard bulletin files.  Compressed files and tar or zip
+        archives of bulletin files are read in place.  The files are read in
+        the order of the YYYYMMDDHH dates in their names.
     numlast : int
-        Only take this many "most recent" files
+        Only take this many "most recent" files, according to the dates in
+        their names.
     current : bool
         If True, keep only current events, that is, events that have not
         expired
+    fields : iterable of str
+        If provided, only parse these segment attributes.  The VTEC codes
+        and expiration date are always parsed since events cannot be
+        assembled without them.
+    recursive : bool
+        If True, also read the bulletin files in subdirectories.
+    since, until : datetime.datetime
+        Only take files whose names are dated at or after since, and before
+        until.  The files are selected without opening them.
+    quarantine : Quarantine
+        If provided, malformed products and segments are recorded here and
+        skipped instead of raising.
     """
-    lst = os.listdir(dirname)
+    if fields is not None:
+        fields = _check_fields(fields) | {'vtec', 'expiration_date'}
 
-    # exclude if it starts with a "."
-    lst = [item for item in lst if not item.startswith('.')]
+    entries = corpus.iter_entries(dirname, recursive=recursive)
+    entries = corpus.select_entries(entries, since=since, until=until,
+                                    numlast=numlast)
 
-    if numlast is None:
-        fnames = [os.path.join(dirname, item) for item in lst]
-    else:
-        fnames = [os.path.join(dirname, item) for item in lst[numlast:]]
     hzlst = []
-    for fname in fnames:
-        hzlst.append(HazardsFile(fname))
+    for entry in entries:
+        with entry.open() as fileobj:
+            hzlst.append(HazardsFile(entry.name, fields=fields,
+                                     fileobj=fileobj, quarantine=quarantine))
 
     events = []
     for hazard_file in hzlst:
@@ -313,7 +656,7 @@ def fetch_events(dirname, numlast=None, current=None):
                         # the sequence of events.
                         assert len(evts) == 1
                         evt = evts[0]
-                        evt.append(segment)
+                        evt.append(segment, vtec_code)
 
     if current is not None and current:
         events = [event for event in events if event.not_expired()]
@@ -321,6 +664,74 @@ def fetch_events(dirname, numlast=None, current=None):
     return events
 
 
+def split_products(raw):
+    """
+    Split the contents of a bulletin file into separate products.  Look for
+    the end of product codes juxtaposed with beginning of product codes.
+
+    Parameters
+    ----------
+    raw : bytes
+        Decompressed contents of a bulletin file.
+
+    Yields
+    ------
+    tuple
+        Byte offset of the product within the contents, and the raw bytes
+        of the product with the line endings untouched.
+    """
+    offset = 0
+    for raw_item in raw.split(b'\x03\x01'):
+        yield offset, raw_item
+        offset += len(raw_item) + 2
+
+
+def parse_product(raw_item, base_date, fields=None, quarantine=None,
+                  filename=None, offset=None, ingest_times=None):
+    """
+    Parse one product as split from a bulletin file.  The line endings are
+    translated one product at a time.
+
+    Parameters
+    ----------
+    raw_item : bytes
+        Raw bytes of the product, see split_products.
+    base_date : datetime.datetime
+        Date attached to the file from whence this product came.
+    fields : frozenset
+        If provided, only parse these segment attributes.
+    quarantine : Quarantine
+        If provided, failures are recorded here instead of raised.
+    filename : str
+        Bulletin file that the product came from.
+    offset : int
+        Byte offset of the product within the decompressed file.
+    ingest_times : dict
+        Earlier ingest stages that the product went through, see
+        INGEST_STAGES.  The time of parsing is added.
+
+    Returns
+    -------
+    Product or None
+        None for empty products, test messages, and quarantined products.
+    """
+    try:
+        product = Product(_universal_newlines(raw_item), base_date=base_date,
+                          fields=fields, quarantine=quarantine,
+                          filename=filename, offset=offset)
+        if ingest_times is not None:
+            product.ingest_times.update(ingest_times)
+        product.ingest_times['parsed'] = dt.datetime.utcnow()
+        return product
+    except (EmptyProductException, TestMessageException):
+        return None
+    except Exception as e:
+        if quarantine is None:
+            raise
+        quarantine.add(filename, offset, e)
+        return None
+
+
 class HazardsFile(object):
     """
     Collection of hazard messages.
@@ -329,44 +740,50 @@ class HazardsFile(object):
     ----------
     filename : str
         Path to source file
+    fields : frozenset or None
+        Segment attributes that were parsed.  None means all of them.
     """
-    def __init__(self, fname):
+    def __init__(self, fname, fields=None, fileobj=None, quarantine=None):
         """
         Parameters
         ----------
         fname : filename
-            File for filename to read.
+            File for filename to read.  Files ending with ".gz", ".bz2", or
+            ".xz" are decompressed on the fly.
+        fields : iterable of str
+            If provided, only parse these segment attributes.  See
+            SEGMENT_FIELDS for the possibilities.  Accessing an attribute
+            that was not parsed raises FieldNotParsedError.
+        fileobj : file-like object
+            If provided, read the contents from this binary stream instead
+            of opening fname, e.g. a member of a tar archive.  The name is
+            still used for the date and the decompression.  The caller
+            closes it.
+        quarantine : Quarantine
+            If provided, products and segments that fail to parse are
+            recorded here and skipped, otherwise the exception propagates.
         """
         self.filename = fname
+        self.fields = _check_fields(fields)
         self._items = []
 
-        # Use universal newline support.
-        with open(fname, 'rtU') as f:
-            txt = f.read()
+        # Read the raw bytes.  Nothing is decoded until it is asked for.
+        seen = dt.datetime.utcnow()
+        with corpus.open_bulletin(fname, fileobj=fileobj) as f:
+            raw = f.read()
 
         # Get the base date from the filename.  The format is
         # YYYYMMDDHH.xxxx
-        basename = os.path.basename(fname)
-        try:
-            file_base_date = dt.datetime(int(basename[0:4]),
-                                         int(basename[4:6]),
-                                         int(basename[6:8]),
-                                         int(basename[8:10]), 0, 0)
-        except ValueError:
-            # Have not seen this case yet in the wild, but maybe...
-            file_base_date = None
-
-        # Split the text into separate events.  Look for the end of product
-        # codes juxtaposed with beginning of product codes.
-        regex = re.compile('\x03\x01')
-        self._items = []
-        for j, text_item in enumerate(regex.split(txt)):
-            try:
-                prod = Product(text_item, base_date=file_base_date)
-            except (EmptyProductException, TestMessageException):
-                continue
+        file_base_date = corpus.file_date(fname)
 
-            self._items.append(prod)
+        self._items = []
+        for offset, raw_item in split_products(raw):
+            ingest_times = {'seen': seen, 'framed': dt.datetime.utcnow()}
+            prod = parse_product(raw_item, file_base_date, fields=self.fields,
+                                 quarantine=quarantine, filename=fname,
+                                 offset=offset, ingest_times=ingest_times)
+            if prod is not None:
+                self._items.append(prod)
 
     def __str__(self):
         return "Filename:  {}".format(self.filename)
@@ -404,19 +821,40 @@ class Product(object):
 
     Attributes
     ----------
+    raw : bytes
+        Text constituting the entire product, newlines already translated
     segments : list
         Segments contained in this product.  An unsegmented product is treated
         as a product with a single segment.
+    txt : str
+        Decoded text of the entire product, only decoded when asked for
+    filename : str
+        Bulletin file that the product came from, if known
+    offset : int
+        Byte offset of the product within the decompressed file, if known
+    ingest_times : dict
+        When the product went through each of the INGEST_STAGES that it has
+        reached, in UTC
     """
 
-    def __init__(self, txt, base_date):
+    def __init__(self, txt, base_date, fields=None, quarantine=None,
+                 filename=None, offset=None):
         """
         Parameters
         ----------
-        txt : str
+        txt : bytes or str
             Text constituting the entire product
         base_date : datetime.datetime
             Date attached to the file from whence this bulletin came.
+        fields : frozenset
+            If provided, only parse these segment attributes.
+        quarantine : Quarantine
+            If provided, segments that fail to parse are recorded here and
+            skipped, otherwise the exception propagates.
+        filename : str
+            Bulletin file that the product came from.
+        offset : int
+            Byte offset of the product within the decompressed file.
         office : str
             ID of issuing office
         wmo_dtype, wmo_geog, wmo_code, wmo_retrans : str, str, int, str
@@ -426,24 +864,66 @@ class Product(object):
         awips_product, awips_location_id : str, str
             As defined in [1]
         """
-        self.txt = txt
+        if not isinstance(txt, bytes):
+            txt = txt.encode(_ENCODING)
+        self.raw = txt
         self.base_date = base_date
+        self.filename = filename
+        self.offset = offset
+        self.ingest_times = {}
 
         self.segments = []
         self.parse_wmo_abbreviated_heading_awips_id()
 
         # Each segment is delimited by "$$".  The last one is the product
         # trailer, which we will not parse.
-        lst = re.split('\$\$', self.txt)
+        lst = self.raw.split(b'$$')
         for j, text_item in enumerate(lst[:-1]):
             try:
-                segment = Segment(text_item, base_date, first_segment=(j == 0))
+                segment = Segment(text_item, base_date,
+                                  first_segment=(j == 0), fields=fields)
                 self.segments.append(segment)
             except (EmptySegmentException, TestMessageException):
                 pass
+            except Exception as e:
+                if quarantine is None:
+                    raise
+                quarantine.add(filename, offset, e, segment=j)
 
         # self.parse_forecaster_identifier()
 
+    @property
+    def txt(self):
+        """
+        Decoded text of the entire product.
+        """
+        return _decode(self.raw)
+
+    def encode(self, raw=False):
+        """
+        Encode in the compact binary wire format, see hazards.wire.
+
+        Parameters
+        ----------
+        raw : bool
+            If True, include the raw text of the product and its segments.
+
+        Returns
+        -------
+        bytes
+        """
+        from . import wire
+        return wire.encode_product(self, raw=raw)
+
+    @classmethod
+    def decode(cls, buf):
+        """
+        Decode from the compact binary wire format, see hazards.wire.  The
+        raw text is None unless it was encoded.
+        """
+        from . import wire
+        return wire.decode_product(buf)
+
     def parse_forecaster_identifier(self):
         """
         A forecaster identifier at the end of the product is optional.
@@ -475,15 +955,15 @@ class Product(object):
             self.forecaster_identifier = m.groupdict()['fid']
 
     def parse_wmo_abbreviated_heading_awips_id(self):
-        m = WMO_AWIPS_regex.search(self.txt)
+        m = WMO_AWIPS_regex.search(self.raw)
         if m is None:
-            import ipdb; ipdb.set_trace()
-            raise InvalidProductException()
+            msg = 'No WMO abbreviated heading and AWIPS ID found'
+            raise InvalidProductException(msg)
 
-        self.wmo_dtype = m.group('dtype_form')
-        self.wmo_geog = m.group('geog')
+        self.wmo_dtype = _decode(m.group('dtype_form'))
+        self.wmo_geog = _decode(m.group('geog'))
         self.wmo_code = int(m.group('code'))
-        self.wmo_office = m.group('office')
+        self.wmo_office = _decode(m.group('office'))
 
         day = int(m.group('dd'))
         hour = int(m.group('hh'))
@@ -492,9 +972,9 @@ class Product(object):
         self.wmo_issuance_time = adjust_to_base_date(self.base_date,
                                                      day, hour, minute)
 
-        self.wmo_retrans = m.group('retrans')
-        self.awips_product = m.group('awips_product')
-        self.awips_location_id = m.group('awips_loc_id')
+        self.wmo_retrans = _decode(m.group('retrans'))
+        self.awips_product = _decode(m.group('awips_product'))
+        self.awips_location_id = _decode(m.group('awips_loc_id'))
         if '\n' in self.awips_location_id:
             msg = '"{}" is technically an invalid AWIPS location ID'
             warnings.warn(msg.format(self.awips_location_id))
@@ -527,7 +1007,9 @@ class TestMessageException(Exception):
 
 
 class InvalidProductException(Exception):
-    pass
+    def __init__(self, message):
+        self.message = message
+        super(InvalidProductException, self).__init__(message)
 
 
 class EmptySegmentException(Exception):
@@ -547,53 +1029,89 @@ class Segment(object):
     Attributes
     ----------
     txt : str
-        the raw text found within the segment
+        the text found within the segment, only decoded when asked for
+    raw : bytes
+        the undecoded text found within the segment
+    area : float
+        signed area of the polygon in square degrees
     base_date : datetime.datetime
         date attached to the file from whence this bulletin came
+    bbox : tuple
+        (xmin, ymin, xmax, ymax) bounding box of the polygon
+    centroid : tuple
+        (x, y) centroid of the polygon
     expiration_date
         See [1]
+    fields : frozenset or None
+        Attributes that were requested when parsing.  None means all of them.
     headline : str
     mnd_issuance_time : datetime.datetime
     polygon
     states : dict
         Maps states to the 3-digit FIPS codes for associated counties /
-        parishes / zones.
+        parishes / zones.  A segment may list both counties and zones of a
+        state, see ugc_groups to tell them apart.
     time_motion_location : collections.namedtuple
     ugc_format : str
-        Either 'county' or 'zone'
-    wkt
+        Either 'county' or 'zone', that of the last UGC group if the segment
+        mixes them.
+    ugc_groups : dict
+        Maps (state, format) pairs, the format being 'C' or 'Z', to the
+        county or zone numbers.
+    ugc_codes : list
+        UGC codes like "KSC075", formulated on demand
+    wkt : str
+        Well known text of the polygon, formulated on demand
     vtec
     """
 
-    def __init__(self, txt, base_date=None, first_segment=False):
+    def __init__(self, txt, base_date=None, first_segment=False,
+                 fields=None):
         """
         Parameters
         ----------
-        txt : str
+        txt : bytes or str
             Text constituting the entire bulletin
         base_date : datetime.datetime
             Date attached to the file from whence this bulletin came.
         first_segment : bool
             First segment?  Must have awips identifier.
+        fields : iterable of str
+            If provided, only parse these attributes.  The others are not
+            set at all, and accessing them raises FieldNotParsedError.
         """
-        self.txt = txt
+        if not isinstance(txt, bytes):
+            txt = txt.encode(_ENCODING)
+        self.raw = txt
+        self._clean_txt = False
         self.base_date = base_date
+        self.fields = _check_fields(fields)
+
+        # Always parsed, they come from the segment header.
         self.expiration_date = None
-        self.headline = None
-        self.mnd_issuance_time = None
-        self.polygon = []
         self.states = None
-        self.time_motion_location = None
         self.ugc_format = None
-        self.wkt = None
+        self.ugc_groups = None
         self.vtec = []
 
+        if self._wants(_PARSE_HEADLINES_FIELDS):
+            self.headline = None
+        if self._wants(_PARSE_MND_ISSUANCE_TIME_FIELDS):
+            self.mnd_issuance_time = None
+        if self._wants(_PARSE_LAT_LON_FIELDS):
+            self.polygon = []
+            self.bbox = None
+            self.area = None
+            self.centroid = None
+        if self._wants(_PARSE_TIME_MOTION_LOCATION_FIELDS):
+            self.time_motion_location = None
+
         # Characterize the segment.
-        m = re.search('\n+', txt)
+        m = re.search(b'\n+', txt)
         if m.span()[0] == 0 and m.span()[1] == len(txt):
             # The segment is empty.
             raise EmptySegmentException()
-        elif re.search('THIS IS A TEST MESSAGE.', txt) is not None:
+        elif re.search(b'THIS IS A TEST MESSAGE.', txt) is not None:
             # The segment is a test message.  Nothing more to do.
             return
         elif UGC_regex.search(txt) is not None:
@@ -604,11 +1122,11 @@ class Segment(object):
             self.parse_content_block()
             self.parse_communications_trailer()
 
-            # Clean up the text a bit.
-            self.txt = self.txt.replace('\n\n', '\n').strip('\x01')
+            # Clean up the text a bit, but only once it is decoded.
+            self._clean_txt = True
             return
 
-        elif re.search('&&', txt) is not None:
+        elif re.search(b'&&', txt) is not None:
             # Ignore these for now, not sure what to do with them.
             # They are certainly legal.  Not sure what to parse, though.
             return
@@ -627,15 +1145,74 @@ class Segment(object):
 
         # Assume that the segment has a UGC string, VTEC, etc.
 
+    @property
+    def txt(self):
+        """
+        Decoded text of the segment, None if the raw text was not decoded
+        from the wire format.
+        """
+        txt = _decode(self.raw)
+        if txt is not None and self._clean_txt:
+            txt = txt.replace('\n\n', '\n').strip('\x01')
+        return txt
+
+    def encode(self, raw=False):
+        """
+        Encode in the compact binary wire format, see hazards.wire.
+
+        Parameters
+        ----------
+        raw : bool
+            If True, include the raw text.
+
+        Returns
+        -------
+        bytes
+        """
+        from . import wire
+        return wire.encode_segment(self, raw=raw)
+
+    @classmethod
+    def decode(cls, buf):
+        """
+        Decode from the compact binary wire format, see hazards.wire.  The
+        polygon is a read-only array that shares memory with the buffer.
+        """
+        from . import wire
+        return wire.decode_segment(buf)
+
+    def __getattr__(self, name):
+        """
+        Only invoked when normal attribute lookup fails, which for the
+        segment fields means that they were excluded from parsing.
+        """
+        if name in _OPTIONAL_FIELDS:
+            msg = ('The "{}" attribute was not parsed because it was not '
+                   'among the requested fields ({}).')
+            fields = self.__dict__.get('fields') or ()
+            raise FieldNotParsedError(msg.format(name,
+                                                 ', '.join(sorted(fields))))
+        msg = "'{}' object has no attribute '{}'"
+        raise AttributeError(msg.format(type(self).__name__, name))
+
+    def _wants(self, names):
+        """
+        Should any of these attributes be parsed?
+        """
+        return self.fields is None or not self.fields.isdisjoint(names)
+
     def parse_content_block(self):
         """
         Parse all text information following the Segment Header Block.
         """
-        self.parse_headlines()
+        if self._wants(_PARSE_HEADLINES_FIELDS):
+            self.parse_headlines()
         self.parse_narrative()
         self.parse_call_to_action()
-        self.parse_lat_lon()
-        self.parse_time_motion_location()
+        if self._wants(_PARSE_LAT_LON_FIELDS):
+            self.parse_lat_lon()
+        if self._wants(_PARSE_TIME_MOTION_LOCATION_FIELDS):
+            self.parse_time_motion_location()
 
     def parse_lat_lon(self):
         """
@@ -649,37 +1226,64 @@ class Segment(object):
             Content of message.
         """
         self.polygon = []
-        self.wkt = None
+        self.bbox = None
+        self.area = None
+        self.centroid = None
 
         # Look for the constant LAT...LON string, and then
         #     at least one space, maybe more
         #     ... followed by indeterminate number of lat/lon pairs
         #     ... terminated by the carriage return sequence
         #     and match this pattern at least one, maybe more
-        regex = re.compile(r'''LAT...LON(?P<latlon>(((\s+(\d{4,5}\s\d{4,5}\s?)
+        regex = re.compile(br'''LAT...LON(?P<latlon>(((\s+(\d{4,5}\s\d{4,5}\s?)
                                                          +\n\n)+)))''',
                            re.VERBOSE)
-        m = regex.search(self.txt)
+        m = regex.search(self.raw)
         if m is None:
             return
 
         self.polygon = self._parse_latlon_pairs(m.group('latlon'))
-        self.create_wkt()
+        from .geometry import polygon_metrics
+        self.bbox, self.area, self.centroid = polygon_metrics(self.polygon)
+
+    @property
+    def wkt(self):
+        """
+        Well known text of the polygon, or None if there is no polygon.  It
+        is only formulated when asked for.
+        """
+        return self.create_wkt()
 
     def create_wkt(self):
         """
         Formulate WKT from the polygon.
+
+        Returns
+        -------
+        str or None
         """
-        # Must include the first point as the last point.
-        lst = copy.deepcopy(self.polygon)
-        lst.append(lst[0])
+        if len(self.polygon) == 0:
+            return None
 
-        # Build up the inner (and only) ring.
-        txt = '{} {}'.format(lst[0][0], lst[0][1])
-        for tuple in lst[1:]:
-            txt = txt + ', {} {}'.format(tuple[0], tuple[1])
+        # Must include the first point as the last point to close the inner
+        # (and only) ring.
+        points = ['{} {}'.format(lon, lat) for lon, lat in self.polygon]
+        points.append(points[0])
 
-        self.wkt = 'POLYGON(({}))'.format(txt)
+        return 'POLYGON(({}))'.format(', '.join(points))
+
+    @property
+    def ugc_codes(self):
+        """
+        UGC codes of the counties or zones, like "KSC075", sorted by state.
+        """
+        if self.ugc_groups is None:
+            return []
+        codes = []
+        for (state, letter), numbers in sorted(self.ugc_groups.items()):
+            codes.extend('{}{}{:03d}'.format(state, letter, number)
+                         for number in numbers)
+        return codes
 
     def parse_time_motion_location(self):
         """
@@ -694,14 +1298,14 @@ class Segment(object):
         """
         self.time_motion_location = None
 
-        regex = re.compile(r"""TIME...MOT...LOC\s
+        regex = re.compile(br"""TIME...MOT...LOC\s
                                (?P<tml_hh>\d{1,2})
                                (?P<tml_mm>\d{2})Z\s
                                (?P<tml_dir>\d{3})DEG\s
                                (?P<tml_speed>\d{2})KT\s
                                (?P<tml_loc>[\s\r\n\d{4,5}]+\n\n)
                             """, re.VERBOSE)
-        m = regex.search(self.txt)
+        m = regex.search(self.raw)
         if m is None:
             return
 
@@ -724,21 +1328,17 @@ class Segment(object):
 
         Parameters
         ----------
-        text : str
+        text : bytes
             e.g.
 
-            "4862 10197 4828 10190 4827 10223 4851 10259\r\r\n"
-            "4870 10238"
+            b"4862 10197 4828 10190 4827 10223 4851 10259\n\n"
+            b"4870 10238"
 
             It could be a single point.
         """
-        latlon_txt = text.replace('\n', ' ')
-        if sys.hexversion < 0x03000000:
-            nums = np.genfromtxt(StringIO(unicode(latlon_txt)))
-        else:
-            nums = np.genfromtxt(BytesIO(latlon_txt.encode()))
-        lats = [float(x)/100.0 for x in nums[0::2]]
-        lons = [float(x)/100.0 for x in nums[1::2]]
+        nums = [int(x) for x in text.split()]
+        lats = [x / 100.0 for x in nums[0::2]]
+        lons = [x / 100.0 for x in nums[1::2]]
 
         return [item for item in zip(lons, lats)]
 
@@ -752,14 +1352,14 @@ class Segment(object):
         pass
 
     def parse_headlines(self):
-        regex = re.compile(r'''\n\n\n\n
+        regex = re.compile(br'''\n\n\n\n
                                \.\.\.
                                (?P<header>[0-9\w\s\./\'-]*?)
                                \.\.\.
                                \n\n\n\n''', re.VERBOSE)
-        m = regex.search(self.txt)
+        m = regex.search(self.raw)
         if m is not None:
-            raw_header = m.group('header')
+            raw_header = _decode(m.group('header'))
 
             # Replace any sequence of newlines with just a space.
             self.headline = re.sub('\n\n', ' ', raw_header)
@@ -792,7 +1392,7 @@ class Segment(object):
         [1] http://www.nws.noaa.gov/directives/sym/pd01017002curr.pdf
         """
 
-        m = UGC_regex.search(self.txt)
+        m = UGC_regex.search(self.raw)
 
         dd = int(m.group('day'))
         hh = int(m.group('hour'))
@@ -816,7 +1416,7 @@ class Segment(object):
 
         Parameters
         ----------
-        txt : str
+        txt : bytes
             UGC string
         """
         # Must match:
@@ -826,7 +1426,7 @@ class Segment(object):
         #    3) a sequence of numbers and separators identifying the
         #       counties/zones, which might span multiple lines
         #
-        ugc_regex = re.compile(r'''(?P<fips>\w{2})
+        ugc_regex = re.compile(br'''(?P<fips>\w{2})
                                    (?P<format>[CZ])
                                    (?:\d{3}((-|>)(\n\n)?))+
                                 ''', re.VERBOSE)
@@ -834,16 +1434,16 @@ class Segment(object):
         # Within the sequence of counties/zones, must match at least one
         # 3-digit code for a county or zone, but possibly an entire range
         # of zones.  If the separator is '>', that means a range of zones.
-        cty_regex = re.compile(r'''(\d{3})(-|>\d{3}-)''', re.VERBOSE)
+        cty_regex = re.compile(br'''(\d{3})(-|>\d{3}-)''', re.VERBOSE)
 
-        states = {}
+        groups = {}
         for m in ugc_regex.finditer(txt):
-            state = m.groupdict()['fips']
-            format = m.groupdict()['format']
+            state = _decode(m.groupdict()['fips'])
+            format = _decode(m.groupdict()['format'])
 
             codes = []
             for item in cty_regex.findall(m.group()):
-                if item[1] == '-':
+                if item[1] == b'-':
                     # single county or zone
                     codes.append(int(item[0]))
                 else:
@@ -853,10 +1453,27 @@ class Segment(object):
                     # intended.  Can never have a range of counties.
                     for code in range(int(item[0]), int(item[1][1:4]) + 1):
                         codes.append(code)
-            states[state] = codes
+            groups.setdefault((state, format), []).extend(codes)
+
+        self._set_ugc_groups(groups)
+        if len(groups) > 0:
+            self.ugc_format = 'county' if format == 'C' else 'zone'
 
+    def _set_ugc_groups(self, groups):
+        """
+        Set ugc_groups, and states along with it.
+
+        Parameters
+        ----------
+        groups : dict
+            Lists of county or zone numbers by (state, format) pairs, the
+            format being 'C' or 'Z'.
+        """
+        states = {}
+        for (state, format), codes in groups.items():
+            states.setdefault(state, []).extend(codes)
+        self.ugc_groups = groups
         self.states = states
-        self.ugc_format = 'county' if format == 'C' else 'zone'
 
     def parse_vtec_code(self):
         """
@@ -868,18 +1485,10 @@ class Segment(object):
 
         There can be more than one.
 
-        Parameters
-        ----------
-        txt : str
-            Content of message.
         """
         self.vtec = []
 
-        _codes = []
-
-        for m in vtec_regex.finditer(self.txt):
-            the_vtec_code = m.group()
-            _codes.append(the_vtec_code)
+        for m in vtec_regex.finditer(self.raw):
             self.vtec.append(VtecCode(m))
 
     def parse_mnd_header(self):
@@ -893,7 +1502,8 @@ class Segment(object):
             c.   an issuance office line
             d.   an issuance date/time
         """
-        self.parse_mnd_issuance_time()
+        if self._wants(_PARSE_MND_ISSUANCE_TIME_FIELDS):
+            self.parse_mnd_issuance_time()
 
     def parse_mnd_issuance_time(self):
         """
@@ -903,7 +1513,7 @@ class Segment(object):
 
         402 PM CDT WED JUN 11 2008
         """
-        regex = re.compile(r'''(?P<hh>\d{1,2})(?P<mm>\d{2})\s
+        regex = re.compile(br'''(?P<hh>\d{1,2})(?P<mm>\d{2})\s
                                (?P<meridiem>A|P)M\s
                                (?P<timezone>\w{3,4})\s
                                (?P<day_of_week>SUN|MON|TUE|WED|THU|FRI|SAT)\s
@@ -911,11 +1521,12 @@ class Segment(object):
                                (?P<dd>\d{1,2})\s
                                (?P<year>\d{4})
                             ''', re.VERBOSE)
-        m = regex.search(self.txt)
+        m = regex.search(self.raw)
         if m is None:
             issuance_dt = None
         else:
-            gd = m.groupdict()
+            gd = dict((key, _decode(value))
+                      for key, value in m.groupdict().items())
             year = int(gd['year'])
             month = _MONTH[gd['month']]
             day = int(gd['dd'])
@@ -972,14 +1583,41 @@ class Event(HazardsFile):
     ----------
     vtec_code : str
         Object containing VTEC code.
+    state : str
+        Lifecycle state driven by the VTEC action codes, one of 'new',
+        'continued', 'extended', 'upgraded', 'cancelled', or 'expired'.
+    history : list
+        EventHistory records of the action code, issuance time, and
+        expiration date of every bulletin, including those that are no
+        longer retained.
     """
-    def __init__(self, vtec_code, bulletin):
+    def __init__(self, vtec_code, bulletin, max_bulletins=None):
+        """
+        Parameters
+        ----------
+        vtec_code : VtecCode
+            VTEC code identifying the event.
+        bulletin : Segment
+            First bulletin of the event.
+        max_bulletins : int
+            If provided, only retain this many of the most recent bulletins.
+            The history is always retained.
+        """
         self.vtec_code = vtec_code
         my_bulletin = copy.deepcopy(bulletin)
         if len(bulletin.vtec) > 1:
             my_bulletin.vtec = [vtec_code]
 
-        self._items = [my_bulletin]
+        if max_bulletins is None:
+            self._items = [my_bulletin]
+        else:
+            self._items = collections.deque([my_bulletin],
+                                            maxlen=max_bulletins)
+
+        self.state = 'new'
+        self.history = []
+        self._update_history(vtec_code, bulletin)
+        self.transition([vtec_code.action])
 
     def __str__(self):
         lst = []
@@ -996,16 +1634,155 @@ class Event(HazardsFile):
         vtec_code : VtecCode
             VTEC code object
         """
-        if (((self._items[0].vtec[0].product == vtec_code.product) and
-             (self._items[0].vtec[0].office == vtec_code.office) and
-             (self._items[0].vtec[0].phenomena == vtec_code.phenomena) and
-             (self._items[0].vtec[0].event_tracking_id == vtec_code.event_tracking_id))):
+        if (((self.vtec_code.product == vtec_code.product) and
+             (self.vtec_code.office == vtec_code.office) and
+             (self.vtec_code.phenomena == vtec_code.phenomena) and
+             (self.vtec_code.event_tracking_id == vtec_code.event_tracking_id))):
             return True
         else:
             return False
 
-    def append(self, bulletin):
+    def append(self, bulletin, vtec_code=None, transition=True):
+        """
+        Add a bulletin to the sequence of events.
+
+        Parameters
+        ----------
+        bulletin : Segment
+            The new bulletin.
+        vtec_code : VtecCode
+            The code within the bulletin that belongs to this event.  If not
+            provided, the first one that the event contains is used.
+        transition : bool
+            If True, move the lifecycle state along according to the action
+            code.  Pass False when the caller will make the transition for
+            all of the segments of a product at once.
+        """
+        if vtec_code is None:
+            for code in bulletin.vtec:
+                if self.contains(code):
+                    vtec_code = code
+                    break
         self._items.append(bulletin)
+        if vtec_code is not None:
+            self._update_history(vtec_code, bulletin)
+            if transition:
+                self.transition([vtec_code.action])
+
+    def transition(self, actions):
+        """
+        Move the lifecycle state along according to action codes.
+
+        Parameters
+        ----------
+        actions : list of str
+            Action codes that a single product issued for this event.  A
+            segmented product may cancel the event for some areas while
+            continuing it for others, in which case the event stays open.
+        """
+        states = [_VTEC_ACTION_STATE.get(action) for action in actions]
+        states = [state for state in states if state is not None]
+        if len(states) == 0:
+            return
+
+        open_states = [state for state in states
+                       if state not in _CLOSED_STATES]
+        if len(open_states) > 0:
+            self.state = open_states[-1]
+        else:
+            self.state = states[-1]
+
+    def _update_history(self, vtec_code, bulletin):
+        """
+        Record the bulletin in the compact history.
+        """
+        # Prefer the VTEC event ending time.  The segment expiration date
+        # only says when the product itself expires.
+        expiration_date = vtec_code.event_ending_time
+        if expiration_date is None:
+            expiration_date = bulletin.expiration_date
+
+        issuance_time = getattr(bulletin, 'mnd_issuance_time', None)
+        self.history.append(EventHistory(action=vtec_code.action,
+                                         issuance_time=issuance_time,
+                                         expiration_date=expiration_date))
+
+    @property
+    def closed(self):
+        """
+        Has the event been cancelled, upgraded, or expired?
+        """
+        return self.state in _CLOSED_STATES
+
+    @property
+    def expiration_date(self):
+        """
+        When the event is expected to end according to its latest bulletin.
+        """
+        return self.history[-1].expiration_date
+
+    def expire(self, now=None):
+        """
+        Close the event if it has run past its expiration date.
+
+        Parameters
+        ----------
+        now : datetime.datetime
+            Current time in UTC, defaults to the system clock.
+
+        Returns
+        -------
+        bool
+            True if the event is closed.
+        """
+        if now is None:
+            now = dt.datetime.utcnow()
+        if (((not self.closed) and
+             (self.expiration_date is not None) and
+             (now >= self.expiration_date))):
+            self.state = 'expired'
+        return self.closed
+
+    @property
+    def bbox(self):
+        """
+        Bounding box over the polygons of all bulletins, or None if no
+        bulletin has a polygon.
+        """
+        from .geometry import union_bbox
+        return union_bbox([bulletin.bbox for bulletin in self._items])
+
+    def area_changes(self):
+        """
+        Change in polygon area between consecutive bulletins.
+
+        Bulletins without a polygon are skipped.
+
+        Returns
+        -------
+        ndarray
+            Differences of the unsigned polygon areas in square degrees,
+            one fewer than the number of bulletins with polygons.
+        """
+        areas = [abs(bulletin.area) for bulletin in self._items
+                 if bulletin.area is not None]
+        import numpy as np
+        return np.diff(np.array(areas, dtype=np.float64))
+
+    def ugc_changes(self):
+        """
+        Change in counties or zones between consecutive bulletins.
+
+        Returns
+        -------
+        list
+            (added, removed) pairs of UgcSet, one fewer than the number of
+            bulletins.
+        """
+        from .ugc import UgcSet
+        sets = [UgcSet.from_segment(bulletin) for bulletin in self._items]
+        return [(after - before, before - after)
+                for before, after in zip(sets[:-1], sets[1:])]
 
     def not_expired(self):
         """
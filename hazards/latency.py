@@ -0,0 +1,213 @@
+"""
+Latency of products from issuance to each stage of ingest.
+
+Each parsed product carries the times at which it went through the ingest
+stages, see Product.ingest_times.  The recorder compares them with the
+issuance time of the product in its WMO heading, and with the issuance time
+in the mass news disseminator (MND) header of each segment, and keeps
+histograms by AWIPS product category and VTEC phenomena.  The histograms are
+exported in the Prometheus text format for scraping.
+
+Both issuance times only have a resolution of a minute, so latencies of
+less than a minute are noise.
+"""
+
+import collections
+import threading
+
+from .hazards import INGEST_STAGES
+
+# Upper bounds of the histogram buckets, in seconds.
+DEFAULT_BUCKETS = (30, 60, 90, 120, 180, 300, 600, 900, 1800, 3600)
+
+# The histograms are labelled by the issuance time that they are measured
+# from, the ingest stage, the AWIPS product category, e.g. "TOR", and the
+# phenomena and significance of the VTEC codes, e.g. "TO.W", or "" for a
+# product without any.
+LatencyLabels = collections.namedtuple('LatencyLabels',
+                                       ['since', 'stage', 'product',
+                                        'phenomena'])
+
+METRIC_NAME = 'hazards_ingest_latency_seconds'
+
+
+class LatencyHistogram(object):
+    """
+    Cumulative histogram of latencies.
+
+    Attributes
+    ----------
+    buckets : tuple
+        Upper bounds of the buckets in seconds, in increasing order.
+    counts : list
+        Number of observations in each bucket, not cumulative.  The last
+        one is for those above the largest bound.
+    sum : float
+        Total of the observations in seconds.
+    count : int
+        Number of observations.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        """
+        Add one latency.
+        """
+        j = 0
+        while j < len(self.buckets) and seconds > self.buckets[j]:
+            j += 1
+        self.counts[j] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Number of observations at or below each bound, then the total.
+
+        Returns
+        -------
+        list
+        """
+        lst = []
+        total = 0
+        for count in self.counts:
+            total += count
+            lst.append(total)
+        return lst
+
+
+def _phenomena(vtec_codes):
+    """
+    Sorted distinct "pp.s" labels of VTEC codes, or [""] if there are none.
+    """
+    labels = sorted(set('{}.{}'.format(vtec_code.phenomena,
+                                       vtec_code.significance)
+                        for vtec_code in vtec_codes))
+    return labels if len(labels) > 0 else ['']
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _number(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class LatencyRecorder(object):
+    """
+    Latency histograms of the products that went through ingest.  Safe to
+    use from several threads.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Parameters
+        ----------
+        buckets : sequence of float
+            Upper bounds of the histogram buckets in seconds.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, labels, seconds):
+        histogram = self._histograms.get(labels)
+        if histogram is None:
+            histogram = LatencyHistogram(self.buckets)
+            self._histograms[labels] = histogram
+        histogram.observe(seconds)
+
+    def observe(self, product):
+        """
+        Record the latencies of a product at each ingest stage that it has
+        reached.  A product with several phenomena counts towards each.
+
+        Parameters
+        ----------
+        product : Product
+        """
+        vtec_codes = []
+        segment_times = []
+        for segment in product.segments:
+            vtec_codes.extend(segment.vtec)
+            issuance_time = getattr(segment, 'mnd_issuance_time', None)
+            if issuance_time is not None:
+                segment_times.append((issuance_time,
+                                      _phenomena(segment.vtec)))
+        product_phenomena = _phenomena(vtec_codes)
+
+        awips_product = product.awips_product
+        with self._lock:
+            for stage in INGEST_STAGES:
+                when = product.ingest_times.get(stage)
+                if when is None:
+                    continue
+                if product.wmo_issuance_time is not None:
+                    seconds = (when - product.wmo_issuance_time)
+                    seconds = seconds.total_seconds()
+                    for phenomena in product_phenomena:
+                        labels = LatencyLabels('wmo', stage, awips_product,
+                                               phenomena)
+                        self._observe(labels, seconds)
+                for issuance_time, lst in segment_times:
+                    seconds = (when - issuance_time).total_seconds()
+                    for phenomena in lst:
+                        labels = LatencyLabels('mnd', stage, awips_product,
+                                               phenomena)
+                        self._observe(labels, seconds)
+
+    def histograms(self):
+        """
+        Copy of the histograms.
+
+        Returns
+        -------
+        dict
+            LatencyHistogram by LatencyLabels
+        """
+        with self._lock:
+            histograms = {}
+            for labels, histogram in self._histograms.items():
+                copy = LatencyHistogram(histogram.buckets)
+                copy.counts = list(histogram.counts)
+                copy.sum = histogram.sum
+                copy.count = histogram.count
+                histograms[labels] = copy
+            return histograms
+
+    def exposition(self):
+        """
+        The histograms in the Prometheus text exposition format.
+
+        Returns
+        -------
+        str
+        """
+        lines = [
+            '# HELP {} Seconds from issuance to each ingest stage.'.format(
+                METRIC_NAME),
+            '# TYPE {} histogram'.format(METRIC_NAME),
+        ]
+        histograms = self.histograms()
+        for labels in sorted(histograms, key=lambda x: tuple(map(str, x))):
+            histogram = histograms[labels]
+            text = ','.join('{}="{}"'.format(name, _escape(str(value)))
+                            for name, value in zip(labels._fields, labels)
+                            if value is not None)
+            bounds = [_number(bound) for bound in histogram.buckets]
+            for bound, total in zip(bounds + ['+Inf'],
+                                    histogram.cumulative()):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    METRIC_NAME, text, bound, total))
+            lines.append('{}_sum{{{}}} {}'.format(METRIC_NAME, text,
+                                                  _number(histogram.sum)))
+            lines.append('{}_count{{{}}} {}'.format(METRIC_NAME, text,
+                                                    histogram.count))
+        return '\n'.join(lines) + '\n'
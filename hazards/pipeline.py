@@ -0,0 +1,482 @@
+"""
+Staged ingest pipeline connected by bounded queues.
+
+Bulletins go through four stages:
+
+    read       read and decompress each bulletin file
+    split      split the contents into products at the \\x03\\x01 boundaries
+    parse      parse each product's headers and segments
+    aggregate  hand the products to a sink, e.g. EventTracker.add_product
+
+Each stage but the last has its own pool of worker threads, or processes
+for the split and parse stages, and the queues between the stages are
+bounded so that a fast stage blocks rather than running away from a slow
+one.  The products reach the sink in the same order as a sequential ingest,
+whatever the number of workers, since event aggregation depends on the
+order of the bulletins.
+
+The metrics tell how busy each stage is and how deep its queue is, so that
+the bottleneck stage can be given more workers on its own.
+
+Given a priority table, the parse stage takes the products most urgent
+first, e.g. tornado warnings ahead of zone forecasts, and each priority
+class reaches the sink as soon as it is parsed.  The products stay in file
+order within each class, and across classes among the products of any one
+event, so that the bulletins of an event are applied in sequence.
+
+The reordering only reaches as far as the parse inbox.  The split stage
+puts the urgent products of each file ahead of the others, and they do not
+wait for room in the inbox, so a warning is never stuck behind a full queue
+of routine products.  It still waits behind the files ahead of it in the
+read and split stages, and behind any earlier product of the same event.
+"""
+
+import collections
+import datetime as dt
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+
+from . import corpus
+from .hazards import (ROUTINE_PRIORITY, Quarantine, _check_fields,
+                      _check_priorities, _decode, parse_product,
+                      product_priority, split_products, vtec_regex)
+
+STAGES = ('read', 'split', 'parse', 'aggregate')
+
+# Only these stages work on picklable items and can run in processes.
+_PROCESS_STAGES = frozenset(['split', 'parse'])
+
+# Activity of one stage.  The busy time is summed over the workers and
+# excludes waiting on the queues, so items / busy_seconds is the rate of a
+# single worker.  The queue depth is that of the stage's inbox, or None if
+# the platform cannot tell.
+StageMetrics = collections.namedtuple('StageMetrics',
+                                      ['stage', 'workers', 'processes',
+                                       'items', 'busy_seconds', 'throughput',
+                                       'queue_depth'])
+
+
+def _read(item, fields, priorities):
+    """
+    Read and decompress a bulletin file.  A file that cannot be read is
+    quarantined and passed on without contents.
+    """
+    index, entry = item
+    out = []
+    seen = dt.datetime.utcnow()
+    try:
+        raw = corpus.read_bulletin(entry)
+    except Exception as e:
+        quarantine = Quarantine()
+        quarantine.add(entry.name, None, e)
+        out.append(('quarantine', quarantine))
+        raw = None
+    out.append(('file', index, entry.name, raw, seen))
+    return out
+
+
+def _event_keys(raw_item):
+    """
+    Events that a product refers to, by the same identity as
+    tracker.event_key, without parsing it.
+    """
+    return frozenset((_decode(m.group('product_class')),
+                      _decode(m.group('office_id')),
+                      _decode(m.group('phenomena')),
+                      _decode(m.group('significance')),
+                      int(m.group('event_tracking_id')))
+                     for m in vtec_regex.finditer(raw_item))
+
+
+def _split(item, fields, priorities):
+    """
+    Split a file into products.  The products are preceded by the priority
+    and the events of each one, which also says how many there are.  Given
+    priorities, the most urgent products of the file come out first.
+    """
+    if item[0] != 'file':
+        return [item]
+    _, index, name, raw, seen = item
+    out = []
+    events = []
+    if raw is not None:
+        base_date = corpus.file_date(name)
+        for j, (offset, raw_item) in enumerate(split_products(raw)):
+            if priorities is None:
+                priority = 0
+                events.append(frozenset())
+            else:
+                priority = product_priority(raw_item, priorities)
+                events.append(_event_keys(raw_item))
+            ingest_times = {'seen': seen, 'framed': dt.datetime.utcnow()}
+            out.append(('raw', index, j, priority, name, offset, base_date,
+                        raw_item, ingest_times))
+    count = ('count', index, tuple(zip((item[3] for item in out), events)))
+    # The sort is stable, so file order holds among equals.
+    out.sort(key=lambda item: item[3])
+    return [count] + out
+
+
+def _parse(item, fields, priorities):
+    """
+    Parse a product, everything else passes through.
+    """
+    if item[0] != 'raw':
+        return [item]
+    _, index, j, _, name, offset, base_date, raw_item, ingest_times = item
+    quarantine = Quarantine()
+    product = parse_product(raw_item, base_date, fields=fields,
+                            quarantine=quarantine, filename=name,
+                            offset=offset, ingest_times=ingest_times)
+    out = []
+    if len(quarantine) > 0:
+        out.append(('quarantine', quarantine))
+    out.append(('product', index, j, product))
+    return out
+
+
+_FUNCTIONS = {
+    'read': _read,
+    'split': _split,
+    'parse': _parse,
+}
+
+
+def _work(function, fields, priorities, inbox, outbox, nworkers, nprevious,
+          stops, items, busy):
+    """
+    Worker loop shared by the threads and processes of a stage.
+
+    Each worker of the previous stage puts None on the inbox when it stops,
+    after everything else that it put there, since a process hands its
+    items over to a queue in order but not in step with the other
+    processes.  Whichever worker takes the last of those Nones knows that
+    nothing more is coming, and passes on a None to each of the others.
+    """
+    while True:
+        item = inbox.get()
+        if item is None:
+            with stops.get_lock():
+                stops.value += 1
+                nstops = stops.value
+            if nstops < nprevious:
+                continue
+            if nstops == nprevious:
+                for _ in range(nworkers - 1):
+                    inbox.put(None)
+            break
+        start = time.time()
+        results = function(item, fields, priorities)
+        elapsed = time.time() - start
+        with items.get_lock():
+            items.value += 1
+        with busy.get_lock():
+            busy.value += elapsed
+        # Blocks when the next stage falls behind.
+        for result in results:
+            outbox.put(result)
+
+    outbox.put(None)
+
+
+class _PriorityInbox(queue.PriorityQueue):
+    """
+    Inbox of the parse stage that hands out the most urgent products first,
+    in file order among equals.  Everything else goes to the front, except
+    for the stop signal, which goes to the back.
+
+    Products more urgent than ROUTINE_PRIORITY are let in even when the
+    inbox is full, so that they do not queue up behind routine products.
+    """
+    def put(self, item, block=True, timeout=None):
+        if (item is not None and item[0] == 'raw' and
+                item[3] < ROUTINE_PRIORITY):
+            with self.not_full:
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+            return
+        queue.PriorityQueue.put(self, item, block=block, timeout=timeout)
+
+    def _init(self, maxsize):
+        queue.PriorityQueue._init(self, maxsize)
+        self._tiebreak = itertools.count()
+
+    def _put(self, item):
+        if item is None:
+            key = (float('inf'), 0, 0)
+        elif item[0] == 'raw':
+            key = (item[3], item[1], item[2])
+        else:
+            key = (-1, 0, 0)
+        queue.PriorityQueue._put(self, key + (next(self._tiebreak), item))
+
+    def _get(self):
+        return queue.PriorityQueue._get(self)[-1]
+
+
+def _depth(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+
+class Pipeline(object):
+    """
+    Ingest bulletin files through bounded queues and per-stage workers.
+
+    Attributes
+    ----------
+    sink : callable
+        Invoked with each Product, in file order, from the thread that
+        calls run().
+    workers : dict
+        Number of workers of the read, split, and parse stages.
+    processes : frozenset
+        Stages whose workers are processes rather than threads.
+    priorities : dict or None
+        Priority table of the parse stage, see hazards.PRIORITIES.
+    latency : LatencyRecorder or None
+        Latencies of the products handed to the sink.
+    quarantine : Quarantine
+        Files and products that failed to read or parse.
+    """
+    def __init__(self, sink, workers=None, processes=(), maxsize=64,
+                 fields=None, priorities=None, latency=None, quarantine=None):
+        """
+        Parameters
+        ----------
+        sink : callable
+            Invoked with each Product, e.g. EventTracker.add_product.
+        workers : dict
+            Number of workers by stage name, one for any stage not given.
+            The aggregate stage always runs in the calling thread.
+        processes : iterable of str
+            Run the workers of these stages, either 'split' or 'parse', in
+            processes instead of threads.
+        maxsize : int
+            Capacity of each queue between the stages.
+        fields : iterable of str
+            If provided, only parse these segment attributes.
+        priorities : dict
+            If provided, parse the products in the order of priority given
+            by this table, e.g. hazards.PRIORITIES, instead of file order.
+            The products of any one event still reach the sink in file
+            order.  The parse stage then has to run in threads.
+        latency : LatencyRecorder
+            If provided, record the latency of each product.
+        quarantine : Quarantine
+            Where to record the failures, a new one by default.
+        """
+        self.sink = sink
+        self.workers = dict((stage, 1) for stage in STAGES[:-1])
+        if workers is not None:
+            unknown = set(workers) - set(self.workers)
+            if len(unknown) > 0:
+                msg = 'Unknown or fixed stage(s):  {}'
+                raise ValueError(msg.format(', '.join(sorted(unknown))))
+            self.workers.update(workers)
+        self.processes = frozenset(processes)
+        if not self.processes <= _PROCESS_STAGES:
+            msg = 'Only the split and parse stages can run in processes.'
+            raise ValueError(msg)
+        self.priorities = _check_priorities(priorities)
+        if self.priorities is not None and 'parse' in self.processes:
+            msg = 'Priority scheduling needs the parse stage in threads.'
+            raise ValueError(msg)
+        self.maxsize = maxsize
+        self.latency = latency
+        self.fields = _check_fields(fields)
+        if quarantine is None:
+            quarantine = Quarantine()
+        self.quarantine = quarantine
+
+        self._items = dict((stage, multiprocessing.Value('l', 0))
+                           for stage in STAGES)
+        self._busy = dict((stage, multiprocessing.Value('d', 0.0))
+                          for stage in STAGES)
+        self._queues = {}
+
+    def metrics(self):
+        """
+        Current activity of each stage.  May be called from any thread while
+        run() is in progress.
+
+        Returns
+        -------
+        list
+            StageMetrics for each stage, in pipeline order.
+        """
+        lst = []
+        for stage in STAGES:
+            items = self._items[stage].value
+            busy = self._busy[stage].value
+            throughput = items / busy if busy > 0 else None
+            inbox = self._queues.get(stage)
+            lst.append(StageMetrics(stage=stage,
+                                    workers=self.workers.get(stage, 1),
+                                    processes=stage in self.processes,
+                                    items=items, busy_seconds=busy,
+                                    throughput=throughput,
+                                    queue_depth=(None if inbox is None
+                                                 else _depth(inbox))))
+        return lst
+
+    def _make_queue(self, stage):
+        """
+        Inbox of a stage.  It has to cross processes if either the stage
+        or the one feeding it runs in processes.
+        """
+        j = STAGES.index(stage)
+        if stage in self.processes or (j > 0 and
+                                       STAGES[j - 1] in self.processes):
+            return multiprocessing.Queue(self.maxsize)
+        if stage == 'parse' and self.priorities is not None:
+            return _PriorityInbox(self.maxsize)
+        return queue.Queue(self.maxsize)
+
+    def run(self, source, recursive=False):
+        """
+        Push bulletin files through the pipeline.
+
+        Parameters
+        ----------
+        source : str or iterable of CorpusEntry
+            A directory, archive, or file, or entries from
+            corpus.iter_entries.  A path is read in the order of the dates
+            in the file names.
+        recursive : bool
+            If source is a directory, also read its subdirectories.
+
+        Returns
+        -------
+        int
+            Number of products handed to the sink.
+        """
+        if isinstance(source, str):
+            source = corpus.select_entries(
+                corpus.iter_entries(source, recursive=recursive))
+
+        self._queues = dict((stage, self._make_queue(stage))
+                            for stage in STAGES)
+
+        workers = []
+        for j, stage in enumerate(STAGES[:-1]):
+            nworkers = self.workers[stage]
+            nprevious = self.workers[STAGES[j - 1]] if j > 0 else 1
+            args = (_FUNCTIONS[stage], self.fields, self.priorities,
+                    self._queues[stage], self._queues[STAGES[j + 1]],
+                    nworkers, nprevious, multiprocessing.Value('l', 0),
+                    self._items[stage],
+                    self._busy[stage])
+            for _ in range(nworkers):
+                if stage in self.processes:
+                    worker = multiprocessing.Process(target=_work, args=args)
+                else:
+                    worker = threading.Thread(target=_work, args=args)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+        # Feed from a separate thread, since the queues are bounded and
+        # this thread has to keep draining the far end.
+        def feed():
+            inbox = self._queues['read']
+            for index, entry in enumerate(source):
+                inbox.put((index, entry))
+            inbox.put(None)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        count = self._aggregate(self._queues['aggregate'],
+                                self.workers['parse'])
+
+        feeder.join()
+        for worker in workers:
+            worker.join()
+        return count
+
+    def _aggregate(self, inbox, nprevious):
+        """
+        Hand the products to the sink in file order within each priority
+        class.  Products that arrive early wait in a reorder buffer.
+
+        A product also waits for the earlier products of its events, of
+        whatever class.  The earliest product still to go never waits on
+        another, so everything gets through.
+        """
+        items = self._items['aggregate']
+        busy = self._busy['aggregate']
+
+        # Products that have been parsed, by file and position.
+        pending = {}
+        # Priorities of the products in the files still to be lined up.
+        counts = {}
+        # Products of each priority class in the order they are due.
+        due = collections.defaultdict(collections.deque)
+        # Events of the products still to go, and the products of each
+        # event in the order they are due.
+        events = {}
+        owners = collections.defaultdict(collections.deque)
+        index = 0
+        count = 0
+        nstops = 0
+        while nstops < nprevious:
+            item = inbox.get()
+            if item is None:
+                nstops += 1
+                continue
+            kind = item[0]
+            if kind == 'quarantine':
+                self.quarantine.merge(item[1])
+                continue
+            elif kind == 'count':
+                counts[item[1]] = item[2]
+                while index in counts:
+                    for j, (priority, keys) in enumerate(counts.pop(index)):
+                        due[priority].append((index, j))
+                        events[(index, j)] = keys
+                        for key in keys:
+                            owners[key].append((index, j))
+                    index += 1
+            else:
+                pending[(item[1], item[2])] = item[3]
+
+            # Release whatever is next in order, most urgent first, until
+            # nothing more can go.
+            released = True
+            while released:
+                released = False
+                for priority in sorted(due):
+                    queued = due[priority]
+                    while len(queued) > 0 and queued[0] in pending:
+                        position = queued[0]
+                        keys = events[position]
+                        if any(owners[key][0] != position for key in keys):
+                            break
+                        queued.popleft()
+                        del events[position]
+                        for key in keys:
+                            owners[key].popleft()
+                            if len(owners[key]) == 0:
+                                del owners[key]
+                        released = True
+                        product = pending.pop(position)
+                        if product is None:
+                            continue
+                        start = time.time()
+                        now = dt.datetime.utcnow()
+                        product.ingest_times['aggregated'] = now
+                        self.sink(product)
+                        if self.latency is not None:
+                            self.latency.observe(product)
+                        busy.value += time.time() - start
+                        items.value += 1
+                        count += 1
+        return count
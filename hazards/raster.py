@@ -0,0 +1,360 @@
+"""
+Warning polygons rasterized onto a regular longitude/latitude grid.
+
+Each cell of the grid holds a bitset of the events whose latest polygon
+covers the center of the cell, so that looking up the warnings at a point
+is a matter of indexing rather than testing every polygon, and coverage
+statistics over gridded data are sums over the cells of each mask.
+
+Only the cells within the bounding box of a polygon are tested when it is
+rasterized, and an event is only rasterized again when a new bulletin
+changes its polygon.
+"""
+
+import math
+
+import numpy as np
+
+from .geometry import frozen_polygon, points_in_polygon, polygon_metrics
+from .tracker import EventIndex
+
+# Bits in each word of the bitsets.
+_WORD_BITS = 64
+
+# Mean radius of the earth in kilometers.
+_EARTH_RADIUS = 6371.0
+
+
+class RasterGrid(object):
+    """
+    Regular longitude/latitude grid.  Row i and column j cover latitudes
+    ymin + i * resolution to ymin + (i + 1) * resolution, and likewise for
+    longitudes.
+
+    Attributes
+    ----------
+    bbox : tuple
+        (xmin, ymin, xmax, ymax) in degrees, longitude positive west.
+    resolution : float
+        Size of a cell in degrees.
+    shape : tuple
+        Number of rows and columns.
+    """
+    def __init__(self, bbox, resolution):
+        """
+        Parameters
+        ----------
+        bbox : tuple
+            (xmin, ymin, xmax, ymax) in degrees, longitude positive west.
+            The grid is extended to a whole number of cells.
+        resolution : float
+            Size of a cell in degrees, e.g. 0.01.
+        """
+        xmin, ymin, xmax, ymax = bbox
+        if resolution <= 0 or xmax <= xmin or ymax <= ymin:
+            msg = 'Invalid grid of {} degrees over {}'
+            raise ValueError(msg.format(resolution, bbox))
+        ncols = int(math.ceil((xmax - xmin) / resolution - 1e-9))
+        nrows = int(math.ceil((ymax - ymin) / resolution - 1e-9))
+        self.resolution = resolution
+        self.shape = (nrows, ncols)
+        self.bbox = (xmin, ymin, xmin + ncols * resolution,
+                     ymin + nrows * resolution)
+
+    def cells(self, x, y):
+        """
+        Cells containing points.
+
+        Parameters
+        ----------
+        x, y : array_like
+            Longitudes and latitudes of the points.
+
+        Returns
+        -------
+        rows, cols : ndarray
+            Cell indices, -1 for points outside of the grid.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        cols = np.floor((x - self.bbox[0]) / self.resolution).astype(np.intp)
+        rows = np.floor((y - self.bbox[1]) / self.resolution).astype(np.intp)
+        outside = ((rows < 0) | (rows >= self.shape[0]) |
+                   (cols < 0) | (cols >= self.shape[1]))
+        return np.where(outside, -1, rows), np.where(outside, -1, cols)
+
+    def window(self, bbox):
+        """
+        Range of cells whose centers may fall within a bounding box.
+
+        Returns
+        -------
+        tuple
+            Slices of the rows and columns, possibly empty.
+        """
+        xmin, ymin, xmax, ymax = bbox
+        res = self.resolution
+        col0 = max(int(math.floor((xmin - self.bbox[0]) / res - 0.5)), 0)
+        col1 = min(int(math.ceil((xmax - self.bbox[0]) / res + 0.5)),
+                   self.shape[1])
+        row0 = max(int(math.floor((ymin - self.bbox[1]) / res - 0.5)), 0)
+        row1 = min(int(math.ceil((ymax - self.bbox[1]) / res + 0.5)),
+                   self.shape[0])
+        return slice(row0, max(row0, row1)), slice(col0, max(col0, col1))
+
+    def centers(self, rows=slice(None), cols=slice(None)):
+        """
+        Coordinates of the cell centers.
+
+        Returns
+        -------
+        x, y : ndarray
+            Longitudes and latitudes, broadcastable to the shape of the
+            selected cells.
+        """
+        res = self.resolution
+        j = np.arange(self.shape[1])[cols]
+        i = np.arange(self.shape[0])[rows]
+        x = self.bbox[0] + (j + 0.5) * res
+        y = self.bbox[1] + (i + 0.5) * res
+        return x[np.newaxis, :], y[:, np.newaxis]
+
+    def cell_areas(self):
+        """
+        Approximate area of the cells of each row in square kilometers, on a
+        spherical earth.
+
+        Returns
+        -------
+        ndarray
+            Shape (nrows, 1), broadcastable to the grid.
+        """
+        _, y = self.centers()
+        res = math.radians(self.resolution)
+        return (_EARTH_RADIUS ** 2 * res * res) * np.cos(np.radians(y))
+
+
+def rasterize(polygon, grid):
+    """
+    Cells of a grid whose centers lie within a polygon.
+
+    Parameters
+    ----------
+    polygon : list of tuples
+        (longitude, latitude) pairs as found in Segment.polygon
+    grid : RasterGrid
+
+    Returns
+    -------
+    window : tuple
+        Slices of the rows and columns around the polygon.
+    mask : ndarray
+        Boolean mask of the cells within the window.
+    """
+    bbox, _, _ = polygon_metrics(polygon)
+    window = grid.window(bbox)
+    x, y = grid.centers(*window)
+    return window, points_in_polygon(polygon, x, y)
+
+
+class WarningRaster(EventIndex):
+    """
+    Bitsets of the events covering each cell of a grid, see EventIndex for
+    keeping them up to date.
+
+    Attributes
+    ----------
+    grid : RasterGrid
+    bits : ndarray
+        Array of uint64 of shape (nwords, nrows, ncols).  Bit b of word w
+        of a cell is set if the event in slot 64 * w + b covers the cell.
+
+    Each word holds 64 events and takes 8 bytes per cell, e.g. about 120 MB
+    over the contiguous United States at 0.01 degrees.  Words are added one
+    at a time as more events are live at once, and adding one briefly takes
+    the memory of both the old and the new array, so give the capacity up
+    front if the number of events is known.
+    """
+    def __init__(self, grid, capacity=_WORD_BITS):
+        """
+        Parameters
+        ----------
+        grid : RasterGrid
+        capacity : int
+            Number of events to make room for up front.
+        """
+        super(WarningRaster, self).__init__()
+        self.grid = grid
+        nwords = max(1, -(-capacity // _WORD_BITS))
+        self.bits = np.zeros((nwords,) + grid.shape, dtype=np.uint64)
+
+        # Slot of each key, the key in each slot, and the free slots.
+        self._slots = {}
+        self._keys = []
+        self._free = []
+        # The rasterized window of each key.
+        self._masks = {}
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            return slot
+        if len(self._free) > 0:
+            slot = self._free.pop()
+            self._keys[slot] = key
+        else:
+            slot = len(self._keys)
+            self._keys.append(key)
+            if slot >= self.bits.shape[0] * _WORD_BITS:
+                nwords = self.bits.shape[0]
+                bits = np.empty((nwords + 1,) + self.grid.shape,
+                                dtype=np.uint64)
+                bits[:nwords] = self.bits
+                bits[nwords] = 0
+                self.bits = bits
+        self._slots[key] = slot
+        return slot
+
+    def _paint(self, key, on):
+        slot = self._slots[key]
+        word, bit = divmod(slot, _WORD_BITS)
+        bit = np.uint64(1) << np.uint64(bit)
+        (rows, cols), mask = self._masks[key]
+        view = self.bits[word, rows, cols]
+        if on:
+            view[mask] |= bit
+        else:
+            view[mask] &= ~bit
+
+    def _value(self, bulletin):
+        return getattr(bulletin, 'polygon', None)
+
+    def _normalize(self, polygon):
+        return frozen_polygon(polygon)
+
+    def _set(self, key, polygon):
+        if key in self._masks:
+            self._paint(key, False)
+        self._slot(key)
+        self._masks[key] = rasterize(polygon, self.grid)
+        self._paint(key, True)
+
+    def _clear(self, key):
+        self._paint(key, False)
+        slot = self._slots.pop(key)
+        self._keys[slot] = None
+        self._free.append(slot)
+        del self._masks[key]
+
+    def _keys_of(self, words):
+        keys = []
+        for w, word in enumerate(words):
+            word = int(word)
+            while word:
+                low = word & -word
+                keys.append(self._keys[w * _WORD_BITS + low.bit_length() - 1])
+                word ^= low
+        return keys
+
+    def lookup(self, x, y):
+        """
+        Events covering a point.
+
+        Parameters
+        ----------
+        x, y : float
+            Longitude and latitude of the point.
+
+        Returns
+        -------
+        list
+            Event keys.
+        """
+        rows, cols = self.grid.cells(x, y)
+        if rows < 0:
+            return []
+        return self._keys_of(self.bits[:, rows, cols])
+
+    def lookup_bits(self, x, y):
+        """
+        Bitsets of the cells containing many points at once.
+
+        Parameters
+        ----------
+        x, y : array_like
+            Longitudes and latitudes of the points.
+
+        Returns
+        -------
+        ndarray
+            Array of uint64 of shape (npoints, nwords), zero for points
+            outside of the grid.  See keys to decode a row.
+        """
+        rows, cols = self.grid.cells(np.ravel(x), np.ravel(y))
+        bits = self.bits[:, rows, cols].T.copy()
+        bits[rows < 0] = 0
+        return bits
+
+    def keys(self, words):
+        """
+        Event keys of a bitset, e.g. a row of lookup_bits.
+        """
+        return self._keys_of(words)
+
+    def mask(self, key):
+        """
+        Boolean mask over the whole grid of the cells an event covers.
+        """
+        mask = np.zeros(self.grid.shape, dtype=bool)
+        if key in self._masks:
+            window, window_mask = self._masks[key]
+            mask[window] = window_mask
+        return mask
+
+    def coverage(self, weights=None):
+        """
+        How much of the grid each event covers.  Only the windows of the
+        events are summed over.
+
+        Parameters
+        ----------
+        weights : ndarray
+            Value of each cell, e.g. population, of the shape of the grid.
+            By default, each cell counts as one.  Use RasterGrid.cell_areas
+            for the area.
+
+        Returns
+        -------
+        dict
+            Covered total by event key.
+        """
+        if weights is not None:
+            weights = np.broadcast_to(weights, self.grid.shape)
+        totals = {}
+        for key, (window, mask) in self._masks.items():
+            if weights is None:
+                totals[key] = int(np.count_nonzero(mask))
+            else:
+                totals[key] = float(weights[window][mask].sum())
+        return totals
+
+    def covered(self, weights=None):
+        """
+        How much of the grid is covered by any event.
+
+        Parameters
+        ----------
+        weights : ndarray
+            See coverage.
+
+        Returns
+        -------
+        float or int
+        """
+        any_event = np.zeros(self.grid.shape, dtype=bool)
+        for word in self.bits:
+            any_event |= word != 0
+        if weights is None:
+            return int(np.count_nonzero(any_event))
+        weights = np.broadcast_to(weights, self.grid.shape)
+        return float(weights[any_event].sum())
@@ -0,0 +1,289 @@
+"""
+Replay an archive of bulletins in the order they were issued.
+
+The products of an archive are fed to an event aggregator in the order of
+their WMO issuance times, either as fast as possible or paced against the
+wall clock at some multiple of real time.  Each product is only parsed when
+its turn comes, so the time spent parsing counts against the ingest just as
+it would live.  The statistics then tell how far the ingest fell behind the
+schedule and how many products per second it sustained, e.g. when replaying
+a big outbreak at ten times real time to plan the capacity of the ingest
+tier.
+
+Only the WMO heading at the top of each product is read while ordering, and
+products are only held back until the files are far enough along that no
+earlier product can still turn up.
+"""
+
+import datetime as dt
+import heapq
+import time
+
+from . import corpus
+from .hazards import (WMO_AWIPS_regex, Quarantine, _check_fields, _PEEK_BYTES,
+                      _universal_newlines, adjust_to_base_date,
+                      parse_product, split_products)
+from .tracker import EventTracker
+
+# How much earlier than the date of its file a product can be issued.
+DEFAULT_WINDOW = dt.timedelta(hours=1)
+
+
+def _issuance_time(raw_item, base_date):
+    """
+    WMO issuance time of a raw product without parsing it, or the date of
+    the file if there is no WMO heading.
+    """
+    if base_date is None:
+        return None
+    m = WMO_AWIPS_regex.search(_universal_newlines(raw_item[:_PEEK_BYTES]))
+    if m is None:
+        return base_date
+    try:
+        return adjust_to_base_date(base_date, int(m.group('dd')),
+                                   int(m.group('hh')), int(m.group('mm')))
+    except ValueError:
+        return base_date
+
+
+def _percentile(values, q):
+    """
+    Nearest rank percentile of sorted values, or None if there are none.
+    """
+    if len(values) == 0:
+        return None
+    k = int(round(q / 100.0 * (len(values) - 1)))
+    return values[k]
+
+
+class ReplayStats(object):
+    """
+    Throughput and latency of a replay.
+
+    The latency of a product runs from when it was due according to the
+    replay schedule until it was aggregated.  It includes both the time
+    waiting behind earlier products and the service time of parsing and
+    aggregating the product itself.  When replaying as fast as possible,
+    every product is due at the start.
+
+    Attributes
+    ----------
+    products : int
+        Number of products aggregated.
+    segments : int
+        Number of segments in those products.
+    wall_seconds : float
+        Elapsed time of the replay.
+    replayed : datetime.timedelta
+        Span of the issuance times that were replayed.
+    latencies, service_times : list
+        Seconds for each product.
+    """
+    def __init__(self):
+        self.products = 0
+        self.segments = 0
+        self.wall_seconds = 0.0
+        self.replayed = dt.timedelta(0)
+        self.latencies = []
+        self.service_times = []
+
+    @property
+    def throughput(self):
+        """
+        Products per second of wall time, or None if no time has passed.
+        """
+        if self.wall_seconds <= 0:
+            return None
+        return self.products / self.wall_seconds
+
+    def percentiles(self, values, qs=(50, 95, 99, 100)):
+        """
+        Percentiles of some of the statistics.
+
+        Parameters
+        ----------
+        values : str
+            Either "latencies" or "service_times".
+        qs : sequence of float
+            Percentiles to compute.
+
+        Returns
+        -------
+        list
+            Seconds for each percentile, None if there were no products.
+        """
+        values = sorted(getattr(self, values))
+        return [_percentile(values, q) for q in qs]
+
+    def report(self):
+        """
+        Summary of the replay.
+
+        Returns
+        -------
+        str
+        """
+        throughput = self.throughput
+        lines = [
+            '{} products, {} segments'.format(self.products, self.segments),
+            '{:.1f} s wall time for {} of bulletins'.format(
+                self.wall_seconds, self.replayed),
+            'throughput {} products/s'.format(
+                'n/a' if throughput is None else '{:.1f}'.format(throughput)),
+        ]
+        for name in ['latencies', 'service_times']:
+            p50, p95, p99, pmax = self.percentiles(name)
+            if p50 is None:
+                continue
+            lines.append('{:<14}p50 {:.4f}  p95 {:.4f}  p99 {:.4f}  '
+                         'max {:.4f} s'.format(name.replace('_', ' '),
+                                               p50, p95, p99, pmax))
+        return '\n'.join(lines)
+
+
+class Replay(object):
+    """
+    Feed the products of an archive to an aggregator in issuance order.
+
+    Attributes
+    ----------
+    sink : callable
+        Invoked with each Product, by default EventTracker.add_product.
+    tracker : EventTracker or None
+        The default aggregator, if no sink was given.
+    speed : float or None
+        Multiple of real time, or None for as fast as possible.
+    quarantine : Quarantine
+        Files and products that failed to read or parse.
+    """
+    def __init__(self, source, sink=None, speed=None, recursive=True,
+                 fields=None, window=DEFAULT_WINDOW, quarantine=None,
+                 clock=time.time, sleep=time.sleep):
+        """
+        Parameters
+        ----------
+        source : str or iterable of CorpusEntry
+            A directory, archive, or file of bulletins, or entries from
+            corpus.iter_entries.
+        sink : callable
+            Invoked with each Product.  By default, a new EventTracker
+            aggregates them.
+        speed : float
+            Replay at this multiple of real time, e.g. 10 for an hour of
+            bulletins in six minutes.  None means as fast as possible.
+        recursive : bool
+            If source is a directory, also read its subdirectories.
+        fields : iterable of str
+            If provided, only parse these segment attributes.
+        window : datetime.timedelta
+            How much earlier than the date of its file a product can be
+            issued.  Products are held back this long to put them in order.
+        quarantine : Quarantine
+            Where to record the failures, a new one by default.
+        clock, sleep : callable
+            Wall clock in seconds and the way to wait on it.
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError('The speed must be positive.')
+        if isinstance(source, str):
+            source = corpus.iter_entries(source, recursive=recursive)
+        self.source = source
+        self.tracker = None
+        if sink is None:
+            self.tracker = EventTracker()
+            sink = self.tracker.add_product
+        self.sink = sink
+        self.speed = speed
+        self.fields = _check_fields(fields)
+        self.window = window
+        if quarantine is None:
+            quarantine = Quarantine()
+        self.quarantine = quarantine
+        self._clock = clock
+        self._sleep = sleep
+
+    def products(self):
+        """
+        Raw products in the order of their issuance times.  Products issued
+        at the same time stay in file order.
+
+        Yields
+        ------
+        tuple
+            Issuance time, file name, offset within the file, the date of
+            the file, and the raw bytes of the product.
+        """
+        heap = []
+        seq = 0
+        for entry in corpus.select_entries(self.source):
+            base_date = corpus.file_date(entry.name)
+            try:
+                raw = corpus.read_bulletin(entry)
+            except Exception as e:
+                self.quarantine.add(entry.name, None, e)
+                continue
+
+            # The files are in date order, so nothing earlier than the
+            # window before this one can still turn up.
+            if base_date is not None:
+                while len(heap) > 0 and heap[0][0] < base_date - self.window:
+                    yield heapq.heappop(heap)[2]
+
+            for offset, raw_item in split_products(raw):
+                when = _issuance_time(raw_item, base_date)
+                if when is None:
+                    # Cannot be put in order, so pass it on right away.
+                    yield (None, entry.name, offset, base_date, raw_item)
+                    continue
+                item = (when, entry.name, offset, base_date, raw_item)
+                heapq.heappush(heap, (when, seq, item))
+                seq += 1
+
+        while len(heap) > 0:
+            yield heapq.heappop(heap)[2]
+
+    def run(self):
+        """
+        Replay everything.
+
+        Returns
+        -------
+        ReplayStats
+        """
+        stats = ReplayStats()
+        start = self._clock()
+        first = None
+        last = None
+        for when, name, offset, base_date, raw_item in self.products():
+            if when is not None:
+                if first is None:
+                    first = when
+                last = when
+
+            # When this product is due on the replay schedule.
+            due = start
+            if self.speed is not None and when is not None:
+                due += (when - first).total_seconds() / self.speed
+                delay = due - self._clock()
+                if delay > 0:
+                    self._sleep(delay)
+
+            began = self._clock()
+            product = parse_product(raw_item, base_date, fields=self.fields,
+                                    quarantine=self.quarantine,
+                                    filename=name, offset=offset)
+            if product is None:
+                continue
+            product.ingest_times['aggregated'] = dt.datetime.utcnow()
+            self.sink(product)
+            done = self._clock()
+
+            stats.products += 1
+            stats.segments += len(product.segments)
+            stats.latencies.append(done - due)
+            stats.service_times.append(done - began)
+
+        stats.wall_seconds = self._clock() - start
+        if first is not None:
+            stats.replayed = last - first
+        return stats
@@ -0,0 +1,551 @@
+"""
+Serve the active events of a bulletin directory over local HTTP/JSON.
+
+A feed watches the directory and aggregates each new bulletin file into an
+EventTracker.  After each round of ingest it publishes a new immutable
+snapshot of the active events together with indexes by office, phenomena,
+UGC code, and location.  Only the events that changed are re-indexed, and
+the request handlers only ever read whichever snapshot is current, so
+queries never wait on ingest.
+
+Over HTTP, longitudes are signed, negative west, the same as GeoJSON, both
+in the lon parameter and in the polygons of the replies.  The snapshots
+themselves keep longitude positive west, as in the bulletins.
+"""
+
+import collections
+import datetime as dt
+import json
+import math
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from . import corpus
+from .geometry import bbox_intersects, point_in_polygon
+from .hazards import Quarantine, parse_product, split_products
+from .latency import LatencyRecorder
+from .tracker import EventTracker, event_key
+
+# Size in degrees of the grid cells of the location index.
+_CELL_SIZE = 1.0
+
+# Immutable summary of an active event as of its latest bulletin.  The UGC
+# codes look like "KSC075", and the polygon is a tuple of (longitude,
+# latitude) pairs, or None.
+EventRecord = collections.namedtuple('EventRecord',
+                                     ['key', 'office', 'phenomena',
+                                      'significance', 'event_tracking_id',
+                                      'state', 'issuance_time',
+                                      'expiration_date', 'ugc', 'polygon',
+                                      'bbox'])
+
+
+def event_record(event):
+    """
+    Summarize an event for a snapshot.
+
+    Parameters
+    ----------
+    event : Event
+        A live event, typically from an EventTracker.
+
+    Returns
+    -------
+    EventRecord
+    """
+    vtec_code = event.vtec_code
+    bulletin = event[-1]
+
+    polygon = None
+    bbox = None
+    if len(bulletin.__dict__.get('polygon', ())) > 0:
+        polygon = tuple((float(x), float(y)) for x, y in bulletin.polygon)
+        bbox = tuple(bulletin.bbox)
+
+    issuance_time = None
+    if len(event.history) > 0:
+        issuance_time = event.history[-1].issuance_time
+
+    return EventRecord(key=event_key(vtec_code), office=vtec_code.office,
+                       phenomena=vtec_code.phenomena,
+                       significance=vtec_code.significance,
+                       event_tracking_id=vtec_code.event_tracking_id,
+                       state=event.state, issuance_time=issuance_time,
+                       expiration_date=event.expiration_date,
+                       ugc=tuple(bulletin.ugc_codes), polygon=polygon,
+                       bbox=bbox)
+
+
+def record_json(record):
+    """
+    JSON-ready dictionary of an EventRecord.  The polygon is a list of
+    [longitude, latitude] pairs, longitude negative west.
+    """
+    def isoformat(t):
+        return None if t is None else t.isoformat()
+
+    return {
+        'product': record.key[0],
+        'office': record.office,
+        'phenomena': record.phenomena,
+        'significance': record.significance,
+        'event_tracking_id': record.event_tracking_id,
+        'state': record.state,
+        'issuance_time': isoformat(record.issuance_time),
+        'expiration_date': isoformat(record.expiration_date),
+        'ugc': list(record.ugc),
+        'polygon': None if record.polygon is None else [[-x, y] for x, y in
+                                                         record.polygon],
+    }
+
+
+def _cells(bbox):
+    """
+    Grid cells of the location index that a bounding box overlaps.
+    """
+    xmin = int(math.floor(bbox[0] / _CELL_SIZE))
+    ymin = int(math.floor(bbox[1] / _CELL_SIZE))
+    xmax = int(math.floor(bbox[2] / _CELL_SIZE))
+    ymax = int(math.floor(bbox[3] / _CELL_SIZE))
+    return [(i, j) for i in range(xmin, xmax + 1)
+            for j in range(ymin, ymax + 1)]
+
+
+def _buckets(record):
+    """
+    Index buckets of a record, as (index name, bucket) pairs.
+    """
+    buckets = [('office', record.office), ('phenomena', record.phenomena)]
+    buckets.extend(('ugc', code) for code in record.ugc)
+    if record.bbox is not None:
+        buckets.extend(('cell', cell) for cell in _cells(record.bbox))
+    return buckets
+
+
+class Snapshot(object):
+    """
+    Immutable view of the active events and their indexes.
+
+    Never modify a snapshot, derive a new one with updated().
+
+    Attributes
+    ----------
+    version : int
+        Incremented with each update.
+    updated_at : datetime.datetime
+        When the snapshot was made, in UTC.
+    records : dict
+        EventRecord by event key.
+    """
+    _INDEXES = ('office', 'phenomena', 'ugc', 'cell')
+
+    def __init__(self, records=None, indexes=None, version=0,
+                 updated_at=None):
+        self.records = records if records is not None else {}
+        if indexes is None:
+            indexes = dict((name, {}) for name in self._INDEXES)
+        self._indexes = indexes
+        self.version = version
+        self.updated_at = updated_at
+
+    def __len__(self):
+        """
+        Implements built-in len(), returns number of active events.
+        """
+        return len(self.records)
+
+    def updated(self, changed, removed, now=None):
+        """
+        Derive a new snapshot.  Only the index buckets of the changed and
+        removed events are rebuilt, the others are shared with this snapshot.
+
+        Parameters
+        ----------
+        changed : list
+            EventRecord of each event that is new or has changed.
+        removed : list
+            Keys of the events that are no longer active.
+        now : datetime.datetime
+            Time of the update, defaults to the system clock.
+
+        Returns
+        -------
+        Snapshot
+        """
+        records = dict(self.records)
+        drop = collections.defaultdict(set)
+        add = collections.defaultdict(set)
+
+        for key in removed:
+            old = records.pop(key, None)
+            if old is not None:
+                for bucket in _buckets(old):
+                    drop[bucket].add(key)
+
+        for record in changed:
+            old = records.get(record.key)
+            if old is not None:
+                for bucket in _buckets(old):
+                    drop[bucket].add(record.key)
+            records[record.key] = record
+            for bucket in _buckets(record):
+                add[bucket].add(record.key)
+
+        indexes = dict(self._indexes)
+        copied = set()
+        for name, bucket in set(drop) | set(add):
+            if name not in copied:
+                indexes[name] = dict(indexes[name])
+                copied.add(name)
+            index = indexes[name]
+            keys = set(index.get(bucket, ()))
+            keys -= drop.get((name, bucket), set())
+            keys |= add.get((name, bucket), set())
+            if len(keys) > 0:
+                index[bucket] = frozenset(keys)
+            else:
+                index.pop(bucket, None)
+
+        if now is None:
+            now = dt.datetime.utcnow()
+        return Snapshot(records, indexes, version=self.version + 1,
+                        updated_at=now)
+
+    def query(self, office=None, phenomena=None, significance=None,
+              ugc=None, point=None):
+        """
+        Active events matching all of the given criteria.
+
+        Parameters
+        ----------
+        office : str
+            4-character VTEC office ID, e.g. 'KDDC'
+        phenomena : str
+            2-character VTEC phenomena code, e.g. 'SV'
+        significance : str
+            1-character VTEC significance code, e.g. 'W'
+        ugc : str
+            UGC county or zone, e.g. 'KSC075'
+        point : tuple
+            (longitude, latitude), longitude positive west.  Only events
+            with a polygon can match.
+
+        Returns
+        -------
+        list
+            EventRecord objects, ordered by key.
+        """
+        candidates = None
+        for name, bucket in (('office', office), ('phenomena', phenomena),
+                             ('ugc', ugc)):
+            if bucket is None:
+                continue
+            keys = self._indexes[name].get(bucket, frozenset())
+            candidates = keys if candidates is None else candidates & keys
+
+        if point is not None:
+            x, y = point
+            cell = _cells((x, y, x, y))[0]
+            keys = self._indexes['cell'].get(cell, frozenset())
+            candidates = keys if candidates is None else candidates & keys
+
+        if candidates is None:
+            candidates = self.records.keys()
+
+        records = []
+        for key in candidates:
+            record = self.records[key]
+            if (significance is not None and
+                    record.significance != significance):
+                continue
+            if point is not None:
+                if not bbox_intersects(record.bbox, (x, y, x, y)):
+                    continue
+                if not point_in_polygon(record.polygon, x, y):
+                    continue
+            records.append(record)
+        return sorted(records, key=lambda record: record.key)
+
+
+def _signature(name):
+    """
+    Size and modification time of a file, or None for a member of an
+    archive.
+    """
+    try:
+        st = os.stat(name)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class DirectoryFeed(object):
+    """
+    Ingest the bulletin files of a directory as they appear and keep a
+    snapshot of the active events.
+
+    Hourly bulletin files keep growing while their hour lasts, so a file is
+    read again whenever its size or modification time changes, and only the
+    products past the ones already ingested are parsed.  A product at the
+    end of a file that is not yet terminated is held back until it is, or
+    until the file has stopped changing for a whole poll.
+
+    Attributes
+    ----------
+    snapshot : Snapshot
+        The current snapshot.  Replacing it is a single assignment, so
+        readers in other threads always see a complete one.
+    quarantine : Quarantine
+        Bulletins that failed to parse.
+    latency : LatencyRecorder
+        Latencies of the products ingested.
+    """
+    def __init__(self, dirname, recursive=False, expire=True):
+        """
+        Parameters
+        ----------
+        dirname : str
+            Directory of bulletin files.
+        recursive : bool
+            If True, also watch the subdirectories.
+        expire : bool
+            If True, retire events once they are past their expiration date
+            according to the system clock.  Turn this off to serve an
+            archived corpus.
+        """
+        self.dirname = dirname
+        self.recursive = recursive
+        self.expire = expire
+        self.quarantine = Quarantine(max_records=1000)
+        self.latency = LatencyRecorder()
+        self.snapshot = Snapshot()
+
+        self._tracker = EventTracker(changelog=True)
+        # The signature, the offset ingested up to, and whether a product
+        # was held back, of each file that was read successfully, and the
+        # signature of each file that failed to read.
+        self._files = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    def _ingest(self, entry, signature):
+        """
+        Ingest the products of a file past those already ingested.
+        """
+        _, start, _ = self._files.get(entry.name, (None, 0, False))
+        raw = corpus.read_bulletin(entry)
+        seen = dt.datetime.utcnow()
+        base_date = corpus.file_date(entry.name)
+
+        items = [(offset, raw_item) for offset, raw_item
+                 in split_products(raw)
+                 if offset >= start and len(raw_item.strip()) > 0]
+        # Everything from this offset on is left for the next poll.
+        end = start if len(items) == 0 else items[-1][0] + 1
+        held = False
+        if len(items) > 0 and not items[-1][1].rstrip().endswith(b'\x03'):
+            previous = self._files.get(entry.name)
+            if previous is None or previous[0] != signature:
+                # Probably still being written.
+                end = items.pop()[0]
+                held = True
+
+        products = []
+        for offset, raw_item in items:
+            ingest_times = {'seen': seen, 'framed': dt.datetime.utcnow()}
+            product = parse_product(raw_item, base_date,
+                                    quarantine=self.quarantine,
+                                    filename=entry.name, offset=offset,
+                                    ingest_times=ingest_times)
+            if product is not None:
+                products.append(product)
+
+        for product in products:
+            self._tracker.add_product(product)
+        aggregated = dt.datetime.utcnow()
+        for product in products:
+            product.ingest_times['aggregated'] = aggregated
+            self.latency.observe(product)
+        self._files[entry.name] = (signature, end, held)
+
+    def poll(self, now=None):
+        """
+        Ingest any new or grown bulletin files and publish a new snapshot if
+        anything changed.  Files that fail to read are quarantined and tried
+        again once they change.
+
+        Parameters
+        ----------
+        now : datetime.datetime
+            Current time in UTC, defaults to the system clock.
+
+        Returns
+        -------
+        int
+            Number of files ingested.
+        """
+        # Only one ingest at a time, the readers never take this lock.
+        with self._lock:
+            entries = []
+            for entry in corpus.iter_entries(self.dirname,
+                                             recursive=self.recursive):
+                signature = _signature(entry.name)
+                previous = self._files.get(entry.name)
+                if previous is not None:
+                    if previous[0] == signature and not previous[2]:
+                        continue
+                elif (entry.name in self._failed and
+                      self._failed[entry.name] == signature):
+                    continue
+                entries.append((entry, signature))
+            signatures = dict((entry.name, signature)
+                              for entry, signature in entries)
+            entries = corpus.select_entries(entry for entry, _ in entries)
+
+            count = 0
+            for entry in entries:
+                signature = signatures[entry.name]
+                try:
+                    self._ingest(entry, signature)
+                except Exception as e:
+                    # Try again once the file changes.
+                    self.quarantine.add(entry.name, None, e)
+                    self._failed[entry.name] = signature
+                    continue
+                self._failed.pop(entry.name, None)
+                count += 1
+
+            if self.expire:
+                self._tracker.expire(now)
+
+            changed = []
+            removed = []
+            for change in self._tracker.changes():
+                if change.kind == 'closed':
+                    removed.append(change.key)
+                else:
+                    changed.append(event_record(change.event))
+
+            if len(changed) > 0 or len(removed) > 0:
+                self.snapshot = self.snapshot.updated(changed, removed,
+                                                      now=now)
+            return count
+
+    def run(self, interval, stop):
+        """
+        Poll the directory until stopped.
+
+        Parameters
+        ----------
+        interval : float
+            Seconds between polls.
+        stop : threading.Event
+            Set this to stop.
+        """
+        while not stop.is_set():
+            self.poll()
+            stop.wait(interval)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Answer GET /events and GET /status from the current snapshot, and
+    GET /metrics with the ingest latencies for Prometheus.
+
+    GET /events takes the optional parameters office, phenomena,
+    significance, and ugc, and lat and lon together for the events whose
+    polygon contains that point.  The longitude is signed, negative west,
+    e.g. lon=-97.5, and so are the longitudes of the polygons returned.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((key, values[-1])
+                      for key, values in parse_qs(url.query).items())
+
+        # A single read of the snapshot, so the reply is consistent.
+        snapshot = self.server.feed.snapshot
+
+        if url.path == '/status':
+            body = {
+                'version': snapshot.version,
+                'updated_at': (None if snapshot.updated_at is None
+                               else snapshot.updated_at.isoformat()),
+                'events': len(snapshot),
+                'quarantined': len(self.server.feed.quarantine),
+            }
+            self._reply(200, body)
+        elif url.path == '/events':
+            point = None
+            if 'lat' in params or 'lon' in params:
+                try:
+                    lon = float(params['lon'])
+                    lat = float(params['lat'])
+                except (KeyError, ValueError):
+                    msg = 'Both lat and lon must be given as numbers'
+                    self._reply(400, {'error': msg})
+                    return
+                if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+                    msg = ('lon must be within [-180, 180], negative west, '
+                           'and lat within [-90, 90]')
+                    self._reply(400, {'error': msg})
+                    return
+                # The snapshot has longitude positive west.
+                point = (-lon, lat)
+            records = snapshot.query(office=params.get('office'),
+                                     phenomena=params.get('phenomena'),
+                                     significance=params.get('significance'),
+                                     ugc=params.get('ugc'), point=point)
+            body = {
+                'version': snapshot.version,
+                'count': len(records),
+                'events': [record_json(record) for record in records],
+            }
+            self._reply(200, body)
+        elif url.path == '/metrics':
+            text = self.server.feed.latency.exposition()
+            self._reply(200, text.encode('utf-8'),
+                        content_type='text/plain; version=0.0.4')
+        else:
+            self._reply(404, {'error': 'Unknown path {}'.format(url.path)})
+
+    def _reply(self, status, body, content_type='application/json'):
+        if content_type == 'application/json':
+            data = json.dumps(body).encode('utf-8')
+        else:
+            data = body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class EventServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server answering queries from the snapshot of a feed, one thread
+    per request.
+    """
+    daemon_threads = True
+
+    def __init__(self, feed, address=('127.0.0.1', 8080), verbose=False):
+        """
+        Parameters
+        ----------
+        feed : DirectoryFeed
+            Source of the snapshots.
+        address : tuple
+            (host, port) to listen on, port 0 picks a free port.
+        verbose : bool
+            If True, log each request to stderr.
+        """
+        self.feed = feed
+        self.verbose = verbose
+        HTTPServer.__init__(self, address, _Handler)
@@ -0,0 +1,294 @@
+"""
+Event aggregation sharded across worker processes by issuing office.
+
+An event never spans offices, so each office can be assigned to a single
+worker process that aggregates its events independently of all the others.
+"""
+
+import collections
+import multiprocessing
+import queue
+import zlib
+
+from .tracker import EventTracker
+
+# Retired events that each shard holds on to until collected.
+DEFAULT_MAX_RETIRED = 10000
+
+# Seconds between checks that a shard is still alive while waiting on it.
+_POLL_SECONDS = 1.0
+
+
+class ShardError(Exception):
+    """
+    Raised when a shard process dies while a query is waiting on it.
+    """
+    def __init__(self, message):
+        self.message = message
+        super(ShardError, self).__init__(message)
+
+
+def shard_for(office, nshards):
+    """
+    Shard that aggregates the events of an office.
+
+    A CRC is used instead of the built-in hash so that the assignment does not
+    depend on hash randomization.
+
+    Parameters
+    ----------
+    office : str
+        4-character VTEC office ID, e.g. 'KPBZ'
+    nshards : int
+        Number of shards
+
+    Returns
+    -------
+    int
+    """
+    return zlib.crc32(office.encode('ascii')) % nshards
+
+
+class _ShardFilter(object):
+    """
+    Accept only the VTEC codes that belong to one shard.
+    """
+    def __init__(self, shard, nshards):
+        self.shard = shard
+        self.nshards = nshards
+
+    def __call__(self, vtec_code):
+        return shard_for(vtec_code.office, self.nshards) == self.shard
+
+
+def _match(event, office, phenomena, significance):
+    vtec_code = event.vtec_code
+    return ((office is None or vtec_code.office == office) and
+            (phenomena is None or vtec_code.phenomena == phenomena) and
+            (significance is None or vtec_code.significance == significance))
+
+
+def _worker(shard, nshards, max_bulletins, max_retired, inbox, outbox):
+    """
+    Event loop of a shard process.
+
+    Commands arrive on the inbox as (command, payload) tuples.  Only the
+    queries produce a reply on the outbox.  Only the latest max_retired
+    retired events are kept until collected, the rest are counted.
+    """
+    retired = collections.deque(maxlen=max_retired)
+    dropped = [0]
+
+    def archive(event):
+        if len(retired) == retired.maxlen:
+            dropped[0] += 1
+        retired.append(event)
+
+    tracker = EventTracker(archive=archive,
+                           max_bulletins=max_bulletins,
+                           accept=_ShardFilter(shard, nshards))
+    while True:
+        command, payload = inbox.get()
+        if command == 'segments':
+            tracker.add_segments(payload)
+        elif command == 'events':
+            office, phenomena, significance = payload
+            outbox.put([event for event in tracker
+                        if _match(event, office, phenomena, significance)])
+        elif command == 'len':
+            outbox.put(len(tracker))
+        elif command == 'expire':
+            tracker.expire(payload)
+            outbox.put(None)
+        elif command == 'retired':
+            outbox.put((list(retired), dropped[0]))
+            retired.clear()
+            dropped[0] = 0
+        elif command == 'stop':
+            break
+
+
+class ShardedAggregator(object):
+    """
+    Aggregate bulletins into events across several worker processes.
+
+    Segments are routed to the worker that owns the issuing office of their
+    VTEC codes.  Each worker runs its own EventTracker, and queries are
+    answered by merging the results of the workers concerned.
+
+    Attributes
+    ----------
+    nshards : int
+        Number of worker processes.
+    dropped : int
+        Number of retired events that were dropped because more than
+        max_retired of them piled up in a shard between calls to retired().
+    """
+    def __init__(self, nshards=None, max_bulletins=1,
+                 max_retired=DEFAULT_MAX_RETIRED):
+        """
+        Parameters
+        ----------
+        nshards : int
+            Number of worker processes, defaults to the number of CPUs.
+        max_bulletins : int
+            Number of the most recent bulletins that live events retain.
+        max_retired : int
+            Number of retired events each shard holds on to until they are
+            collected with retired().  Older ones are dropped.  None means
+            no limit.
+        """
+        if nshards is None:
+            nshards = multiprocessing.cpu_count()
+        self.nshards = nshards
+        self.dropped = 0
+
+        self._inboxes = []
+        self._outboxes = []
+        self._processes = []
+        for shard in range(nshards):
+            inbox = multiprocessing.Queue()
+            outbox = multiprocessing.Queue()
+            args = (shard, nshards, max_bulletins, max_retired, inbox,
+                    outbox)
+            process = multiprocessing.Process(target=_worker, args=args)
+            process.daemon = True
+            process.start()
+            self._inboxes.append(inbox)
+            self._outboxes.append(outbox)
+            self._processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        """
+        Implements built-in len(), returns number of live events.
+        """
+        return sum(self._ask(range(self.nshards), 'len', None))
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        for inbox in self._inboxes:
+            inbox.put(('stop', None))
+        for process in self._processes:
+            process.join()
+        self._inboxes = []
+        self._outboxes = []
+        self._processes = []
+
+    def add_file(self, hazards_file):
+        """
+        Aggregate all of the products in a HazardsFile.
+        """
+        for product in hazards_file:
+            self.add_product(product)
+
+    def add_product(self, product):
+        """
+        Route the segments of a product to the shards of their offices.
+
+        The segments of a product that go to the same shard are sent
+        together so that the shard can make a single lifecycle transition
+        for the whole product.
+        """
+        routes = {}
+        for segment in product.segments:
+            shards = set(shard_for(vtec_code.office, self.nshards)
+                         for vtec_code in segment.vtec)
+            for shard in shards:
+                routes.setdefault(shard, []).append(segment)
+
+        for shard, segments in routes.items():
+            self._inboxes[shard].put(('segments', segments))
+
+    def add_segment(self, segment):
+        """
+        Route a single segment to the shards of its offices.
+        """
+        shards = set(shard_for(vtec_code.office, self.nshards)
+                     for vtec_code in segment.vtec)
+        for shard in shards:
+            self._inboxes[shard].put(('segments', [segment]))
+
+    def events(self, office=None, phenomena=None, significance=None):
+        """
+        Live events, optionally restricted by office, phenomena, and
+        significance.  An office query is answered by a single shard.
+
+        Returns
+        -------
+        list
+            Event objects
+        """
+        if office is None:
+            shards = range(self.nshards)
+        else:
+            shards = [shard_for(office, self.nshards)]
+
+        events = []
+        for lst in self._ask(shards, 'events',
+                             (office, phenomena, significance)):
+            events.extend(lst)
+        return events
+
+    def expire(self, now=None):
+        """
+        Retire all events that have run past their expiration date.
+
+        Parameters
+        ----------
+        now : datetime.datetime
+            Current time in UTC, defaults to the system clock.
+        """
+        self._ask(range(self.nshards), 'expire', now)
+
+    def retired(self):
+        """
+        Collect the events that the shards have retired since the last call.
+        See the dropped attribute for those that did not fit.
+
+        Returns
+        -------
+        list
+            Event objects
+        """
+        events = []
+        for lst, dropped in self._ask(range(self.nshards), 'retired', None):
+            events.extend(lst)
+            self.dropped += dropped
+        return events
+
+    def _ask(self, shards, command, payload):
+        """
+        Send a command to the shards and gather their replies.  The commands
+        all go out before waiting on any reply so that the shards work on
+        them concurrently.
+
+        Raises
+        ------
+        ShardError
+            If a shard died before replying.
+        """
+        shards = list(shards)
+        for shard in shards:
+            self._inboxes[shard].put((command, payload))
+        return [self._reply(shard) for shard in shards]
+
+    def _reply(self, shard):
+        """
+        Wait on the reply of a shard for as long as it is alive.
+        """
+        while True:
+            try:
+                return self._outboxes[shard].get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                process = self._processes[shard]
+                if not process.is_alive():
+                    msg = 'Shard {} died with exit code {}'
+                    raise ShardError(msg.format(shard, process.exitcode))
@@ -0,0 +1,402 @@
+"""
+Thread-safe store of live events with copy-on-write snapshots.
+
+A single ingest thread feeds bulletins into the store while any number of
+reader threads query it.  Each write publishes a new immutable snapshot by
+swapping a single reference, so readers never take a lock and never see an
+event halfway through an update.  Only the events that changed are copied,
+the unchanged ones are shared between successive snapshots, and so is most
+of the mapping that holds them, so a write costs about the same however
+many events are live.
+"""
+
+import collections
+import contextlib
+import copy
+import datetime as dt
+import threading
+
+from .tracker import EventTracker, event_key
+
+# The shared mapping is a hash trie, each level taking this many bits of
+# the hash.  Keys are held in dictionaries of up to _LEAF_SIZE items at the
+# bottom, which split into another level as they grow.
+_BITS = 5
+_WIDTH = 1 << _BITS
+_MASK = _WIDTH - 1
+_LEAF_SIZE = 16
+_HASH_BITS = 64
+
+_REMOVED = object()
+
+
+def _freeze(event):
+    """
+    Copy of an event that later updates to the original do not affect.  The
+    bulletins themselves are never modified once parsed, so they are shared.
+    """
+    frozen = copy.copy(event)
+    frozen._items = tuple(event._items)
+    frozen.history = tuple(event.history)
+    return frozen
+
+
+def _thaw(frozen, max_bulletins):
+    """
+    Copy of a frozen event that can be updated again, see _freeze.
+    """
+    event = copy.copy(frozen)
+    if max_bulletins is None:
+        event._items = list(frozen._items)
+    else:
+        event._items = collections.deque(frozen._items, maxlen=max_bulletins)
+    event.history = list(frozen.history)
+    return event
+
+
+def _hash(key):
+    return hash(key) & ((1 << _HASH_BITS) - 1)
+
+
+def _split(leaf, shift):
+    """
+    Spread the items of a leaf over a new level of the trie.
+    """
+    children = [None] * _WIDTH
+    for key, value in leaf.items():
+        j = (_hash(key) >> shift) & _MASK
+        if children[j] is None:
+            children[j] = {}
+        children[j][key] = value
+    for j, child in enumerate(children):
+        if (child is not None and len(child) > _LEAF_SIZE and
+                shift + _BITS < _HASH_BITS):
+            children[j] = _split(child, shift + _BITS)
+    return tuple(children)
+
+
+def _assoc(node, h, shift, key, value):
+    """
+    Copy of a node with a key set, or removed if the value is _REMOVED.
+    Only the path down to the key is copied.
+    """
+    if isinstance(node, tuple):
+        j = (h >> shift) & _MASK
+        child = node[j] if node[j] is not None else {}
+        child = _assoc(child, h, shift + _BITS, key, value)
+        if len(child) == 0:
+            child = None
+        return node[:j] + (child,) + node[j + 1:]
+
+    leaf = dict(node)
+    if value is _REMOVED:
+        leaf.pop(key, None)
+    else:
+        leaf[key] = value
+    if len(leaf) > _LEAF_SIZE and shift < _HASH_BITS:
+        return _split(leaf, shift)
+    return leaf
+
+
+def _get(node, key, default):
+    h = _hash(key)
+    shift = 0
+    while isinstance(node, tuple):
+        node = node[(h >> shift) & _MASK]
+        if node is None:
+            return default
+        shift += _BITS
+    return node.get(key, default)
+
+
+def _values(node):
+    if isinstance(node, tuple):
+        for child in node:
+            if child is not None:
+                for value in _values(child):
+                    yield value
+    else:
+        for value in node.values():
+            yield value
+
+
+class _SharedMap(object):
+    """
+    Immutable mapping whose updated copies share all but the changed paths
+    with the original, so that an update costs O(log N) rather than O(N).
+    Iteration follows the hashes of the keys, not the order of insertion.
+    """
+    def __init__(self, root=None, size=0):
+        self._root = root if root is not None else {}
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        return self.get(key, _REMOVED) is not _REMOVED
+
+    def __getitem__(self, key):
+        value = self.get(key, _REMOVED)
+        if value is _REMOVED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return _get(self._root, key, default)
+
+    def values(self):
+        return _values(self._root)
+
+    def updated(self, items):
+        """
+        New mapping with the given changes.
+
+        Parameters
+        ----------
+        items : iterable
+            (key, value) pairs, a value of _REMOVED removes the key.
+
+        Returns
+        -------
+        _SharedMap
+        """
+        root = self._root
+        size = self._size
+        for key, value in items:
+            present = _get(root, key, _REMOVED) is not _REMOVED
+            if value is _REMOVED and not present:
+                continue
+            root = _assoc(root, _hash(key), 0, key, value)
+            if value is _REMOVED:
+                size -= 1
+            elif not present:
+                size += 1
+        return _SharedMap(root, size)
+
+
+class EventSnapshot(object):
+    """
+    Immutable view of the live events as of one version of the store.
+
+    Attributes
+    ----------
+    version : int
+        Incremented with each published change.
+    """
+    def __init__(self, events=None, version=0):
+        self._events = events if events is not None else _SharedMap()
+        self.version = version
+
+    def __len__(self):
+        """
+        Implements built-in len(), returns number of live events.
+        """
+        return len(self._events)
+
+    def __iter__(self):
+        """
+        Implements iterator protocol over the live events.
+        """
+        return iter(self._events.values())
+
+    def __contains__(self, key):
+        return key in self._events
+
+    def __getitem__(self, key):
+        """
+        Event by its key, see tracker.event_key.
+        """
+        return self._events[key]
+
+    def get(self, vtec_code):
+        """
+        Live event that the VTEC code refers to, or None.
+        """
+        return self._events.get(event_key(vtec_code))
+
+    def query(self, office=None, phenomena=None, significance=None):
+        """
+        Live events, optionally restricted by office, phenomena, and
+        significance.
+
+        Returns
+        -------
+        list
+            Event objects
+        """
+        events = []
+        for event in self._events.values():
+            vtec_code = event.vtec_code
+            if office is not None and vtec_code.office != office:
+                continue
+            if phenomena is not None and vtec_code.phenomena != phenomena:
+                continue
+            if (significance is not None and
+                    vtec_code.significance != significance):
+                continue
+            events.append(event)
+        return events
+
+    def current(self, now=None):
+        """
+        Live events that have not run past their expiration date.
+
+        Parameters
+        ----------
+        now : datetime.datetime
+            Current time in UTC, defaults to the system clock.
+
+        Returns
+        -------
+        list
+            Event objects
+        """
+        if now is None:
+            now = dt.datetime.utcnow()
+        return [event for event in self._events.values()
+                if now < event[-1].expiration_date]
+
+
+class EventStore(object):
+    """
+    Aggregate bulletins into live events for concurrent readers.
+
+    Writes are serialized with a lock, reads go to snapshot() and never
+    block.
+
+    Attributes
+    ----------
+    archive : callable
+        Invoked with each Event when it is retired.
+    """
+    def __init__(self, archive=None, max_bulletins=1):
+        """
+        Parameters
+        ----------
+        archive : callable
+            Invoked with each Event when it is retired, from the ingest
+            thread.
+        max_bulletins : int
+            Number of the most recent bulletins that live events retain.
+        """
+        self._tracker = EventTracker(archive=archive,
+                                     max_bulletins=max_bulletins,
+                                     changelog=True)
+        self._snapshot = EventSnapshot()
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._failed = False
+
+    @property
+    def archive(self):
+        """
+        Invoked with each Event when it is retired.
+        """
+        return self._tracker.archive
+
+    @archive.setter
+    def archive(self, value):
+        self._tracker.archive = value
+
+    def snapshot(self):
+        """
+        The current snapshot.  Keep using the same one for a consistent view
+        across several queries.
+
+        Returns
+        -------
+        EventSnapshot
+        """
+        return self._snapshot
+
+    def __len__(self):
+        """
+        Implements built-in len(), returns number of live events.
+        """
+        return len(self._snapshot)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Publish all of the writes made within the block as a single
+        snapshot.
+
+        If the block raises, or a write within it does, everything that it
+        aggregated is undone, the events are put back as they are in the
+        current snapshot, and the readers keep that snapshot.  Events that
+        were retired in the meantime have already gone to the archive
+        callback, though.
+        """
+        with self._lock:
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._failed = True
+                raise
+            finally:
+                self._depth -= 1
+                if self._depth == 0 and self._failed:
+                    self._failed = False
+                    self._rollback()
+            if self._depth == 0:
+                self._publish()
+
+    def add_file(self, hazards_file):
+        """
+        Aggregate all of the products in a HazardsFile.
+        """
+        with self.batch():
+            self._tracker.add_file(hazards_file)
+
+    def add_product(self, product):
+        """
+        Aggregate all of the segments in a product.
+        """
+        with self.batch():
+            self._tracker.add_product(product)
+
+    def add_segments(self, segments):
+        """
+        Aggregate the segments of a single product.
+        """
+        with self.batch():
+            self._tracker.add_segments(segments)
+
+    def expire(self, now=None):
+        """
+        Retire all events that have run past their expiration date.
+
+        Parameters
+        ----------
+        now : datetime.datetime
+            Current time in UTC, defaults to the system clock.
+        """
+        with self.batch():
+            self._tracker.expire(now)
+
+    def _rollback(self):
+        """
+        Put the changed events back as they are in the current snapshot.
+        """
+        events = self._snapshot._events
+        for change in self._tracker.changes():
+            frozen = events.get(change.key)
+            if frozen is not None:
+                frozen = _thaw(frozen, self._tracker.max_bulletins)
+            self._tracker.restore(change.key, frozen)
+
+    def _publish(self):
+        changes = self._tracker.changes()
+        if len(changes) == 0:
+            return
+
+        events = self._snapshot._events.updated(
+            (change.key, _REMOVED if change.kind == 'closed'
+             else _freeze(change.event))
+            for change in changes)
+
+        # The swap is a single assignment, readers see either the old
+        # snapshot or the new one.
+        self._snapshot = EventSnapshot(events, self._snapshot.version + 1)
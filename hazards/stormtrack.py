@@ -0,0 +1,242 @@
+"""
+Storm tracks extrapolated from the TIME...MOT...LOC lines of warnings.
+
+The storm is taken to keep moving in a straight line at the reported speed
+from the reported location, which is what the pathcast of a warning
+assumes.  From this, the time each asset is closest to the storm, how close
+it comes, and when the storm first comes within some radius of it are
+computed for all of the assets at once.  As statements update the motion of
+a storm, only the track of that event is computed again.
+
+The track is computed on a plane tangent to the earth at each storm
+location, which is accurate over the tens of kilometers and the hour or so
+that a warning covers.  Where several locations are given, e.g. for a line
+of storms, the nearest of them counts.
+
+The direction of motion is where the storm is moving from, in degrees
+clockwise from north, and the speed is in knots.
+"""
+
+import collections
+import math
+
+import numpy as np
+
+from .geometry import frozen_polygon
+from .tracker import EventIndex
+
+# Kilometers in a nautical mile.
+_KM_PER_NMI = 1.852
+
+# Kilometers in a degree of latitude, on a spherical earth.
+_KM_PER_DEGREE = math.pi * 6371.0 / 180.0
+
+# How close a storm must come to an asset to arrive, in kilometers.
+DEFAULT_RADIUS = 10.0
+
+# Where a storm will be closest to each of many assets.  The times are
+# numpy.datetime64 arrays, the distance in kilometers.  The arrival is when
+# the storm first comes within the radius, NaT if it never does.  Neither
+# time is earlier than that of the TIME...MOT...LOC line.
+Approach = collections.namedtuple('Approach',
+                                  ['time', 'distance', 'arrival'])
+
+
+def storm_velocity(tml):
+    """
+    Velocity of a storm.
+
+    Parameters
+    ----------
+    tml : TimeMotionLocation
+        As found in Segment.time_motion_location.
+
+    Returns
+    -------
+    east, north : float
+        Components in kilometers per hour.
+    """
+    heading = math.radians((tml.direction + 180) % 360)
+    speed = tml.speed * _KM_PER_NMI
+    return speed * math.sin(heading), speed * math.cos(heading)
+
+
+def _location(tml):
+    location = np.asarray(tml.location, dtype=np.float64).reshape(-1, 2)
+    return location[:, 0], location[:, 1]
+
+
+def project(tml, hours):
+    """
+    Positions of a storm ahead of the time of its TIME...MOT...LOC line.
+
+    Parameters
+    ----------
+    tml : TimeMotionLocation
+        As found in Segment.time_motion_location.
+    hours : array_like
+        Times ahead in hours.
+
+    Returns
+    -------
+    x, y : ndarray
+        Longitudes and latitudes of shape (len(hours), number of storm
+        locations).
+    """
+    hours = np.asarray(hours, dtype=np.float64).reshape(-1, 1)
+    east, north = storm_velocity(tml)
+    x0, y0 = _location(tml)
+    scale = _KM_PER_DEGREE * np.cos(np.radians(y0))
+    x = x0 - east * hours / scale
+    y = y0 + north * hours / _KM_PER_DEGREE
+    return x, y
+
+
+def _times(base, hours):
+    """
+    Times some hours after a datetime, NaT where the hours are not finite.
+    """
+    finite = np.isfinite(hours)
+    seconds = np.round(np.where(finite, hours, 0.0) * 3600.0)
+    times = np.datetime64(base, 's') + seconds.astype('timedelta64[s]')
+    times[~finite] = np.datetime64('NaT', 's')
+    return times
+
+
+def closest_approach(tml, x, y, radius=DEFAULT_RADIUS):
+    """
+    Closest approach of a storm to many assets.
+
+    Parameters
+    ----------
+    tml : TimeMotionLocation
+        As found in Segment.time_motion_location.
+    x, y : array_like
+        Longitudes and latitudes of the assets, longitude positive west.
+    radius : float
+        How close in kilometers the storm must come to arrive.
+
+    Returns
+    -------
+    Approach
+    """
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    x0, y0 = _location(tml)
+    east, north = storm_velocity(tml)
+    speed2 = east * east + north * north
+
+    # Assets relative to each storm location, of shape (locations, assets).
+    scale = _KM_PER_DEGREE * np.cos(np.radians(y0))[:, np.newaxis]
+    dx = (x0[:, np.newaxis] - x) * scale
+    dy = (y - y0[:, np.newaxis]) * _KM_PER_DEGREE
+
+    if speed2 > 0:
+        hours = np.maximum((dx * east + dy * north) / speed2, 0.0)
+    else:
+        hours = np.zeros_like(dx)
+    distance = np.hypot(dx - east * hours, dy - north * hours)
+
+    # Time from closest approach back to the edge of the radius.
+    with np.errstate(invalid='ignore'):
+        before = np.sqrt(radius * radius - distance * distance)
+    if speed2 > 0:
+        arrival = np.maximum(hours - before / math.sqrt(speed2), 0.0)
+    else:
+        arrival = np.where(distance <= radius, 0.0, np.nan)
+    arrival = np.where(distance <= radius, arrival, np.inf)
+
+    nearest = np.argmin(distance, axis=0)
+    cols = np.arange(len(x))
+    arrival = arrival.min(axis=0)
+    arrival[np.isinf(arrival)] = np.nan
+    return Approach(time=_times(tml.time, hours[nearest, cols]),
+                    distance=distance[nearest, cols],
+                    arrival=_times(tml.time, arrival))
+
+
+class StormTracks(EventIndex):
+    """
+    Closest approach of the storm of each event to many assets, see
+    EventIndex for keeping them up to date with the TIME...MOT...LOC lines.
+
+    Attributes
+    ----------
+    x, y : ndarray
+        Longitudes and latitudes of the assets.
+    radius : float
+        How close in kilometers a storm must come to arrive.
+    """
+    def __init__(self, x, y, radius=DEFAULT_RADIUS):
+        """
+        Parameters
+        ----------
+        x, y : array_like
+            Longitudes and latitudes of the assets, longitude positive west.
+        radius : float
+            How close in kilometers a storm must come to arrive.
+        """
+        super(StormTracks, self).__init__()
+        self.x = np.asarray(x, dtype=np.float64).ravel()
+        self.y = np.asarray(y, dtype=np.float64).ravel()
+        if self.x.shape != self.y.shape:
+            msg = 'Got {} longitudes but {} latitudes'
+            raise ValueError(msg.format(len(self.x), len(self.y)))
+        self.radius = radius
+
+        # The approach of the storm of each event.
+        self._approaches = collections.OrderedDict()
+
+    def _value(self, bulletin):
+        return getattr(bulletin, 'time_motion_location', None)
+
+    def _normalize(self, tml):
+        # The location may be an array, e.g. when decoded from the wire.
+        if tml is None or frozen_polygon(tml.location) is None:
+            return None
+        return tml._replace(location=frozen_polygon(tml.location))
+
+    def _set(self, key, tml):
+        self._approaches[key] = closest_approach(tml, self.x, self.y,
+                                                 radius=self.radius)
+
+    def _clear(self, key):
+        del self._approaches[key]
+
+    def approach(self, key):
+        """
+        Closest approach of the storm of an event, or None if not tracked.
+
+        Returns
+        -------
+        Approach
+        """
+        return self._approaches.get(key)
+
+    def earliest(self):
+        """
+        First arrival of any storm at each asset.
+
+        Returns
+        -------
+        arrival : ndarray
+            numpy.datetime64 array, NaT where no storm arrives.
+        cols : ndarray
+            Index into keys of the storm that arrives first, -1 if none.
+        keys : list
+            Event keys.
+        """
+        keys = list(self._approaches)
+        n = len(self.x)
+        if len(keys) == 0:
+            arrival = np.full(n, np.datetime64('NaT', 's'))
+            return arrival, np.full(n, -1, dtype=np.intp), keys
+
+        arrivals = np.stack([self._approaches[key].arrival for key in keys])
+        never = np.isnat(arrivals)
+        seconds = np.where(never, np.iinfo(np.int64).max,
+                           arrivals.astype(np.int64))
+        cols = np.argmin(seconds, axis=0)
+        arrival = arrivals[cols, np.arange(n)]
+        cols[never.all(axis=0)] = -1
+        return arrival, cols, keys
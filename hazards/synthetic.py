@@ -0,0 +1,555 @@
+"""
+Synthetic bulletin corpora for scale and load testing.
+
+The generator writes hourly YYYYMMDDHH.xxxx files of framed products laid
+out like the NOAAPort text bulletins, i.e. WMO/AWIPS headers, MND headers,
+UGC strings, VTEC codes, headlines, LAT...LON polygons, and
+TIME...MOT...LOC lines, all with the same \\r\\r\\n line endings.  Every
+event runs through a complete lifecycle, NEW then CON then EXP, with some
+watches cancelled piecemeal in segmented products and some flood watches
+upgraded to warnings in multi-VTEC segments.
+
+The output depends only on the seed and the volume settings, so a corpus of
+any size can be regenerated instead of stored.
+"""
+
+import collections
+import datetime as dt
+import math
+import os
+import random
+
+# Issuing offices: VTEC office ID, state, MND office line, time zone, and
+# the approximate center of the county warning area in (longitude, latitude)
+# with the longitude positive west, as the LAT...LON lines have it.
+_Office = collections.namedtuple('_Office', ['office', 'state', 'name',
+                                             'timezone', 'center'])
+
+_OFFICES = [
+    _Office('KPBZ', 'PA', 'PITTSBURGH PA', 'EDT', (80.2, 40.5)),
+    _Office('KILM', 'NC', 'WILMINGTON NC', 'EDT', (78.2, 34.3)),
+    _Office('KLOT', 'IL', 'CHICAGO IL', 'CDT', (88.1, 41.6)),
+    _Office('KOUN', 'OK', 'NORMAN OK', 'CDT', (97.4, 35.2)),
+    _Office('KFWD', 'TX', 'FORT WORTH TX', 'CDT', (97.3, 32.8)),
+    _Office('KDDC', 'KS', 'DODGE CITY KS', 'CDT', (100.0, 37.8)),
+    _Office('KDMX', 'IA', 'DES MOINES IA', 'CDT', (93.7, 41.7)),
+    _Office('KBOU', 'CO', 'DENVER CO', 'MDT', (104.9, 39.8)),
+    _Office('KABQ', 'NM', 'ALBUQUERQUE NM', 'MDT', (106.6, 35.0)),
+    _Office('KSTO', 'CA', 'SACRAMENTO CA', 'PDT', (121.5, 38.6)),
+]
+
+_UTC_OFFSET = {
+    'EDT': -4,
+    'CDT': -5,
+    'MDT': -6,
+    'PDT': -7,
+}
+
+# Kinds of events: the VTEC phenomena and significance, the AWIPS product
+# and WMO heading of the issuance and of the followups, the MND product type
+# line, the UGC format, the range of durations in hours, and whether the
+# bulletins carry a polygon and a storm motion.
+_Kind = collections.namedtuple('_Kind', ['phenomena', 'significance',
+                                         'product', 'wmo', 'followup',
+                                         'followup_wmo', 'title', 'ugc_format',
+                                         'duration', 'polygon', 'motion'])
+
+_SEVERE_THUNDERSTORM_WARNING = _Kind('SV', 'W', 'SVR', 'WUUS53', 'SVS',
+                                     'WWUS53', 'SEVERE THUNDERSTORM WARNING',
+                                     'C', (1, 2), True, True)
+_TORNADO_WARNING = _Kind('TO', 'W', 'TOR', 'WFUS53', 'SVS', 'WWUS53',
+                         'TORNADO WARNING', 'C', (1, 2), True, True)
+_FLASH_FLOOD_WARNING = _Kind('FF', 'W', 'FFW', 'WGUS53', 'FFS', 'WGUS73',
+                             'FLASH FLOOD WARNING', 'C', (2, 4), True, False)
+_SEVERE_THUNDERSTORM_WATCH = _Kind('SV', 'A', 'WCN', 'WWUS63', 'WCN',
+                                   'WWUS63',
+                                   'WATCH COUNTY NOTIFICATION', 'C', (3, 6),
+                                   False, False)
+_FLOOD_WATCH = _Kind('FA', 'A', 'FFA', 'WGUS63', 'FFA', 'WGUS63',
+                     'FLOOD WATCH', 'Z', (4, 8), False, False)
+_FLOOD_WARNING = _Kind('FA', 'W', 'FLW', 'WGUS43', 'FLS', 'WGUS83',
+                       'FLOOD WARNING', 'Z', (3, 6), False, False)
+
+# Relative frequencies of the kinds of new events.  Flood warnings only come
+# from upgraded flood watches.
+_KIND_WEIGHTS = [
+    (_SEVERE_THUNDERSTORM_WARNING, 10),
+    (_TORNADO_WARNING, 3),
+    (_FLASH_FLOOD_WARNING, 3),
+    (_SEVERE_THUNDERSTORM_WATCH, 2),
+    (_FLOOD_WATCH, 2),
+]
+
+_MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP',
+           'OCT', 'NOV', 'DEC']
+_WEEKDAYS = ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN']
+
+_NARRATIVE = [
+    'DOPPLER RADAR INDICATED A LINE OF STRONG THUNDERSTORMS',
+    'TRAINED WEATHER SPOTTERS REPORTED HEAVY RAIN',
+    'THE STORMS WERE MOVING ACROSS OPEN COUNTRY',
+    'LOCATIONS IMPACTED INCLUDE RURAL PORTIONS OF THE AREA',
+    'HAIL UP TO ONE INCH IN DIAMETER IS POSSIBLE',
+    'WIND GUSTS UP TO 60 MPH ARE POSSIBLE',
+    'MOVE TO AN INTERIOR ROOM ON THE LOWEST FLOOR OF A BUILDING',
+    'TURN AROUND DO NOT DROWN WHEN ENCOUNTERING FLOODED ROADS',
+]
+
+# Headlines of the followup bulletins, by the action of the first VTEC code.
+_HEADLINE_VERBS = {
+    'CON': 'REMAINS IN EFFECT',
+    'EXP': 'EXPIRES',
+    'CAN': 'IS CANCELLED',
+    'UPG': 'IS NOW IN EFFECT',
+}
+
+# Longest line of a UGC string or a LAT...LON block.
+_LINE_LENGTH = 66
+
+_EOL = '\r\r\n'
+
+
+class _SyntheticEvent(object):
+    """
+    State of an event between its bulletins.
+    """
+    def __init__(self, kind, office, etn, begin, end, codes, polygon=None,
+                 motion=None):
+        self.kind = kind
+        self.office = office
+        self.etn = etn
+        self.begin = begin
+        self.end = end
+        self.codes = codes
+        self.polygon = polygon
+        self.motion = motion
+        self.issued = False
+
+
+def _vtec_time(t):
+    if t is None:
+        return '000000T0000Z'
+    return t.strftime('%y%m%dT%H%MZ')
+
+
+def _vtec(action, event, begin=None):
+    """
+    VTEC code of a bulletin, the beginning time is only given for NEW.
+    """
+    return '/O.{}.{}.{}.{}.{:04d}.{}-{}/'.format(action, event.office.office,
+                                                 event.kind.phenomena,
+                                                 event.kind.significance,
+                                                 event.etn, _vtec_time(begin),
+                                                 _vtec_time(event.end))
+
+
+def _mnd_time(t, timezone):
+    """
+    MND issuance time line, e.g. "340 PM CDT SUN JUL 19 2015"
+    """
+    local = t + dt.timedelta(hours=_UTC_OFFSET[timezone])
+    hour = local.hour % 12
+    if hour == 0:
+        hour = 12
+    meridiem = 'AM' if local.hour < 12 else 'PM'
+    return '{}{:02d} {} {} {} {} {} {}'.format(hour, local.minute, meridiem,
+                                               timezone,
+                                               _WEEKDAYS[local.weekday()],
+                                               _MONTHS[local.month - 1],
+                                               local.day, local.year)
+
+
+def _wrap(items, separator=''):
+    """
+    Join items into lines of limited length.
+    """
+    lines = []
+    line = ''
+    for item in items:
+        if line and len(line) + len(separator) + len(item) > _LINE_LENGTH:
+            lines.append(line)
+            line = item
+        elif line:
+            line += separator + item
+        else:
+            line = item
+    lines.append(line)
+    return lines
+
+
+def _ugc_lines(state, ugc_format, codes, expiration):
+    """
+    UGC string, e.g. "KSC075-093-200500-" or "PAZ007>009-014-200500-"
+
+    Only zones can be given as ranges.  The lines are broken after a dash.
+    """
+    items = []
+    codes = sorted(codes)
+    j = 0
+    while j < len(codes):
+        k = j
+        if ugc_format == 'Z':
+            while k + 1 < len(codes) and codes[k + 1] == codes[k] + 1:
+                k += 1
+        if k - j >= 2:
+            items.append('{:03d}>{:03d}-'.format(codes[j], codes[k]))
+            j = k + 1
+        else:
+            items.append('{:03d}-'.format(codes[j]))
+            j += 1
+    items[0] = state + ugc_format + items[0]
+    items.append(expiration.strftime('%d%H%M-'))
+    return _wrap(items)
+
+
+def _latlon_lines(polygon):
+    """
+    LAT...LON block of a polygon, four points to a line.
+    """
+    pairs = ['{:d} {:d}'.format(int(round(lat * 100)), int(round(lon * 100)))
+             for lon, lat in polygon]
+    lines = []
+    for j in range(0, len(pairs), 4):
+        prefix = 'LAT...LON ' if j == 0 else '      '
+        lines.append(prefix + ' '.join(pairs[j:j + 4]))
+    return lines
+
+
+class BulletinGenerator(object):
+    """
+    Seeded generator of synthetic bulletins.
+
+    Attributes
+    ----------
+    events_per_hour : int
+        Mean number of new events per hour across all offices.
+    nproducts, nsegments, nevents : int
+        Number of products, segments, and events generated so far.
+    """
+    def __init__(self, seed=0, events_per_hour=20, cancel_fraction=0.2,
+                 upgrade_fraction=0.3):
+        """
+        Parameters
+        ----------
+        seed : int
+            Seed of the random number generator.
+        events_per_hour : int
+            Mean number of new events per hour across all offices.
+        cancel_fraction : float
+            Chance that a watch update cancels part of the area in a
+            separate segment.
+        upgrade_fraction : float
+            Chance that a flood watch is upgraded to a flood warning instead
+            of expiring.
+        """
+        self.events_per_hour = events_per_hour
+        self.cancel_fraction = cancel_fraction
+        self.upgrade_fraction = upgrade_fraction
+        self.nproducts = 0
+        self.nsegments = 0
+        self.nevents = 0
+
+        self._random = random.Random(seed)
+        self._live = []
+        self._etn = {}
+        self._sequence = 0
+
+    def hours(self, start, nhours):
+        """
+        Generate the products issued in each hour.
+
+        Parameters
+        ----------
+        start : datetime.datetime
+            First hour, in UTC.
+        nhours : int
+            Number of hours.
+
+        Yields
+        ------
+        tuple
+            The hour and the list of products, as bytes, in order of
+            issuance.
+        """
+        start = start.replace(minute=0, second=0, microsecond=0)
+        for j in range(nhours):
+            hour = start + dt.timedelta(hours=j)
+            yield hour, self._products_for_hour(hour)
+
+    def write(self, dirname, start, nhours, suffix='synth'):
+        """
+        Write one bulletin file per hour.
+
+        Parameters
+        ----------
+        dirname : str
+            Output directory, created if necessary.
+        start : datetime.datetime
+            First hour, in UTC.
+        nhours : int
+            Number of hours.
+        suffix : str
+            Extension of the file names.
+
+        Returns
+        -------
+        list
+            Paths of the files written.
+        """
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        paths = []
+        for hour, products in self.hours(start, nhours):
+            path = os.path.join(dirname,
+                                '{:%Y%m%d%H}.{}'.format(hour, suffix))
+            with open(path, 'wb') as f:
+                for product in products:
+                    f.write(product)
+            paths.append(path)
+        return paths
+
+    def _products_for_hour(self, hour):
+        rng = self._random
+
+        for _ in range(rng.randint(0, 2 * self.events_per_hour)):
+            kind = self._choose_kind()
+            begin = hour + dt.timedelta(minutes=rng.randint(0, 59))
+            self._live.append(self._new_event(kind, begin))
+
+        issuances = []
+        live = []
+        for event in self._live:
+            bulletin, followup = self._next_bulletin(event, hour)
+            issuances.append(bulletin)
+            if followup is not None:
+                live.append(followup)
+        self._live = live
+
+        issuances.sort(key=lambda item: item[0])
+        return [self._frame(*item) for item in issuances]
+
+    def _choose_kind(self):
+        total = sum(weight for _, weight in _KIND_WEIGHTS)
+        x = self._random.uniform(0, total)
+        for kind, weight in _KIND_WEIGHTS:
+            if x < weight:
+                return kind
+            x -= weight
+        return _KIND_WEIGHTS[-1][0]
+
+    def _new_event(self, kind, begin, office=None, codes=None):
+        rng = self._random
+        if office is None:
+            office = rng.choice(_OFFICES)
+
+        key = (office.office, kind.phenomena, kind.significance)
+        etn = self._etn.get(key, 0) % 9999 + 1
+        self._etn[key] = etn
+
+        end = begin + dt.timedelta(hours=rng.randint(*kind.duration))
+
+        if codes is None:
+            if kind.ugc_format == 'Z':
+                # Zones come in runs so that the UGC string has ranges.
+                first = rng.randint(1, 80)
+                codes = set()
+                for _ in range(rng.randint(1, 3)):
+                    first += rng.randint(1, 6)
+                    codes.update(range(first, first + rng.randint(1, 5)))
+                    first = max(codes)
+            else:
+                n = rng.randint(1, 4) if kind.polygon else rng.randint(5, 20)
+                codes = set(rng.sample(range(1, 200, 2), n))
+
+        polygon = None
+        if kind.polygon:
+            lon = office.center[0] + rng.uniform(-1, 1)
+            lat = office.center[1] + rng.uniform(-1, 1)
+            npoints = rng.randint(4, 8)
+            polygon = []
+            for j in range(npoints):
+                radius = rng.uniform(0.1, 0.4)
+                angle = 2 * math.pi * j / npoints
+                polygon.append((round(lon + radius * math.cos(angle), 2),
+                                round(lat + radius * math.sin(angle), 2)))
+
+        motion = None
+        if kind.motion:
+            motion = (rng.randint(180, 300), rng.randint(10, 60))
+
+        self.nevents += 1
+        return _SyntheticEvent(kind, office, etn, begin, end, sorted(codes),
+                               polygon=polygon, motion=motion)
+
+    def _next_bulletin(self, event, hour):
+        """
+        Next bulletin of an event issued in the given hour.
+
+        Returns
+        -------
+        tuple
+            The issuance, i.e. the issuance time, the event, and the list of
+            segments as (action codes, UGC codes) tuples, then the event to
+            keep alive, if any.
+        """
+        rng = self._random
+        if not event.issued:
+            event.issued = True
+            issued = event.begin
+            return (issued, event, [([('NEW', event)], event.codes)]), event
+
+        issued = hour + dt.timedelta(minutes=event.begin.minute)
+        if issued >= event.end:
+            issued = event.end
+            if (event.kind is _FLOOD_WATCH and
+                    rng.random() < self.upgrade_fraction):
+                # The warning takes over the area of the watch in the same
+                # segment.
+                warning = self._new_event(_FLOOD_WARNING, issued,
+                                          office=event.office,
+                                          codes=event.codes)
+                warning.issued = True
+                event.end = issued
+                actions = [('UPG', event), ('NEW', warning)]
+                return (issued, warning, [(actions, event.codes)]), warning
+            return (issued, event, [([('EXP', event)], event.codes)]), None
+
+        if event.polygon is not None and event.motion is not None:
+            event.polygon = _move(event.polygon, event.motion)
+
+        segments = []
+        if (event.kind.significance == 'A' and len(event.codes) > 1 and
+                rng.random() < self.cancel_fraction):
+            ncancelled = rng.randint(1, len(event.codes) - 1)
+            cancelled = event.codes[:ncancelled]
+            event.codes = event.codes[ncancelled:]
+            segments.append(([('CAN', event)], cancelled))
+        segments.append(([('CON', event)], event.codes))
+        return (issued, event, segments), event
+
+    def _frame(self, issued, event, segments):
+        """
+        Lay out a product with the \\x01...\\x03 framing.
+        """
+        office = event.office
+        kind = event.kind
+        new = segments[0][0][0][0] == 'NEW'
+        if new or kind is _FLOOD_WARNING and segments[0][0][0][0] == 'UPG':
+            awips, wmo = kind.product, kind.wmo
+        else:
+            awips, wmo = kind.followup, kind.followup_wmo
+
+        self._sequence = self._sequence % 999 + 1
+        mnd_time = _mnd_time(issued, office.timezone)
+        lines = [
+            '\x01',
+            '{:03d} '.format(self._sequence),
+            '{} {} {:%d%H%M}'.format(wmo, office.office, issued),
+            awips + office.office[1:],
+            '',
+            kind.title,
+            'NATIONAL WEATHER SERVICE ' + office.name,
+            mnd_time,
+            '',
+        ]
+
+        for actions, codes in segments:
+            lines.extend(self._segment_lines(issued, event, actions, codes,
+                                             mnd_time))
+
+        lines.extend(['', '\x03'])
+
+        self.nproducts += 1
+        self.nsegments += len(segments)
+        return _EOL.join(lines).encode('ascii')
+
+    def _segment_lines(self, issued, event, actions, codes, mnd_time):
+        rng = self._random
+        closing = actions[-1][0] in ('EXP', 'CAN')
+        if closing:
+            expiration = issued + dt.timedelta(minutes=15)
+        else:
+            expiration = event.end
+
+        lines = _ugc_lines(event.office.state, event.kind.ugc_format, codes,
+                           expiration)
+        for action, item in actions:
+            begin = item.begin if action == 'NEW' else None
+            lines.append(_vtec(action, item, begin=begin))
+        lines.extend([mnd_time, ''])
+
+        verb = _HEADLINE_VERBS.get(actions[0][0])
+        if verb is not None:
+            lines.extend(['...THE {} {}...'.format(event.kind.title, verb),
+                          ''])
+
+        narrative = rng.sample(_NARRATIVE, rng.randint(1, 3))
+        lines.extend(_wrap(narrative, separator='. '))
+        lines.append('')
+
+        if event.polygon is not None:
+            lines.extend(_latlon_lines(event.polygon))
+            if event.motion is not None:
+                direction, speed = event.motion
+                lon, lat = _centroid(event.polygon)
+                tml = 'TIME...MOT...LOC {:%H%M}Z {:03d}DEG {:02d}KT {} {}'
+                lines.append(tml.format(issued, direction, speed,
+                                        int(round(lat * 100)),
+                                        int(round(lon * 100))))
+            lines.append('')
+
+        lines.extend(['$$', '', 'XX'])
+        return lines
+
+
+def _centroid(polygon):
+    lons = [lon for lon, _ in polygon]
+    lats = [lat for _, lat in polygon]
+    return sum(lons) / len(lons), sum(lats) / len(lats)
+
+
+def _move(polygon, motion):
+    """
+    Displace a polygon by an hour of storm motion.  The direction is the one
+    the storm is moving from, and longitudes are positive west.
+    """
+    direction, speed = motion
+    heading = math.radians((direction + 180) % 360)
+    # One knot is one nautical mile, or one minute of latitude, per hour.
+    dlat = speed / 60.0 * math.cos(heading)
+    dlon = -speed / 60.0 * math.sin(heading)
+    dlon /= math.cos(math.radians(polygon[0][1]))
+    return [(round(lon + dlon, 2), round(lat + dlat, 2))
+            for lon, lat in polygon]
+
+
+def generate_corpus(dirname, start, nhours, seed=0, events_per_hour=20,
+                    suffix='synth'):
+    """
+    Write a synthetic corpus of hourly bulletin files.
+
+    Parameters
+    ----------
+    dirname : str
+        Output directory, created if necessary.
+    start : datetime.datetime
+        First hour, in UTC.
+    nhours : int
+        Number of hours.
+    seed : int
+        Seed of the random number generator.
+    events_per_hour : int
+        Mean number of new events per hour across all offices.
+    suffix : str
+        Extension of the file names.
+
+    Returns
+    -------
+    BulletinGenerator
+        Its counters tell how many products, segments, and events were
+        written.
+    """
+    generator = BulletinGenerator(seed=seed, events_per_hour=events_per_hour)
+    generator.write(dirname, start, nhours, suffix=suffix)
+    return generator
@@ -0,0 +1,443 @@
+"""
+Long-running event aggregation driven by the VTEC action codes.
+"""
+
+import abc
+import collections
+
+from .hazards import Event
+
+# Something that happened to an event: it was created ("new"), received
+# another bulletin ("updated"), or was cancelled, upgraded, or expired
+# ("closed").  The issuance time is that of the latest bulletin.
+EventChange = collections.namedtuple('EventChange',
+                                     ['kind', 'key', 'issuance_time',
+                                      'event'])
+
+
+def event_key(vtec_code):
+    """
+    Identity of the event that a VTEC code refers to.
+
+    Unlike Event.contains, the significance is part of the identity so that
+    a watch and the warning it is upgraded to are tracked separately.
+
+    Parameters
+    ----------
+    vtec_code : VtecCode
+        VTEC code object
+
+    Returns
+    -------
+    tuple
+        (product, office, phenomena, significance, event tracking ID)
+    """
+    return (vtec_code.product, vtec_code.office, vtec_code.phenomena,
+            vtec_code.significance, vtec_code.event_tracking_id)
+
+
+def _issuance_time(event):
+    if len(event.history) == 0:
+        return None
+    return event.history[-1].issuance_time
+
+
+def _signature(event):
+    """
+    What changes whenever an event gets another bulletin, a new expiration
+    time, or a new state.
+    """
+    last = event.history[-1] if len(event.history) > 0 else None
+    return event.state, len(event.history), last
+
+
+def diff_events(old, new):
+    """
+    Changes between two collections of events, e.g. the results of
+    successive calls to fetch_events.
+
+    Events are matched by their VTEC identity, see event_key, so it takes
+    one pass over each collection.  When the events come from an
+    EventTracker, its changelog gets the same answer without looking at the
+    unchanged events at all.
+
+    Parameters
+    ----------
+    old, new : iterable
+        Event objects.
+
+    Returns
+    -------
+    list
+        EventChange for each event that appeared ("new"), changed
+        ("updated"), or disappeared or was closed ("closed") in going from
+        old to new.  The order follows new, then old.
+    """
+    before = dict((event_key(event.vtec_code), event) for event in old)
+
+    changes = []
+    seen = set()
+    for event in new:
+        key = event_key(event.vtec_code)
+        seen.add(key)
+        previous = before.get(key)
+        if event.closed:
+            if previous is None or not previous.closed:
+                changes.append(EventChange('closed', key,
+                                           _issuance_time(event), event))
+        elif previous is None:
+            changes.append(EventChange('new', key, _issuance_time(event),
+                                       event))
+        elif _signature(previous) != _signature(event):
+            changes.append(EventChange('updated', key,
+                                       _issuance_time(event), event))
+
+    for key, event in before.items():
+        if key not in seen and not event.closed:
+            changes.append(EventChange('closed', key, _issuance_time(event),
+                                       event))
+    return changes
+
+
+class EventTracker(object):
+    """
+    Aggregate bulletins into events with bounded memory.
+
+    Each VTEC code moves its event through the lifecycle states.  Once an
+    event is cancelled, upgraded, or expired it is retired from the tracker
+    and handed to the archive callback, if any.  Live events only retain
+    their most recent bulletins plus the compact history of the others.
+
+    Attributes
+    ----------
+    archive : callable
+        Invoked with each Event when it is retired.
+    max_bulletins : int
+        Number of the most recent bulletins that live events retain.
+    accept : callable
+        Predicate on VTEC codes, only the accepted ones are aggregated.
+    """
+    def __init__(self, archive=None, max_bulletins=1, accept=None,
+                 changelog=False):
+        """
+        Parameters
+        ----------
+        archive : callable
+            Invoked with each Event when it is retired.
+        max_bulletins : int
+            Number of the most recent bulletins that live events retain.
+            None means retain all of them.
+        accept : callable
+            If provided, only aggregate the VTEC codes for which this
+            returns True.
+        changelog : bool
+            If True, record the changes to the events until they are
+            collected with changes().
+        """
+        self.archive = archive
+        self.max_bulletins = max_bulletins
+        self.accept = accept
+        self._events = {}
+        self._changes = collections.OrderedDict() if changelog else None
+
+    def __iter__(self):
+        """
+        Implements iterator protocol over the live events.
+        """
+        return iter(list(self._events.values()))
+
+    def __len__(self):
+        """
+        Implements built-in len(), returns number of live events.
+        """
+        return len(self._events)
+
+    def get(self, vtec_code):
+        """
+        Live event that the VTEC code refers to, or None.
+        """
+        return self._events.get(event_key(vtec_code))
+
+    def add_file(self, hazards_file):
+        """
+        Aggregate all of the products in a HazardsFile.
+        """
+        for product in hazards_file:
+            self.add_product(product)
+
+    def add_product(self, product):
+        """
+        Aggregate all of the segments in a product.
+
+        Parameters
+        ----------
+        product : Product
+            A parsed product.
+
+        Returns
+        -------
+        list
+            The events that were created or updated.
+        """
+        return self.add_segments(product.segments)
+
+    def add_segment(self, segment):
+        """
+        Aggregate each VTEC code in a segment into its event.
+
+        Prefer add_product for segmented products, since an event is only
+        closed when every segment of the product closes it.
+
+        Parameters
+        ----------
+        segment : Segment
+            A parsed segment.
+
+        Returns
+        -------
+        list
+            The events that were created or updated.
+        """
+        return self.add_segments([segment])
+
+    def add_segments(self, segments):
+        """
+        Aggregate the segments of a single product.
+
+        Parameters
+        ----------
+        segments : list
+            Segment objects from the same product.
+
+        Returns
+        -------
+        list
+            The events that were created or updated.
+        """
+        actions = collections.OrderedDict()
+        created = set()
+        for segment in segments:
+            for vtec_code in segment.vtec:
+                if self.accept is not None and not self.accept(vtec_code):
+                    continue
+                key = event_key(vtec_code)
+                event = self._events.get(key)
+                if event is None:
+                    event = Event(vtec_code, segment,
+                                  max_bulletins=self.max_bulletins)
+                    self._events[key] = event
+                    created.add(key)
+                else:
+                    event.append(segment, vtec_code, transition=False)
+                actions.setdefault(key, []).append(vtec_code.action)
+
+        touched = []
+        for key, lst in actions.items():
+            event = self._events[key]
+            event.transition(lst)
+            touched.append(event)
+            if event.closed:
+                self._retire(key)
+            else:
+                self._log('new' if key in created else 'updated', key, event)
+        return touched
+
+    def expire(self, now=None):
+        """
+        Retire all events that have run past their expiration date.
+
+        Parameters
+        ----------
+        now : datetime.datetime
+            Current time in UTC, defaults to the system clock.
+
+        Returns
+        -------
+        list
+            The events that were retired.
+        """
+        expired = [key for key, event in self._events.items()
+                   if event.expire(now)]
+        return [self._retire(key) for key in expired]
+
+    def changes(self):
+        """
+        Collect the changes since the last call, at most one per event.
+
+        An event that was created and then updated is reported as "new",
+        and an event that was closed is reported as "closed" whatever
+        happened to it before.  The cost is proportional to the number of
+        changed events, not the number of live ones.
+
+        Returns
+        -------
+        list
+            EventChange objects, in the order the events first changed.
+        """
+        if self._changes is None:
+            raise RuntimeError('The tracker was made without a changelog.')
+        changes = list(self._changes.values())
+        self._changes.clear()
+        return changes
+
+    def restore(self, key, event):
+        """
+        Put an event back as it was, e.g. to undo a failed ingest.  No
+        change is recorded and nothing is archived.
+
+        Parameters
+        ----------
+        key : tuple
+            Event key, see event_key.
+        event : Event or None
+            The event to put back, or None to drop the key.
+        """
+        if event is None:
+            self._events.pop(key, None)
+        else:
+            self._events[key] = event
+
+    def _log(self, kind, key, event):
+        if self._changes is None:
+            return
+        previous = self._changes.get(key)
+        if previous is not None and previous.kind == 'new':
+            if kind == 'updated':
+                kind = 'new'
+        self._changes[key] = EventChange(kind, key, _issuance_time(event),
+                                         event)
+
+    def _retire(self, key):
+        event = self._events.pop(key)
+        self._log('closed', key, event)
+        if self.archive is not None:
+            self.archive(event)
+        return event
+
+
+class EventIndex(abc.ABC):
+    """
+    Something derived from the latest bulletin of each live event, e.g. the
+    cells its polygon covers, kept up to date with an EventTracker.
+
+    Subclasses must say what to take from a bulletin in _value, and how to
+    compute and clear what is derived from it in _set and _clear.  Nothing
+    is computed again unless the value changes.
+    """
+    def __init__(self):
+        # The value each key was last computed from.
+        self._values = {}
+
+    def __len__(self):
+        """
+        Implements built-in len(), returns number of events indexed.
+        """
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    @abc.abstractmethod
+    def _value(self, bulletin):
+        """
+        What to index of the latest bulletin of an event, None if nothing.
+        """
+
+    def _normalize(self, value):
+        """
+        Comparable form of a value, or None if there is nothing to index.
+        """
+        return value
+
+    @abc.abstractmethod
+    def _set(self, key, value):
+        """
+        Compute what is derived from a new value of a key.  Anything derived
+        from the previous value is still there.
+        """
+
+    @abc.abstractmethod
+    def _clear(self, key):
+        """
+        Drop what is derived from the value of a key.
+        """
+
+    def update(self, key, value):
+        """
+        Index the latest value of an event.  Nothing is done if the value
+        has not changed.
+
+        Parameters
+        ----------
+        key : tuple
+            Event key, see event_key.
+        value : object
+            E.g. a polygon.  None or empty removes the event.
+
+        Returns
+        -------
+        bool
+            True if the index changed.
+        """
+        value = self._normalize(value)
+        if value is None:
+            return self.remove(key)
+        if key in self._values and self._values[key] == value:
+            return False
+        self._set(key, value)
+        self._values[key] = value
+        return True
+
+    def remove(self, key):
+        """
+        Drop an event from the index.
+
+        Returns
+        -------
+        bool
+            True if the event was indexed.
+        """
+        if key not in self._values:
+            return False
+        self._clear(key)
+        del self._values[key]
+        return True
+
+    def add_event(self, event):
+        """
+        Index the latest bulletin of an event, or drop the event once it is
+        closed.
+
+        Returns
+        -------
+        bool
+            True if the index changed.
+        """
+        key = event_key(event.vtec_code)
+        if event.closed:
+            return self.remove(key)
+        return self.update(key, self._value(event[-1]))
+
+    def apply(self, changes):
+        """
+        Bring the index up to date with the changes of an EventTracker with
+        a changelog.
+
+        Parameters
+        ----------
+        changes : list
+            EventChange tuples, see EventTracker.changes.
+
+        Returns
+        -------
+        int
+            Number of events whose entries changed.
+        """
+        count = 0
+        for change in changes:
+            if change.kind == 'closed':
+                changed = self.remove(change.key)
+            else:
+                changed = self.add_event(change.event)
+            count += int(changed)
+        return count
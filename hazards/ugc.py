@@ -0,0 +1,280 @@
+"""
+Compact sets of UGC codes.
+
+A set holds one bitset per state and format, with bit N set for county or
+zone NNN.  Counties (C) and zones (Z) of the same state are kept apart, as
+their numbers mean different areas.  Set algebra over whole states is then
+a handful of bitwise operations on Python integers rather than operations
+on lists of codes, and a set serializes to a few bytes per state.
+
+Code 000, which stands for all of the zones of a state, is kept as is and
+not expanded.
+"""
+
+import re
+import struct
+
+# Counties and zones are numbered 000 through 999.
+_NCODES = 1000
+
+_CODE_regex = re.compile(r'^(?P<state>[A-Z]{2})(?P<format>[CZ])'
+                         r'(?P<number>\d{3})$')
+
+_LETTER = {
+    'county': 'C',
+    'zone': 'Z',
+}
+
+# number of states, then for each the state, format, and length in bytes of
+# the bitset
+_COUNT_STRUCT = struct.Struct('<H')
+_STATE_STRUCT = struct.Struct('<2s1sB')
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+class UgcSet(object):
+    """
+    Set of UGC codes like "KSC075".
+
+    Iterating yields the codes sorted by state, format, and number, as in
+    Segment.ugc_codes.
+    """
+    def __init__(self, codes=()):
+        """
+        Parameters
+        ----------
+        codes : iterable of str
+            UGC codes like "KSC075" or "KSZ012".
+        """
+        # Bitset of each (state, format), without empty ones.
+        self._bits = {}
+        for code in codes:
+            self.add(code)
+
+    @classmethod
+    def _from_bits(cls, bits):
+        ugcs = cls()
+        ugcs._bits = dict((key, value) for key, value in bits.items()
+                          if value != 0)
+        return ugcs
+
+    @classmethod
+    def from_groups(cls, groups):
+        """
+        Set of the codes of a segment in its parsed form.
+
+        Parameters
+        ----------
+        groups : dict
+            Lists of county or zone numbers by (state, format) pairs, the
+            format being "C" or "Z", as in Segment.ugc_groups.
+        """
+        bits = {}
+        for key, numbers in groups.items():
+            value = bits.get(key, 0)
+            for number in numbers:
+                value |= 1 << number
+            bits[key] = value
+        return cls._from_bits(bits)
+
+    @classmethod
+    def from_states(cls, states, ugc_format):
+        """
+        Set of codes all of one format.
+
+        Parameters
+        ----------
+        states : dict
+            Lists of county or zone numbers by state.
+        ugc_format : str
+            Either "county" or "zone".
+        """
+        letter = _LETTER[ugc_format]
+        return cls.from_groups(dict(((state, letter), numbers)
+                                    for state, numbers in states.items()))
+
+    @classmethod
+    def from_segment(cls, segment):
+        """
+        Set of the codes of a segment, empty if it has none.  Counties and
+        zones are told apart even when the segment lists both.
+        """
+        if segment.ugc_groups is None:
+            return cls()
+        return cls.from_groups(segment.ugc_groups)
+
+    def add(self, code):
+        """
+        Add a UGC code like "KSC075".
+        """
+        m = _CODE_regex.match(code)
+        if m is None:
+            raise ValueError('Invalid UGC code {!r}'.format(code))
+        key = (m.group('state'), m.group('format'))
+        self._bits[key] = self._bits.get(key, 0) | 1 << int(m.group('number'))
+
+    def __contains__(self, code):
+        m = _CODE_regex.match(code)
+        if m is None:
+            return False
+        bits = self._bits.get((m.group('state'), m.group('format')), 0)
+        return bool(bits >> int(m.group('number')) & 1)
+
+    def __len__(self):
+        """
+        Implements built-in len(), returns number of codes.
+        """
+        return sum(_popcount(bits) for bits in self._bits.values())
+
+    def __iter__(self):
+        for state, letter in sorted(self._bits):
+            bits = self._bits[(state, letter)]
+            number = 0
+            while bits:
+                if bits & 1:
+                    yield '{}{}{:03d}'.format(state, letter, number)
+                bits >>= 1
+                number += 1
+
+    def __eq__(self, other):
+        if not isinstance(other, UgcSet):
+            return NotImplemented
+        return self._bits == other._bits
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'UgcSet({!r})'.format(list(self))
+
+    def __or__(self, other):
+        bits = dict(self._bits)
+        for key, value in other._bits.items():
+            bits[key] = bits.get(key, 0) | value
+        return self._from_bits(bits)
+
+    def __and__(self, other):
+        bits = {}
+        for key, value in self._bits.items():
+            bits[key] = value & other._bits.get(key, 0)
+        return self._from_bits(bits)
+
+    def __sub__(self, other):
+        bits = {}
+        for key, value in self._bits.items():
+            bits[key] = value & ~other._bits.get(key, 0)
+        return self._from_bits(bits)
+
+    def __xor__(self, other):
+        bits = dict(self._bits)
+        for key, value in other._bits.items():
+            bits[key] = bits.get(key, 0) ^ value
+        return self._from_bits(bits)
+
+    def union(self, *others):
+        result = self
+        for other in others:
+            result = result | other
+        return result
+
+    def intersection(self, *others):
+        result = self
+        for other in others:
+            result = result & other
+        return result
+
+    def difference(self, *others):
+        result = self
+        for other in others:
+            result = result - other
+        return result
+
+    def isdisjoint(self, other):
+        return all(value & other._bits.get(key, 0) == 0
+                   for key, value in self._bits.items())
+
+    def issubset(self, other):
+        return all(value & ~other._bits.get(key, 0) == 0
+                   for key, value in self._bits.items())
+
+    def __le__(self, other):
+        return self.issubset(other)
+
+    def __ge__(self, other):
+        return other.issubset(self)
+
+    def states(self):
+        """
+        Counties or zones of each state, like Segment.ugc_groups.
+
+        Returns
+        -------
+        dict
+            Sorted lists of numbers by (state, format) pairs, the format
+            being "C" or "Z".
+        """
+        result = {}
+        for key in sorted(self._bits):
+            bits = self._bits[key]
+            result[key] = [n for n in range(bits.bit_length())
+                           if bits >> n & 1]
+        return result
+
+    def to_bytes(self):
+        """
+        Serialize the set.  Each state takes four bytes plus one byte for
+        every eight numbers up to its highest one.
+
+        Returns
+        -------
+        bytes
+        """
+        parts = [_COUNT_STRUCT.pack(len(self._bits))]
+        for (state, letter) in sorted(self._bits):
+            bits = self._bits[(state, letter)]
+            nbytes = (bits.bit_length() + 7) // 8
+            parts.append(_STATE_STRUCT.pack(state.encode('ascii'),
+                                            letter.encode('ascii'), nbytes))
+            parts.append(bits.to_bytes(nbytes, 'little'))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        """
+        Deserialize a set written by to_bytes.
+
+        Raises
+        ------
+        ValueError
+            If the buffer does not hold a set.
+        """
+        buf = bytes(buf)
+        try:
+            count, = _COUNT_STRUCT.unpack_from(buf, 0)
+            pos = _COUNT_STRUCT.size
+            bits = {}
+            for _ in range(count):
+                state, letter, nbytes = _STATE_STRUCT.unpack_from(buf, pos)
+                pos += _STATE_STRUCT.size
+                if pos + nbytes > len(buf):
+                    raise ValueError('Truncated UGC set')
+                value = int.from_bytes(buf[pos:pos + nbytes], 'little')
+                pos += nbytes
+                bits[(state.decode('ascii'), letter.decode('ascii'))] = value
+        except struct.error as e:
+            raise ValueError('Truncated UGC set: {}'.format(e))
+        if pos != len(buf):
+            raise ValueError('Trailing bytes after UGC set')
+        for (state, letter), value in bits.items():
+            if letter not in 'CZ' or value >> _NCODES:
+                msg = 'Invalid UGC set for {}{}'
+                raise ValueError(msg.format(state, letter))
+        return cls._from_bits(bits)
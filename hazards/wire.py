@@ -0,0 +1,507 @@
+"""
+Compact binary encoding of parsed products, segments, and VTEC codes.
+
+The encoding is meant for moving parsed bulletins between processes and
+services without pickling the object graphs.  Codes are packed into fixed
+width fields, times into integer seconds since the epoch, UGC codes into
+uint16 arrays, and coordinates into float64 arrays that are decoded without
+copying.  The raw text is left out unless asked for.
+
+Each message starts with a header of the magic bytes b'HZ', the format
+version, and a type byte.  All integers and floats are little endian.
+
+Decoded objects are not parsed again.  Coordinates come back as read-only
+NumPy arrays of shape (N, 2) that share memory with the buffer, so they
+still iterate as (longitude, latitude) pairs.
+"""
+
+import datetime as dt
+import struct
+
+import numpy as np
+
+from .hazards import Product, Segment, TimeMotionLocation, VtecCode
+
+MAGIC = b'HZ'
+
+# Bump this whenever the layout changes.  Decoding refuses other versions.
+VERSION = 2
+
+_PRODUCT = ord('P')
+_SEGMENT = ord('S')
+_VTEC = ord('V')
+
+_HEADER = struct.Struct('<2sBB')
+
+# Stands in for a missing time.
+_NO_TIME = -2 ** 63
+
+_EPOCH = dt.datetime(1970, 1, 1)
+
+# product class, action, office, phenomena, significance, event tracking ID,
+# beginning and ending times
+_VTEC_STRUCT = struct.Struct('<1s3s4s2s1sHqq')
+
+# WMO data type, geographic designator, code, office, retransmission, AWIPS
+# product and location ID, WMO issuance time, base date, offset, flags
+_PRODUCT_STRUCT = struct.Struct('<2s2sH4s3s3s3sqqqB')
+
+# expiration date, UGC format, flags of the parsed fields
+_SEGMENT_STRUCT = struct.Struct('<q1sB')
+
+# Flags of the product.
+_HAS_RAW = 0x01
+
+# Flags of the segment.
+_HAS_HEADLINE = 0x01
+_HAS_MND_ISSUANCE_TIME = 0x02
+_HAS_LAT_LON = 0x04
+_HAS_TIME_MOTION_LOCATION = 0x08
+_HAS_STATES = 0x10
+_HAS_FIELDS = 0x20
+_CLEAN_TXT = 0x40
+_SEGMENT_HAS_RAW = 0x80
+
+_UGC_FORMAT = {
+    'county': b'C',
+    'zone': b'Z',
+    None: b'\x00',
+}
+_UGC_FORMAT_NAME = dict((value, key) for key, value in _UGC_FORMAT.items())
+
+
+class WireFormatError(Exception):
+    """
+    Raised when a buffer does not hold a message of the expected type and
+    version.
+    """
+    def __init__(self, message):
+        self.message = message
+        super(WireFormatError, self).__init__(message)
+
+
+def _pack_time(t):
+    if t is None:
+        return _NO_TIME
+    delta = t - _EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def _unpack_time(seconds):
+    if seconds == _NO_TIME:
+        return None
+    return _EPOCH + dt.timedelta(seconds=seconds)
+
+
+def _pack_str(value, width):
+    """
+    Fixed width field, None is all zeros.
+    """
+    if value is None:
+        return b''
+    return value.encode('utf-8')[:width]
+
+
+def _unpack_str(value):
+    value = value.rstrip(b'\x00')
+    if len(value) == 0:
+        return None
+    return value.decode('utf-8')
+
+
+class _Writer(object):
+    """
+    Accumulate the parts of a message.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+
+    def pack(self, fmt, *args):
+        self.parts.append(struct.pack(fmt, *args))
+
+    def bytes(self, data):
+        """
+        Length prefixed bytes, None is distinguished from empty.
+        """
+        if data is None:
+            self.pack('<i', -1)
+        else:
+            self.pack('<i', len(data))
+            self.parts.append(data)
+
+    def text(self, value):
+        self.bytes(None if value is None else value.encode('utf-8'))
+
+    def coordinates(self, points):
+        """
+        Count of (x, y) points followed by their float64 coordinates.
+        """
+        a = np.asarray(points, dtype='<f8').reshape(-1, 2)
+        self.pack('<I', a.shape[0])
+        self.parts.append(a.tobytes())
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class _Reader(object):
+    """
+    Walk through the parts of a message.
+    """
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        self.pos = 0
+
+    def unpack(self, fmt):
+        if isinstance(fmt, struct.Struct):
+            s = fmt
+        else:
+            s = struct.Struct(fmt)
+        values = s.unpack_from(self.buf, self.pos)
+        self.pos += s.size
+        return values
+
+    def bytes(self):
+        n, = self.unpack('<i')
+        if n < 0:
+            return None
+        value = self.buf[self.pos:self.pos + n].tobytes()
+        self.pos += n
+        return value
+
+    def text(self):
+        value = self.bytes()
+        return None if value is None else value.decode('utf-8')
+
+    def coordinates(self):
+        n, = self.unpack('<I')
+        a = np.frombuffer(self.buf, dtype='<f8', count=2 * n,
+                          offset=self.pos).reshape(n, 2)
+        self.pos += 16 * n
+        return a
+
+
+def _write_header(writer, kind):
+    writer.write(_HEADER.pack(MAGIC, VERSION, kind))
+
+
+def _read_header(reader, kind):
+    try:
+        magic, version, actual = reader.unpack(_HEADER)
+    except struct.error:
+        raise WireFormatError('Buffer is too short for a message header')
+    if magic != MAGIC:
+        raise WireFormatError('Not a hazards wire format message')
+    if version != VERSION:
+        msg = 'Wire format version {} is not supported, expected {}'
+        raise WireFormatError(msg.format(version, VERSION))
+    if actual != kind:
+        msg = 'Expected a message of type {!r}, got {!r}'
+        raise WireFormatError(msg.format(chr(kind), chr(actual)))
+
+
+def _write_vtec(writer, vtec_code):
+    writer.write(_VTEC_STRUCT.pack(_pack_str(vtec_code.product, 1),
+                                   _pack_str(vtec_code.action, 3),
+                                   _pack_str(vtec_code.office, 4),
+                                   _pack_str(vtec_code.phenomena, 2),
+                                   _pack_str(vtec_code.significance, 1),
+                                   vtec_code.event_tracking_id,
+                                   _pack_time(vtec_code.event_beginning_time),
+                                   _pack_time(vtec_code.event_ending_time)))
+
+
+def _vtec_time(t):
+    if t is None:
+        return '000000T0000Z'
+    return t.strftime('%y%m%dT%H%MZ')
+
+
+def _read_vtec(reader):
+    (product, action, office, phenomena, significance, etn, begin,
+     end) = reader.unpack(_VTEC_STRUCT)
+
+    vtec_code = VtecCode.__new__(VtecCode)
+    vtec_code.product = _unpack_str(product)
+    vtec_code.action = _unpack_str(action)
+    vtec_code.office = _unpack_str(office)
+    vtec_code.phenomena = _unpack_str(phenomena)
+    vtec_code.significance = _unpack_str(significance)
+    vtec_code.event_tracking_id = etn
+    vtec_code.event_beginning_time = _unpack_time(begin)
+    vtec_code.event_ending_time = _unpack_time(end)
+
+    # The code is fully determined by its parts.
+    vtec_code.code = '/{}.{}.{}.{}.{}.{:04d}.{}-{}'.format(
+        vtec_code.product, vtec_code.action, vtec_code.office,
+        vtec_code.phenomena, vtec_code.significance, etn,
+        _vtec_time(vtec_code.event_beginning_time),
+        _vtec_time(vtec_code.event_ending_time))
+    return vtec_code
+
+
+def _write_segment(writer, segment, raw):
+    d = segment.__dict__
+    flags = 0
+    if 'headline' in d:
+        flags |= _HAS_HEADLINE
+    if 'mnd_issuance_time' in d:
+        flags |= _HAS_MND_ISSUANCE_TIME
+    if 'polygon' in d:
+        flags |= _HAS_LAT_LON
+    if 'time_motion_location' in d:
+        flags |= _HAS_TIME_MOTION_LOCATION
+    if segment.ugc_groups is not None:
+        flags |= _HAS_STATES
+    if segment.fields is not None:
+        flags |= _HAS_FIELDS
+    if segment._clean_txt:
+        flags |= _CLEAN_TXT
+    if raw:
+        flags |= _SEGMENT_HAS_RAW
+
+    writer.write(_SEGMENT_STRUCT.pack(_pack_time(segment.expiration_date),
+                                      _UGC_FORMAT[segment.ugc_format], flags))
+    writer.pack('<q', _pack_time(segment.base_date))
+
+    if flags & _HAS_FIELDS:
+        writer.text(','.join(sorted(segment.fields)))
+
+    if flags & _HAS_STATES:
+        writer.pack('<H', len(segment.ugc_groups))
+        for (state, letter), codes in segment.ugc_groups.items():
+            writer.pack('<2s1sH', _pack_str(state, 2), _pack_str(letter, 1),
+                        len(codes))
+            writer.write(np.asarray(codes, dtype='<u2').tobytes())
+
+    writer.pack('<H', len(segment.vtec))
+    for vtec_code in segment.vtec:
+        _write_vtec(writer, vtec_code)
+
+    if flags & _HAS_HEADLINE:
+        writer.text(segment.headline)
+
+    if flags & _HAS_MND_ISSUANCE_TIME:
+        writer.pack('<q', _pack_time(segment.mnd_issuance_time))
+
+    if flags & _HAS_LAT_LON:
+        writer.coordinates(segment.polygon)
+        if len(segment.polygon) > 0:
+            bbox = segment.bbox
+            centroid = segment.centroid
+            writer.pack('<7d', bbox[0], bbox[1], bbox[2], bbox[3],
+                        segment.area, centroid[0], centroid[1])
+
+    if flags & _HAS_TIME_MOTION_LOCATION:
+        tml = segment.time_motion_location
+        if tml is None:
+            writer.pack('<B', 0)
+        else:
+            writer.pack('<BqHH', 1, _pack_time(tml.time), tml.direction,
+                        tml.speed)
+            writer.coordinates(tml.location)
+
+    if raw:
+        writer.bytes(segment.raw)
+
+
+def _read_segment(reader):
+    expiration_date, ugc_format, flags = reader.unpack(_SEGMENT_STRUCT)
+    base_date, = reader.unpack('<q')
+
+    segment = Segment.__new__(Segment)
+    segment.raw = None
+    segment._clean_txt = bool(flags & _CLEAN_TXT)
+    segment.base_date = _unpack_time(base_date)
+    segment.expiration_date = _unpack_time(expiration_date)
+    segment.ugc_format = _UGC_FORMAT_NAME[ugc_format]
+
+    if flags & _HAS_FIELDS:
+        segment.fields = frozenset(reader.text().split(','))
+    else:
+        segment.fields = None
+
+    if flags & _HAS_STATES:
+        groups = {}
+        ngroups, = reader.unpack('<H')
+        for _ in range(ngroups):
+            state, letter, ncodes = reader.unpack('<2s1sH')
+            codes = np.frombuffer(reader.buf, dtype='<u2', count=ncodes,
+                                  offset=reader.pos)
+            reader.pos += 2 * ncodes
+            key = (_unpack_str(state), _unpack_str(letter))
+            groups[key] = codes.tolist()
+        segment._set_ugc_groups(groups)
+    else:
+        segment.states = None
+        segment.ugc_groups = None
+
+    nvtec, = reader.unpack('<H')
+    segment.vtec = [_read_vtec(reader) for _ in range(nvtec)]
+
+    if flags & _HAS_HEADLINE:
+        segment.headline = reader.text()
+
+    if flags & _HAS_MND_ISSUANCE_TIME:
+        segment.mnd_issuance_time = _unpack_time(reader.unpack('<q')[0])
+
+    if flags & _HAS_LAT_LON:
+        segment.polygon = reader.coordinates()
+        if len(segment.polygon) > 0:
+            values = reader.unpack('<7d')
+            segment.bbox = values[0:4]
+            segment.area = values[4]
+            segment.centroid = values[5:7]
+        else:
+            segment.bbox = None
+            segment.area = None
+            segment.centroid = None
+
+    if flags & _HAS_TIME_MOTION_LOCATION:
+        present, = reader.unpack('<B')
+        if present:
+            tml_time, direction, speed = reader.unpack('<qHH')
+            location = reader.coordinates()
+            tml = TimeMotionLocation(time=_unpack_time(tml_time),
+                                     direction=direction, speed=speed,
+                                     location=location)
+            segment.time_motion_location = tml
+        else:
+            segment.time_motion_location = None
+
+    if flags & _SEGMENT_HAS_RAW:
+        segment.raw = reader.bytes()
+
+    return segment
+
+
+def _write_product(writer, product, raw):
+    offset = -1 if product.offset is None else product.offset
+    flags = _HAS_RAW if raw else 0
+    writer.write(_PRODUCT_STRUCT.pack(
+        _pack_str(product.wmo_dtype, 2), _pack_str(product.wmo_geog, 2),
+        product.wmo_code, _pack_str(product.wmo_office, 4),
+        _pack_str(product.wmo_retrans, 3), _pack_str(product.awips_product, 3),
+        _pack_str(product.awips_location_id, 3),
+        _pack_time(product.wmo_issuance_time), _pack_time(product.base_date),
+        offset, flags))
+    writer.text(product.filename)
+    if raw:
+        writer.bytes(product.raw)
+
+    writer.pack('<I', len(product.segments))
+    for segment in product.segments:
+        _write_segment(writer, segment, raw)
+
+
+def _read_product(reader):
+    (wmo_dtype, wmo_geog, wmo_code, wmo_office, wmo_retrans, awips_product,
+     awips_location_id, wmo_issuance_time, base_date, offset,
+     flags) = reader.unpack(_PRODUCT_STRUCT)
+
+    product = Product.__new__(Product)
+    product.wmo_dtype = _unpack_str(wmo_dtype)
+    product.wmo_geog = _unpack_str(wmo_geog)
+    product.wmo_code = wmo_code
+    product.wmo_office = _unpack_str(wmo_office)
+    product.wmo_retrans = _unpack_str(wmo_retrans)
+    product.awips_product = _unpack_str(awips_product)
+    product.awips_location_id = _unpack_str(awips_location_id)
+    product.wmo_issuance_time = _unpack_time(wmo_issuance_time)
+    product.base_date = _unpack_time(base_date)
+    product.offset = None if offset < 0 else offset
+    product.filename = reader.text()
+    product.ingest_times = {}
+    product.raw = reader.bytes() if flags & _HAS_RAW else None
+
+    nsegments, = reader.unpack('<I')
+    product.segments = [_read_segment(reader) for _ in range(nsegments)]
+    return product
+
+
+def encode_vtec(vtec_code):
+    """
+    Encode a VTEC code.
+
+    Returns
+    -------
+    bytes
+    """
+    writer = _Writer()
+    _write_header(writer, _VTEC)
+    _write_vtec(writer, vtec_code)
+    return writer.getvalue()
+
+
+def decode_vtec(buf):
+    """
+    Decode a VTEC code from bytes produced by encode_vtec.
+    """
+    reader = _Reader(buf)
+    _read_header(reader, _VTEC)
+    return _read_vtec(reader)
+
+
+def encode_segment(segment, raw=False):
+    """
+    Encode a segment.
+
+    Parameters
+    ----------
+    segment : Segment
+        Parsed segment
+    raw : bool
+        If True, include the raw text.
+
+    Returns
+    -------
+    bytes
+    """
+    writer = _Writer()
+    _write_header(writer, _SEGMENT)
+    _write_segment(writer, segment, raw)
+    return writer.getvalue()
+
+
+def decode_segment(buf):
+    """
+    Decode a segment from bytes produced by encode_segment.  The coordinate
+    arrays share memory with the buffer.
+    """
+    reader = _Reader(buf)
+    _read_header(reader, _SEGMENT)
+    return _read_segment(reader)
+
+
+def encode_product(product, raw=False):
+    """
+    Encode a product and all of its segments.
+
+    Parameters
+    ----------
+    product : Product
+        Parsed product
+    raw : bool
+        If True, include the raw text of the product and of each segment.
+
+    Returns
+    -------
+    bytes
+    """
+    writer = _Writer()
+    _write_header(writer, _PRODUCT)
+    _write_product(writer, product, raw)
+    return writer.getvalue()
+
+
+def decode_product(buf):
+    """
+    Decode a product from bytes produced by encode_product.  The coordinate
+    arrays share memory with the buffer.
+    """
+    reader = _Reader(buf)
+    _read_header(reader, _PRODUCT)
+    return _read_product(reader)
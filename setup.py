@@ -9,7 +9,10 @@ kwargs = {'name': 'hazards',
           'author':  'John Evans',
           'description': 'Tools for interrogating NWS hazards messages',
           'entry_points':  {
-              'console_scripts': ['hzparse=hazards.command_line:hzparse'],
+              'console_scripts': ['hzparse=hazards.command_line:hzparse',
+                                  'hzsynth=hazards.command_line:hzsynth',
+                                  'hzserve=hazards.command_line:hzserve',
+                                  'hzreplay=hazards.command_line:hzreplay'],
           },
           'install_requires': install_requires,
           'packages': ['hazards'],
@@ -1,9 +1,24 @@
+import bz2
+import collections
 import datetime as dt
 from datetime import datetime
+import gc
+import gzip
+import json
+import math
 import os
+import pickle
+import queue
+import shutil
+import struct
+import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import unittest
 import warnings
+import zipfile
 
 if sys.hexversion < 0x03000000:
     import mock
@@ -14,8 +29,29 @@ else:
     from unittest.mock import patch
     from io import StringIO
 
+import numpy as np
+
 import hazards
-from hazards import HazardsFile, fetch_events
+from hazards import HazardsFile, Quarantine, fetch_events
+from hazards.hazards import FieldNotParsedError
+from hazards import geometry
+from hazards.tracker import EventTracker, diff_events, event_key
+from hazards.sharding import ShardError, ShardedAggregator, shard_for
+from hazards import corpus
+from hazards import synthetic
+from hazards import wire
+from hazards import server
+from hazards.store import EventStore
+import hazards.pipeline
+from hazards import latency
+from hazards import archive
+from hazards import replay
+import hazards.export
+from hazards import raster
+from hazards import exposure
+from hazards import stormtrack
+from hazards.ugc import UgcSet
+from hazards.hazards import Product, Segment, TimeMotionLocation, VtecCode
 from hazards.command_line import DirectoryNotFoundException
 
 from . import fixtures
@@ -76,6 +112,105 @@ class TestHzparser(unittest.TestCase):
         expected = 'File:  2015062721.special (130 products)'
         self.assertEqual(actual, expected)
 
+    def test_quarantine(self):
+        """
+        A malformed segment is reported instead of stopping the run.
+        """
+        dirname = os.path.join('tests', 'data', 'severe')
+        with patch('sys.argv', ['', dirname]):
+            with self.assertRaises(KeyError):
+                with patch('sys.stdout', new=StringIO()):
+                    hazards.command_line.hzparse()
+
+        with patch('sys.argv', ['', dirname, '--quarantine']):
+            with patch('sys.stdout', new=StringIO()) as fake_stdout:
+                hazards.command_line.hzparse()
+                actual = fake_stdout.getvalue()
+        self.assertIn('File:  2015062520.severe', actual)
+        self.assertIn('2 quarantined', actual)
+        self.assertIn('       2  KeyError', actual)
+
+    def test_ndjson(self):
+        """
+        One JSON record per segment and VTEC code.
+        """
+        dirname = os.path.join('tests', 'data', 'torn_warn')
+        with patch('sys.argv', ['', dirname, '--format', 'ndjson']):
+            with patch('sys.stdout', new=StringIO()) as fake_stdout:
+                hazards.command_line.hzparse()
+                lines = fake_stdout.getvalue().splitlines()
+        records = [json.loads(line) for line in lines]
+
+        expected = 0
+        for name in os.listdir(dirname):
+            for product in HazardsFile(os.path.join(dirname, name)):
+                for segment in product:
+                    expected += max(len(segment.vtec), 1)
+        self.assertEqual(len(records), expected)
+
+        record = records[0]
+        self.assertEqual(list(record), list(hazards.export.FIELDS))
+        self.assertEqual(record['phenomena'], 'TO')
+        self.assertEqual(len(record['ugc'][0]), 6)
+        self.assertIn(record['ugc'][0][2], 'CZ')
+        self.assertEqual(len(record['polygon'][0]), 2)
+
+    def test_csv_output(self):
+        """
+        CSV written to a file, the quarantine report still goes to stdout.
+        """
+        dirname = os.path.join('tests', 'data', 'severe')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'out.csv')
+        with patch('sys.argv', ['', dirname, '--format', 'csv', '--output',
+                                path, '--quarantine']):
+            with patch('sys.stdout', new=StringIO()) as fake_stdout:
+                hazards.command_line.hzparse()
+                actual = fake_stdout.getvalue()
+        self.assertIn('2 quarantined', actual)
+        self.assertNotIn('File:', actual)
+
+        import csv
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(tuple(rows[0]), hazards.export.FIELDS)
+        polygons = [row['polygon'] for row in rows if row['polygon']]
+        self.assertTrue(len(polygons) > 0)
+        self.assertTrue(polygons[0].startswith('POLYGON(('))
+
+
+class TestStartup(unittest.TestCase):
+    """
+    The command line tools are run many times a day, so importing them must
+    be quick.
+    """
+    # Seconds allowed for importing the hzparse entry point.
+    budget = 0.5
+
+    script = """
+import sys, time
+t0 = time.time()
+import hazards.command_line
+elapsed = time.time() - t0
+heavy = [name for name in ('numpy', 'tarfile', 'zipfile', 'lzma', 'bz2')
+         if name in sys.modules]
+print(elapsed)
+print(','.join(heavy))
+"""
+
+    def test_import_budget(self):
+        output = subprocess.check_output([sys.executable, '-c', self.script])
+        elapsed, heavy = output.decode().splitlines()[-2:]
+        self.assertEqual(heavy, '')
+        self.assertLess(float(elapsed), self.budget)
+
+    def test_lazy_regex(self):
+        regex = hazards.hazards.vtec_regex
+        m = regex.search(b'/O.NEW.KBOU.TO.W.0044.150624T2300Z-150624T2330Z/')
+        self.assertEqual(m.group('office_id'), b'KBOU')
+        self.assertEqual(regex.groupindex['office_id'], 3)
+
 
 class TestSuite(unittest.TestCase):
     """
@@ -584,5 +719,1836 @@ class TestSuite(unittest.TestCase):
         self.assertEqual(hzf[-1].segments[0].ugc_format, 'county')
 
 
+class TestFieldProjection(unittest.TestCase):
+    """
+    Parse only the requested segment attributes.
+    """
+    def test_only_requested_fields(self):
+        path = os.path.join('tests', 'data', 'torn_warn', '2015062423.torn')
+        hzf = HazardsFile(path, fields=['vtec', 'states', 'expiration_date'])
+        segment = hzf[0].segments[0]
+
+        self.assertEqual(segment.vtec[0].office, 'KBOU')
+        self.assertEqual(segment.states, {'CO': [5, 31]})
+        self.assertEqual(segment.expiration_date,
+                         dt.datetime(2015, 6, 24, 23, 30, 0))
+
+        for name in ['headline', 'polygon', 'wkt', 'time_motion_location',
+                     'mnd_issuance_time']:
+            with self.assertRaises(FieldNotParsedError):
+                getattr(segment, name)
+
+    def test_partial_content_block(self):
+        """
+        Requesting the polygon should not drag in the TML.
+        """
+        path = os.path.join('tests', 'data', 'torn_warn', '2015062423.torn')
+        hzf = HazardsFile(path, fields=['polygon'])
+        segment = hzf[0].segments[0]
+        self.assertEqual(segment.polygon,
+                         [(105.02, 39.61), (105, 39.74), (104.61, 39.74),
+                          (104.68, 39.6)])
+        with self.assertRaises(FieldNotParsedError):
+            segment.time_motion_location
+
+    def test_unknown_field(self):
+        path = os.path.join('tests', 'data', 'torn_warn', '2015062423.torn')
+        with self.assertRaises(ValueError):
+            HazardsFile(path, fields=['vtec', 'not_a_field'])
+
+    def test_fetch_events(self):
+        """
+        Event assembly must work with a projection.
+        """
+        dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                               'watch_warn', 'svrlcl')
+        events = fetch_events(dirname, fields=['states'])
+        self.assertEqual(len(events), 17)
+        with self.assertRaises(FieldNotParsedError):
+            events[0][0].headline
+
+
+class TestGeometry(unittest.TestCase):
+    """
+    Bulk geometry export
+    """
+    def setUp(self):
+        dirname = os.path.join('tests', 'data', 'fflood', 'warn')
+        self.events = fetch_events(dirname)
+
+    def test_geojson(self):
+        f = StringIO()
+        geometry.write_geojson(self.events, f)
+        collection = json.loads(f.getvalue())
+
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        self.assertEqual(len(collection['features']), 4)
+
+        # RFC 7946 has longitudes negative west, and counter-clockwise
+        # exterior rings.
+        feature = collection['features'][0]
+        ring = np.array(feature['geometry']['coordinates'][0])
+        self.assertEqual(len(ring), 17)
+        self.assertEqual(ring[0].tolist(), [-84.36, 40.99])
+        self.assertEqual(ring[-1].tolist(), ring[0].tolist())
+        self.assertTrue(np.all(ring[:, 0] < 0))
+        x, y = ring[:, 0], ring[:, 1]
+        self.assertTrue((x[:-1] * y[1:] - x[1:] * y[:-1]).sum() > 0)
+        self.assertEqual(feature['properties']['office'], 'KIWX')
+        self.assertEqual(feature['properties']['phenomena'], 'FA')
+        self.assertEqual(feature['properties']['action'], 'NEW')
+        self.assertEqual(feature['properties']['expiration_date'],
+                         '2015-06-27T16:00:00')
+
+        # As stored, if asked for.
+        f = StringIO()
+        geometry.write_geojson(self.events, f, positive_west=True)
+        collection = json.loads(f.getvalue())
+        ring = collection['features'][0]['geometry']['coordinates'][0]
+        self.assertEqual(ring[:2], [[84.36, 40.99], [84.4, 40.99]])
+
+    def test_wkb(self):
+        records = list(geometry.iter_wkb(self.events))
+        self.assertEqual(len(records), 4)
+
+        wkb = records[0][2]
+        byteorder, gtype, nrings, npoints = struct.unpack('<BIII', wkb[:13])
+        self.assertEqual((byteorder, gtype, nrings, npoints), (1, 3, 1, 17))
+        coords = struct.unpack('<34d', wkb[13:])
+        self.assertEqual(coords[:4], (84.36, 40.99, 84.4, 40.99))
+        self.assertEqual(coords[-2:], coords[:2])
+
+        wkb = geometry.polygon_wkb(self.events[0][0].polygon, byteorder='>')
+        self.assertEqual(struct.unpack('>BIII', wkb[:13]), (0, 3, 1, 17))
+
+    def test_polygon_metrics(self):
+        # Unit square, counter-clockwise.
+        polygon = [(0, 0), (1, 0), (1, 1), (0, 1)]
+        bbox, area, centroid = geometry.polygon_metrics(polygon)
+        self.assertEqual(bbox, (0, 0, 1, 1))
+        self.assertEqual(area, 1.0)
+        self.assertEqual(centroid, (0.5, 0.5))
+
+        # Clockwise gives a negative area.
+        bbox, area, centroid = geometry.polygon_metrics(polygon[::-1])
+        self.assertEqual(area, -1.0)
+        self.assertEqual(centroid, (0.5, 0.5))
+
+    def test_point_in_polygon(self):
+        # Concave, the notch is at the top middle.
+        polygon = [(0, 0), (3, 0), (3, 2), (2, 2), (1.5, 1), (1, 2), (0, 2)]
+        self.assertTrue(geometry.point_in_polygon(polygon, 0.5, 1.5))
+        self.assertTrue(geometry.point_in_polygon(polygon[::-1], 2.5, 1.5))
+        self.assertFalse(geometry.point_in_polygon(polygon, 1.5, 1.5))
+        self.assertFalse(geometry.point_in_polygon(polygon, 4, 1))
+
+        x, y = np.meshgrid([0.5, 1.5, 2.5, 4], [0.5, 1.5])
+        np.testing.assert_array_equal(
+            geometry.points_in_polygon(polygon, x, y),
+            [[True, True, True, False], [True, False, True, False]])
+
+    def test_segment_metrics(self):
+        path = os.path.join('tests', 'data', 'torn_warn', '2015062423.torn')
+        hzf = HazardsFile(path)
+        segment = hzf[0].segments[0]
+        self.assertEqual(segment.bbox, (104.61, 39.6, 105.02, 39.74))
+        bbox, area, centroid = geometry.polygon_metrics(segment.polygon)
+        self.assertEqual(segment.area, area)
+        self.assertEqual(segment.centroid, centroid)
+        self.assertTrue(segment.bbox[0] < segment.centroid[0] < segment.bbox[2])
+        self.assertTrue(segment.bbox[1] < segment.centroid[1] < segment.bbox[3])
+
+        # No polygon, no metrics.
+        path = os.path.join('tests', 'data', 'noprcp', '2015062413.noprcp')
+        hzf = HazardsFile(path)
+        self.assertIsNone(hzf[0].segments[0].bbox)
+        self.assertIsNone(hzf[0].segments[0].area)
+
+    def test_event_metrics(self):
+        event = self.events[0]
+        self.assertEqual(event.bbox,
+                         geometry.union_bbox([b.bbox for b in event]))
+        changes = event.area_changes()
+        self.assertEqual(len(changes), 1)
+        self.assertAlmostEqual(changes[0],
+                               abs(event[1].area) - abs(event[0].area))
+
+    def test_wkt_not_parsed(self):
+        path = os.path.join('tests', 'data', 'torn_warn', '2015062423.torn')
+        hzf = HazardsFile(path, fields=['vtec'])
+        with self.assertRaises(FieldNotParsedError):
+            hzf[0].segments[0].wkt
+
+
+class TestEventTracker(unittest.TestCase):
+    """
+    Lifecycle of events driven by the VTEC action codes.
+    """
+    def setUp(self):
+        dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                               'watch_warn', 'svrlcl')
+        self.paths = [os.path.join(dirname, fname)
+                      for fname in sorted(os.listdir(dirname))
+                      if not fname.startswith('.')]
+
+    def test_retire_to_archive(self):
+        archive = []
+        tracker = EventTracker(archive=archive.append)
+        for path in self.paths:
+            tracker.add_file(HazardsFile(path))
+
+        # Every watch was eventually cancelled or expired.
+        self.assertEqual(len(tracker), 0)
+        self.assertEqual(len(archive), 17)
+        for event in archive:
+            self.assertTrue(event.closed)
+            self.assertEqual(len(event), 1)
+
+        event = [x for x in archive if x.vtec_code.office == 'KDDC'][0]
+        self.assertEqual(event.state, 'expired')
+        self.assertEqual([item.action for item in event.history],
+                         ['NEW', 'EXA', 'CON', 'EXA', 'CON', 'CAN', 'CON',
+                          'EXP'])
+        self.assertEqual(event.expiration_date,
+                         dt.datetime(2015, 7, 20, 5, 0, 0))
+
+    def test_expire(self):
+        archive = []
+        tracker = EventTracker(archive=archive.append, max_bulletins=None)
+        tracker.add_file(HazardsFile(self.paths[0]))
+        self.assertTrue(len(tracker) > 0)
+        nevents = len(tracker)
+
+        # Nothing has expired yet.
+        self.assertEqual(tracker.expire(dt.datetime(2015, 7, 19, 19, 0, 0)),
+                         [])
+
+        retired = tracker.expire(dt.datetime(2015, 7, 21, 0, 0, 0))
+        self.assertEqual(len(retired), nevents)
+        self.assertEqual(len(tracker), 0)
+        self.assertEqual(archive, retired)
+        for event in retired:
+            self.assertEqual(event.state, 'expired')
+
+    def test_partial_cancellation(self):
+        """
+        A product cancelling some areas while continuing others keeps the
+        event open.
+        """
+        path = os.path.join('tests', 'data', 'torn_warn', '2015062423.torn')
+        hzf = HazardsFile(path)
+        event = hazards.hazards.Event(hzf[0].segments[0].vtec[0],
+                                      hzf[0].segments[0])
+        self.assertEqual(event.state, 'new')
+
+        event.transition(['CAN', 'CON'])
+        self.assertEqual(event.state, 'continued')
+        self.assertFalse(event.closed)
+
+        event.transition(['CAN', 'CAN'])
+        self.assertEqual(event.state, 'cancelled')
+        self.assertTrue(event.closed)
+
+    def test_incomplete_index(self):
+        """
+        An EventIndex that leaves out a hook cannot be made at all.
+        """
+        class Incomplete(hazards.tracker.EventIndex):
+            def _value(self, bulletin):
+                return bulletin.polygon
+
+            def _set(self, key, value):
+                pass
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+
+class TestShardedAggregator(unittest.TestCase):
+    """
+    Aggregation across worker processes
+    """
+    def test_same_as_single_tracker(self):
+        dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                               'watch_warn', 'svrlcl')
+        paths = [os.path.join(dirname, fname)
+                 for fname in sorted(os.listdir(dirname))
+                 if not fname.startswith('.')]
+
+        # Stop part way through so that some events are still live.
+        hzfs = [HazardsFile(path) for path in paths[:15]]
+
+        archive = []
+        tracker = EventTracker(archive=archive.append)
+        for hzf in hzfs:
+            tracker.add_file(hzf)
+
+        with ShardedAggregator(nshards=3) as aggregator:
+            for hzf in hzfs:
+                aggregator.add_file(hzf)
+
+            self.assertEqual(len(aggregator), len(tracker))
+            expected = sorted(event.vtec_code.code for event in tracker)
+            actual = sorted(event.vtec_code.code
+                            for event in aggregator.events())
+            self.assertEqual(actual, expected)
+
+            expected = sorted(event.vtec_code.code for event in archive)
+            actual = sorted(event.vtec_code.code
+                            for event in aggregator.retired())
+            self.assertEqual(actual, expected)
+
+            # An office query only needs one shard.
+            office = list(tracker)[0].vtec_code.office
+            events = aggregator.events(office=office)
+            self.assertTrue(len(events) > 0)
+            for event in events:
+                self.assertEqual(event.vtec_code.office, office)
+
+            aggregator.expire(dt.datetime(2015, 7, 25, 0, 0, 0))
+            self.assertEqual(len(aggregator), 0)
+            self.assertEqual(len(aggregator.retired()), len(tracker))
+
+    def test_max_retired(self):
+        dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                               'watch_warn', 'svrlcl')
+        with ShardedAggregator(nshards=1, max_retired=2) as aggregator:
+            for entry in corpus.select_entries(
+                    corpus.iter_entries(dirname)):
+                aggregator.add_file(HazardsFile(entry.name))
+            aggregator.expire(dt.datetime(2030, 1, 1, 0, 0, 0))
+            self.assertEqual(len(aggregator.retired()), 2)
+            self.assertTrue(aggregator.dropped > 0)
+            self.assertEqual(aggregator.retired(), [])
+
+    def test_dead_shard(self):
+        aggregator = ShardedAggregator(nshards=2)
+        try:
+            aggregator._processes[1].terminate()
+            aggregator._processes[1].join()
+            with self.assertRaises(ShardError):
+                len(aggregator)
+        finally:
+            aggregator.close()
+
+    def test_shard_for(self):
+        self.assertEqual(shard_for('KDDC', 1), 0)
+        self.assertEqual(shard_for('KDDC', 4), shard_for('KDDC', 4))
+        self.assertTrue(0 <= shard_for('KPBZ', 4) < 4)
+
+
+class TestCorpus(unittest.TestCase):
+    """
+    Read compressed files and archives in place.
+    """
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                                   'fflood', 'statment')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _compress(self, fname, opener, suffix):
+        src = os.path.join(self.srcdir, fname)
+        dest = os.path.join(self.tempdir, fname + suffix)
+        with open(src, 'rb') as fin:
+            with opener(dest, 'wb') as fout:
+                fout.write(fin.read())
+        return dest
+
+    def test_compressed_files(self):
+        fname = '2015072313.sttmnt'
+        expected = HazardsFile(os.path.join(self.srcdir, fname))
+
+        openers = [(gzip.open, '.gz'), (bz2.BZ2File, '.bz2')]
+        try:
+            import lzma
+            openers.append((lzma.open, '.xz'))
+        except ImportError:
+            pass
+        for opener, suffix in openers:
+            path = self._compress(fname, opener, suffix)
+            hzf = HazardsFile(path)
+            self.assertEqual(len(hzf), len(expected))
+            self.assertEqual(hzf[0].segments[0].base_date,
+                             dt.datetime(2015, 7, 23, 13, 0, 0))
+            self.assertEqual(hzf[-1].segments[0].states,
+                             expected[-1].segments[0].states)
+
+    def test_tar_archive(self):
+        """
+        Archive members are read in place, nested directories included.
+        """
+        path = os.path.join(self.tempdir, '20150723.tar.gz')
+        gzpath = self._compress('2015072314.sttmnt', gzip.open, '.gz')
+        with tarfile.open(path, 'w:gz') as tar:
+            tar.add(os.path.join(self.srcdir, '2015072313.sttmnt'),
+                    arcname='2015/2015072313.sttmnt')
+            tar.add(gzpath, arcname='2015/2015072314.sttmnt.gz')
+        os.remove(gzpath)
+
+        entries = list(corpus.iter_entries(self.tempdir))
+        self.assertEqual([os.path.basename(entry.name) for entry in entries],
+                         ['2015072313.sttmnt', '2015072314.sttmnt.gz'])
+
+        with entries[1].open() as fileobj:
+            hzf = HazardsFile(entries[1].name, fileobj=fileobj)
+        self.assertEqual(hzf[0].segments[0].base_date,
+                         dt.datetime(2015, 7, 23, 14, 0, 0))
+        expected = HazardsFile(os.path.join(self.srcdir,
+                                            '2015072314.sttmnt'))
+        self.assertEqual(len(hzf), len(expected))
+
+    def test_tar_opened_once(self):
+        """
+        A compressed archive is opened once to read all of its members.
+        """
+        path = os.path.join(self.tempdir, '20150723.tar.gz')
+        with tarfile.open(path, 'w:gz') as tar:
+            for hour in range(10, 16):
+                tar.add(os.path.join(self.srcdir, '2015072313.sttmnt'),
+                        arcname='201507231{}.sttmnt'.format(hour % 10))
+
+        with patch('hazards.corpus._open_tar',
+                   wraps=corpus._open_tar) as opener:
+            for entry in corpus.iter_entries(path):
+                self.assertTrue(len(corpus.read_bulletin(entry)) > 0)
+            self.assertEqual(opener.call_count, 1)
+
+            # Entries read after the listing share one reopened archive.
+            opener.reset_mock()
+            entries = corpus.select_entries(corpus.iter_entries(path))
+            self.assertEqual(len(entries), 6)
+            for entry in entries:
+                self.assertTrue(len(corpus.read_bulletin(entry)) > 0)
+            self.assertEqual(opener.call_count, 2)
+
+    def test_no_open_files(self):
+        """
+        Compressed files and archives are closed once read.
+        """
+        gzpath = self._compress('2015072314.sttmnt', gzip.open, '.gz')
+        bzpath = self._compress('2015072313.sttmnt', bz2.BZ2File, '.bz2')
+        with tarfile.open(os.path.join(self.tempdir, 'a.tar'), 'w') as tar:
+            tar.add(gzpath, arcname='2015072314.sttmnt.gz')
+        with zipfile.ZipFile(os.path.join(self.tempdir, 'b.zip'),
+                             'w') as zf:
+            zf.write(bzpath, arcname='2015072313.sttmnt.bz2')
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+            corpus.open_bulletin(gzpath).close()
+            entries = list(corpus.iter_entries(self.tempdir))
+            self.assertEqual(len(entries), 4)
+            for entry in entries:
+                self.assertTrue(len(corpus.read_bulletin(entry)) > 0)
+            fetch_events(self.tempdir)
+            del entries
+            gc.collect()
+        self.assertEqual([w for w in caught
+                          if issubclass(w.category, ResourceWarning)], [])
+
+    def test_fetch_events_recursive(self):
+        subdir = os.path.join(self.tempdir, 'sub')
+        os.mkdir(subdir)
+        dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                               'watch_warn', 'svrlcl')
+        for fname in os.listdir(dirname):
+            if not fname.startswith('.'):
+                with open(os.path.join(dirname, fname), 'rb') as fin:
+                    with gzip.open(os.path.join(subdir, fname + '.gz'),
+                                   'wb') as fout:
+                        fout.write(fin.read())
+
+        self.assertEqual(len(fetch_events(self.tempdir)), 0)
+        events = fetch_events(self.tempdir, recursive=True)
+        self.assertEqual(len(events), 17)
+
+
+class TestBytesParsing(unittest.TestCase):
+    """
+    Products are parsed as bytes and decoded on demand.
+    """
+    def test_raw_and_decoded(self):
+        path = os.path.join('tests', 'data', 'fflood', 'warn',
+                            '2015062713.warn')
+        hzf = HazardsFile(path)
+        product = hzf[0]
+        segment = product.segments[0]
+
+        # Line endings are translated without decoding.
+        self.assertTrue(isinstance(product.raw, bytes))
+        self.assertNotIn(b'\r', product.raw)
+        self.assertTrue(isinstance(segment.raw, bytes))
+
+        self.assertEqual(segment.txt, fixtures.fflood_txt)
+        self.assertEqual(product.wmo_office, 'KIWX')
+        self.assertEqual(segment.vtec[0].code,
+                         '/O.NEW.KIWX.FA.W.0015.150627T1307Z-150627T1600Z')
+        self.assertEqual(list(segment.states.keys()), ['IN', 'MI', 'OH'])
+
+    def test_text_input(self):
+        """
+        Products can still be constructed from text.
+        """
+        path = os.path.join('tests', 'data', 'fflood', 'warn',
+                            '2015062713.warn')
+        hzf = HazardsFile(path)
+        product = hazards.hazards.Product(hzf[0].txt, hzf[0].base_date)
+        self.assertEqual(product.segments[0].txt, fixtures.fflood_txt)
+        self.assertEqual(product.segments[0].polygon,
+                         hzf[0].segments[0].polygon)
+
+
+class TestFileSelection(unittest.TestCase):
+    """
+    Select files by the dates in their names.
+    """
+    def setUp(self):
+        self.dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                                    'watch_warn', 'svrlcl')
+
+    def _names(self, **kwargs):
+        entries = corpus.iter_entries(self.dirname)
+        return [os.path.basename(entry.name)
+                for entry in corpus.select_entries(entries, **kwargs)]
+
+    def test_numlast(self):
+        self.assertEqual(self._names(numlast=3),
+                         ['2015072404.svrlcl', '2015072405.svrlcl',
+                          '2015072407.svrlcl'])
+
+    def test_since_until(self):
+        names = self._names(since=dt.datetime(2015, 7, 24, 0, 0, 0))
+        self.assertEqual(names, ['2015072400.svrlcl', '2015072401.svrlcl',
+                                 '2015072402.svrlcl', '2015072403.svrlcl',
+                                 '2015072404.svrlcl', '2015072405.svrlcl',
+                                 '2015072407.svrlcl'])
+
+        names = self._names(since=dt.datetime(2015, 7, 24, 0, 0, 0),
+                            until=dt.datetime(2015, 7, 24, 3, 0, 0),
+                            numlast=2)
+        self.assertEqual(names, ['2015072401.svrlcl', '2015072402.svrlcl'])
+
+    def test_fetch_events(self):
+        events = fetch_events(self.dirname,
+                              since=dt.datetime(2015, 7, 21, 0, 0, 0),
+                              until=dt.datetime(2015, 7, 22, 0, 0, 0))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].vtec_code.office, 'KPAH')
+
+        events = fetch_events(self.dirname, numlast=1)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].vtec_code.office, 'KFGF')
+
+
+class TestSynthetic(unittest.TestCase):
+    """
+    Generate synthetic corpora and parse them back.
+    """
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.start = dt.datetime(2015, 7, 19, 20, 0, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_parse(self):
+        generator = synthetic.generate_corpus(self.dirname, self.start, 12,
+                                              seed=1, events_per_hour=5)
+        names = sorted(os.listdir(self.dirname))
+        self.assertEqual(len(names), 12)
+        self.assertEqual(names[0], '2015071920.synth')
+
+        nproducts = nsegments = 0
+        retired = []
+        tracker = EventTracker(archive=retired.append)
+        for name in names:
+            hzf = HazardsFile(os.path.join(self.dirname, name))
+            nproducts += len(hzf)
+            for product in hzf:
+                for segment in product.segments:
+                    nsegments += 1
+                    self.assertTrue(len(segment.vtec) > 0)
+                    self.assertTrue(len(segment.states) > 0)
+                    self.assertIsNotNone(segment.mnd_issuance_time)
+            tracker.add_file(hzf)
+
+        self.assertEqual(nproducts, generator.nproducts)
+        self.assertEqual(nsegments, generator.nsegments)
+        self.assertTrue(nsegments > nproducts)
+
+        states = set(event.state for event in retired)
+        self.assertEqual(states, set(['expired', 'upgraded']))
+        self.assertEqual(len(retired) + len(tracker), generator.nevents)
+
+        for event in retired:
+            actions = [item.action for item in event.history]
+            self.assertEqual(actions[0], 'NEW')
+            self.assertTrue(set(actions[1:-1]) <= set(['CON', 'CAN']))
+            if event.vtec_code.phenomena in ('SV', 'TO', 'FF'):
+                if event.vtec_code.significance == 'W':
+                    self.assertTrue(len(event[-1].polygon) >= 4)
+
+    def test_seed(self):
+        generator1 = synthetic.BulletinGenerator(seed=3, events_per_hour=5)
+        generator2 = synthetic.BulletinGenerator(seed=3, events_per_hour=5)
+        for (hour1, products1), (hour2, products2) in zip(
+                generator1.hours(self.start, 6),
+                generator2.hours(self.start, 6)):
+            self.assertEqual(hour1, hour2)
+            self.assertEqual(products1, products2)
+
+        for product in products1:
+            self.assertTrue(product.startswith(b'\x01\r\r\n'))
+            self.assertTrue(product.endswith(b'\r\r\n\x03'))
+
+    def test_ugc_ranges(self):
+        lines = synthetic._ugc_lines('PA', 'Z', [7, 8, 9, 14, 15],
+                                     dt.datetime(2015, 7, 20, 5, 0, 0))
+        self.assertEqual(lines, ['PAZ007>009-014-015-200500-'])
+
+
+class TestQuarantine(unittest.TestCase):
+    """
+    Record and skip malformed products and segments.
+    """
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        src = os.path.join('tests', 'data', 'noaaport', 'nwx', 'watch_warn',
+                           'svrlcl', '2015071920.svrlcl')
+        with open(src, 'rb') as f:
+            products = f.read().split(b'\x03\x01')
+        self.nproducts = len(products)
+
+        # Slip a product without a WMO heading in between the others.
+        products.insert(1, b'\r\r\nGARBAGE\r\r\n')
+        self.raw = b'\x03\x01'.join(products)
+        self.path = os.path.join(self.dirname, '2015071920.svrlcl')
+        with open(self.path, 'wb') as f:
+            f.write(self.raw)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_product(self):
+        with self.assertRaises(hazards.hazards.InvalidProductException):
+            HazardsFile(self.path)
+
+        quarantine = Quarantine()
+        hzf = HazardsFile(self.path, quarantine=quarantine)
+        self.assertEqual(len(hzf), self.nproducts)
+        self.assertEqual(len(quarantine), 1)
+        self.assertEqual(quarantine.counts['InvalidProductException'], 1)
+
+        record = quarantine.records[0]
+        self.assertEqual(record.filename, self.path)
+        self.assertIsNone(record.segment)
+        self.assertEqual(record.error, 'InvalidProductException')
+        garbage = self.raw[record.offset:]
+        self.assertTrue(garbage.startswith(b'\r\r\nGARBAGE'))
+        self.assertEqual(self.raw[record.offset - 1:record.offset], b'\x01')
+
+    def test_segment(self):
+        # Two products have a segment with a "GMT" issuance time, which is
+        # not understood.
+        path = os.path.join('tests', 'data', 'severe', '2015062520.severe')
+        quarantine = Quarantine()
+        hzf = HazardsFile(path, quarantine=quarantine)
+        self.assertEqual(quarantine.counts, {'KeyError': 2})
+        self.assertEqual([record.segment for record in quarantine], [0, 0])
+        self.assertTrue(len(hzf) > 0)
+
+    def test_fetch_events(self):
+        quarantine = Quarantine(max_records=0)
+        events = fetch_events(self.dirname, quarantine=quarantine)
+        self.assertTrue(len(events) > 0)
+        self.assertEqual(len(quarantine), 1)
+        self.assertEqual(quarantine.records, [])
+        self.assertEqual(quarantine.report(),
+                         '1 quarantined\n       1  InvalidProductException')
+
+
+class TestWireFormat(unittest.TestCase):
+    """
+    Compact binary encoding of parsed bulletins.
+    """
+    def setUp(self):
+        self.path = os.path.join('tests', 'data', 'torn_warn',
+                                 '2015062501.torn')
+        self.hzf = HazardsFile(self.path)
+
+    def test_product(self):
+        for product in self.hzf:
+            buf = product.encode()
+            self.assertTrue(len(buf) < len(pickle.dumps(product)) / 4)
+
+            decoded = Product.decode(buf)
+            self.assertIsNone(decoded.raw)
+            for name in ('wmo_dtype', 'wmo_geog', 'wmo_code', 'wmo_office',
+                         'wmo_retrans', 'wmo_issuance_time', 'awips_product',
+                         'awips_location_id', 'base_date', 'filename',
+                         'offset'):
+                self.assertEqual(getattr(decoded, name),
+                                 getattr(product, name))
+
+            self.assertEqual(len(decoded), len(product))
+            for expected, actual in zip(product.segments, decoded.segments):
+                for name in ('expiration_date', 'states', 'ugc_groups',
+                             'ugc_format', 'headline', 'mnd_issuance_time',
+                             'area', 'wkt'):
+                    self.assertEqual(getattr(actual, name),
+                                     getattr(expected, name))
+                self.assertEqual([code.code for code in actual.vtec],
+                                 [code.code for code in expected.vtec])
+                self.assertEqual([tuple(point) for point in actual.polygon],
+                                 expected.polygon)
+
+    def test_zero_copy(self):
+        segment = self.hzf[0].segments[0]
+        self.assertTrue(len(segment.polygon) > 0)
+
+        buf = bytearray(segment.encode())
+        decoded = Segment.decode(buf)
+        self.assertEqual(decoded.polygon.shape, (len(segment.polygon), 2))
+        self.assertEqual(decoded.time_motion_location.direction,
+                         segment.time_motion_location.direction)
+
+        # The coordinates are views on the buffer.
+        lon = decoded.polygon[0, 0]
+        offset = bytes(buf).index(struct.pack('<d', lon))
+        buf[offset:offset + 8] = struct.pack('<d', 1.5)
+        self.assertEqual(decoded.polygon[0, 0], 1.5)
+
+    def test_raw(self):
+        product = self.hzf[0]
+        decoded = Product.decode(product.encode(raw=True))
+        self.assertEqual(decoded.raw, product.raw)
+        self.assertEqual(decoded.segments[0].txt, product.segments[0].txt)
+
+        decoded = Product.decode(product.encode())
+        self.assertIsNone(decoded.segments[0].txt)
+
+    def test_vtec(self):
+        vtec_code = self.hzf[0].segments[0].vtec[0]
+        buf = vtec_code.encode()
+        self.assertEqual(len(buf), 4 + 29)
+        self.assertEqual(VtecCode.decode(buf).code, vtec_code.code)
+
+    def test_fields(self):
+        hzf = HazardsFile(self.path, fields=['vtec', 'polygon'])
+        decoded = Segment.decode(hzf[0].segments[0].encode())
+        self.assertEqual(decoded.fields, frozenset(['vtec', 'polygon']))
+        self.assertEqual(len(decoded.polygon), len(hzf[0].segments[0].polygon))
+        with self.assertRaises(FieldNotParsedError):
+            decoded.headline
+
+    def test_errors(self):
+        buf = self.hzf[0].segments[0].encode()
+        with self.assertRaises(wire.WireFormatError):
+            Product.decode(buf)
+        with self.assertRaises(wire.WireFormatError):
+            Segment.decode(b'HZ\x63S' + buf[4:])
+        with self.assertRaises(wire.WireFormatError):
+            Segment.decode(b'XX')
+
+
+class TestServer(unittest.TestCase):
+    """
+    Incrementally maintained snapshots of the active events, and the HTTP
+    queries against them.
+    """
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.src = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                                'watch_warn', 'svrlcl')
+        self.names = sorted(name for name in os.listdir(self.src)
+                            if not name.startswith('.'))[:15]
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _copy(self, names):
+        for name in names:
+            shutil.copy(os.path.join(self.src, name), self.dirname)
+
+    def test_incremental(self):
+        feed = server.DirectoryFeed(self.dirname, expire=False)
+        self._copy(self.names[:5])
+        self.assertEqual(feed.poll(), 5)
+        first = feed.snapshot
+        self.assertEqual(first.version, 1)
+
+        self._copy(self.names[5:])
+        self.assertEqual(feed.poll(), 10)
+        self.assertEqual(feed.poll(), 0)
+        second = feed.snapshot
+        self.assertEqual(second.version, 2)
+
+        # The earlier snapshot is untouched.
+        self.assertEqual(len(first), 4)
+        self.assertEqual(len(first.query(office='KDDC')), 1)
+        self.assertEqual(second.query(office='KDDC'), [])
+
+        # Same events as ingesting everything at once.
+        tracker = EventTracker()
+        for name in self.names:
+            tracker.add_file(HazardsFile(os.path.join(self.src, name)))
+        expected = sorted(server.event_record(event).key
+                          for event in tracker)
+        self.assertEqual(sorted(second.records), expected)
+
+        office = second.query()[0].office
+        records = second.query(office=office)
+        self.assertEqual(records, [record for record in second.query()
+                                   if record.office == office])
+        ugc = records[0].ugc[0]
+        self.assertIn(records[0], second.query(ugc=ugc, office=office))
+        self.assertEqual(second.query(ugc=ugc, office='XXXX'), [])
+
+    def test_growing_file(self):
+        # Hourly files grow as products arrive, the last one maybe cut off
+        # in the middle.
+        name = '2015072000.svrlcl'
+        with open(os.path.join(self.src, name), 'rb') as f:
+            raw = f.read()
+        cut = raw.index(b'\x03\x01') + 2
+        cut = raw.index(b'\x03\x01', cut) + 100
+        path = os.path.join(self.dirname, name)
+        with open(path, 'wb') as f:
+            f.write(raw[:cut])
+
+        feed = server.DirectoryFeed(self.dirname, expire=False)
+        self.assertEqual(feed.poll(), 1)
+        with open(path, 'ab') as f:
+            f.write(raw[cut:])
+        self.assertEqual(feed.poll(), 1)
+        self.assertEqual(feed.poll(), 0)
+
+        tracker = EventTracker()
+        tracker.add_file(HazardsFile(os.path.join(self.src, name)))
+        expected = sorted(server.event_record(event)
+                          for event in tracker)
+        self.assertEqual(sorted(feed.snapshot.records.values()), expected)
+        self.assertEqual(len(feed.quarantine), 0)
+        counts = [histogram.count for labels, histogram
+                  in feed.latency.histograms().items()
+                  if (labels.since, labels.stage) == ('wmo', 'aggregated')]
+        self.assertEqual(sum(counts), raw.count(b'\x03\x01') + 1)
+
+    def test_bad_file(self):
+        self._copy(self.names[:5])
+        with open(os.path.join(self.dirname, '2015071917.svrlcl.gz'),
+                  'wb') as f:
+            f.write(b'not gzip')
+        feed = server.DirectoryFeed(self.dirname, expire=False)
+        self.assertEqual(feed.poll(), 5)
+        self.assertEqual(len(feed.quarantine), 1)
+        self.assertTrue(len(feed.snapshot) > 0)
+
+        # Not tried again until it changes.
+        self.assertEqual(feed.poll(), 0)
+        self.assertEqual(len(feed.quarantine), 1)
+
+    def test_point(self):
+        feed = server.DirectoryFeed(os.path.join('tests', 'data',
+                                                 'torn_warn'),
+                                    expire=False)
+        feed.poll()
+        snapshot = feed.snapshot
+        record = snapshot.records[('O', 'KBOU', 'TO', 'W', 44)]
+        _, _, centroid = geometry.polygon_metrics(record.polygon)
+        records = snapshot.query(point=centroid)
+        self.assertEqual([item.key for item in records], [record.key])
+        self.assertEqual(snapshot.query(point=(0.5, 0.5)), [])
+
+    def test_expire(self):
+        self._copy(self.names)
+        feed = server.DirectoryFeed(self.dirname)
+        feed.poll(now=dt.datetime(2015, 7, 23, 12, 0, 0))
+        self.assertTrue(len(feed.snapshot) > 0)
+        feed.poll(now=dt.datetime(2030, 1, 1, 0, 0, 0))
+        self.assertEqual(len(feed.snapshot), 0)
+        self.assertEqual(feed.snapshot.query(office='KDDC'), [])
+
+    def test_http(self):
+        self._copy(self.names)
+        torn = os.path.join('tests', 'data', 'torn_warn')
+        for name in os.listdir(torn):
+            shutil.copy(os.path.join(torn, name), self.dirname)
+        feed = server.DirectoryFeed(self.dirname, expire=False)
+        feed.poll()
+        httpd = server.EventServer(feed, address=('127.0.0.1', 0))
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+
+        from urllib.request import urlopen
+        from urllib.error import HTTPError
+        try:
+            status = json.loads(urlopen(base + '/status').read().decode())
+            self.assertEqual(status['events'], len(feed.snapshot))
+            self.assertEqual(status['version'], 1)
+
+            office = feed.snapshot.query()[0].office
+            url = base + '/events?office={}&significance=A'.format(office)
+            body = json.loads(urlopen(url).read().decode())
+            expected = feed.snapshot.query(office=office, significance='A')
+            self.assertEqual(body['count'], len(expected))
+            self.assertEqual(body['events'],
+                             [server.record_json(record)
+                              for record in expected])
+
+            # Longitudes are signed on the wire, negative west.
+            record = [record for record in feed.snapshot.query()
+                      if record.polygon is not None][0]
+            _, _, (x, y) = geometry.polygon_metrics(record.polygon)
+            url = base + '/events?lat={}&lon={}'.format(y, -x)
+            body = json.loads(urlopen(url).read().decode())
+            events = [event for event in body['events']
+                      if event['office'] == record.office and
+                      event['event_tracking_id'] ==
+                      record.event_tracking_id]
+            self.assertEqual(len(events), 1)
+            self.assertEqual(events[0]['polygon'][0],
+                             [-record.polygon[0][0], record.polygon[0][1]])
+            self.assertTrue(all(lon < 0 for lon, _ in events[0]['polygon']))
+            url = base + '/events?lat={}&lon={}'.format(y, x)
+            body = json.loads(urlopen(url).read().decode())
+            self.assertEqual(body['count'], 0)
+
+            with self.assertRaises(HTTPError) as cm:
+                urlopen(base + '/events?lat=40')
+            self.assertEqual(cm.exception.code, 400)
+            with self.assertRaises(HTTPError) as cm:
+                urlopen(base + '/events?lat=40&lon=260')
+            self.assertEqual(cm.exception.code, 400)
+            with self.assertRaises(HTTPError) as cm:
+                urlopen(base + '/nothing')
+            self.assertEqual(cm.exception.code, 404)
+
+            reply = urlopen(base + '/metrics')
+            self.assertTrue(reply.headers['Content-Type']
+                            .startswith('text/plain'))
+            text = reply.read().decode()
+            self.assertIn('# TYPE hazards_ingest_latency_seconds histogram',
+                          text)
+            self.assertIn('stage="aggregated"', text)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+class TestEventChanges(unittest.TestCase):
+    """
+    What changed between successive looks at the events.
+    """
+    def setUp(self):
+        self.dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                                    'watch_warn', 'svrlcl')
+        self.names = sorted(name for name in os.listdir(self.dirname)
+                            if not name.startswith('.'))
+
+    def _summary(self, changes):
+        return [(change.kind, change.key[1]) for change in changes]
+
+    def test_diff_events(self):
+        old = fetch_events(self.dirname, until=dt.datetime(2015, 7, 20, 1))
+        new = fetch_events(self.dirname, until=dt.datetime(2015, 7, 20, 3))
+        self.assertEqual(self._summary(diff_events(old, new)),
+                         [('closed', 'KBTV'), ('closed', 'KPBZ'),
+                          ('closed', 'KBGM'), ('closed', 'KGLD'),
+                          ('updated', 'KDDC'), ('updated', 'KPUB')])
+        self.assertEqual(diff_events(new, new), [])
+
+        changes = diff_events([], old)
+        self.assertEqual(len(changes), len(old))
+        self.assertEqual(set(change.kind for change in changes),
+                         set(['new', 'closed']))
+
+        # Events that are no longer around at all are closed.
+        changes = diff_events(old, [])
+        self.assertEqual(set(change.kind for change in changes),
+                         set(['closed']))
+
+    def test_changelog(self):
+        tracker = EventTracker(changelog=True)
+        for name in self.names[:4]:
+            tracker.add_file(HazardsFile(os.path.join(self.dirname, name)))
+        self.assertEqual(self._summary(tracker.changes()),
+                         [('new', 'KBTV'), ('closed', 'KCLE'),
+                          ('closed', 'KBUF'), ('new', 'KPBZ'),
+                          ('new', 'KBGM'), ('new', 'KGLD'), ('new', 'KDDC'),
+                          ('new', 'KPUB')])
+        self.assertEqual(tracker.changes(), [])
+
+        for name in self.names[4:6]:
+            tracker.add_file(HazardsFile(os.path.join(self.dirname, name)))
+        changes = tracker.changes()
+        self.assertEqual(self._summary(changes),
+                         [('closed', 'KBGM'), ('updated', 'KPUB'),
+                          ('closed', 'KPBZ'), ('updated', 'KDDC'),
+                          ('closed', 'KGLD'), ('closed', 'KBTV')])
+        for change in changes:
+            if change.kind == 'updated':
+                self.assertIs(tracker.get(change.event.vtec_code),
+                              change.event)
+
+    def test_no_changelog(self):
+        with self.assertRaises(RuntimeError):
+            EventTracker().changes()
+
+
+class TestEventStore(unittest.TestCase):
+    """
+    Copy-on-write snapshots of the live events.
+    """
+    def setUp(self):
+        dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                               'watch_warn', 'svrlcl')
+        names = sorted(name for name in os.listdir(dirname)
+                       if not name.startswith('.'))
+        self.files = [HazardsFile(os.path.join(dirname, name))
+                      for name in names]
+
+    def test_snapshots_are_stable(self):
+        store = EventStore(max_bulletins=None)
+        for hzf in self.files[:4]:
+            store.add_file(hzf)
+        snapshot = store.snapshot()
+        self.assertEqual(snapshot.version, 4)
+        event = snapshot.query(office='KDDC')[0]
+        self.assertEqual([item.action for item in event.history],
+                         ['NEW', 'EXA', 'CON'])
+
+        store.add_file(self.files[4])
+        before = store.snapshot()
+        store.add_file(self.files[5])
+        after = store.snapshot()
+
+        # The old snapshot did not see the later bulletins.
+        self.assertEqual(snapshot.version, 4)
+        self.assertEqual(len(event), 3)
+        self.assertIs(snapshot.get(event.vtec_code), event)
+        self.assertEqual(len(snapshot.query(office='KPBZ')), 1)
+
+        latest = after.get(event.vtec_code)
+        self.assertEqual([item.action for item in latest.history],
+                         ['NEW', 'EXA', 'CON', 'EXA', 'CON'])
+        self.assertEqual(after.query(office='KPBZ'), [])
+
+        # Unchanged events are shared between the snapshots.
+        shared = [item for item in before
+                  if after.get(item.vtec_code) is item]
+        self.assertEqual(len(shared), 2)
+        self.assertEqual(len(after), 2)
+
+    def test_batch(self):
+        store = EventStore()
+        with store.batch():
+            for hzf in self.files[:15]:
+                store.add_file(hzf)
+            self.assertEqual(store.snapshot().version, 0)
+        self.assertEqual(store.snapshot().version, 1)
+        self.assertEqual(len(store), 7)
+
+        store.expire(dt.datetime(2015, 7, 24, 2, 0, 0))
+        self.assertEqual(len(store), 5)
+        events = store.snapshot().current(dt.datetime(2015, 7, 24, 5, 0, 0))
+        self.assertEqual([event.vtec_code.office for event in events],
+                         ['KBIS'])
+
+    def test_failed_batch(self):
+        store = EventStore()
+        store.add_file(self.files[0])
+        snapshot = store.snapshot()
+        with self.assertRaises(RuntimeError):
+            with store.batch():
+                store.add_file(self.files[1])
+                raise RuntimeError('ingest failed')
+        self.assertIs(store.snapshot(), snapshot)
+
+        # Nothing of the failed batch is left to be published later.
+        def summary(events):
+            return sorted((event_key(event.vtec_code), len(event),
+                           [item.action for item in event.history])
+                          for event in events)
+
+        store.add_file(self.files[2])
+        expected = EventTracker()
+        everything = EventTracker()
+        for hzf in self.files[:3]:
+            if hzf is not self.files[1]:
+                expected.add_file(hzf)
+            everything.add_file(hzf)
+        self.assertEqual(summary(store.snapshot()), summary(expected))
+        self.assertNotEqual(summary(store.snapshot()), summary(everything))
+
+    def test_shared_map(self):
+        """
+        Updated copies of the snapshot mapping leave the original alone.
+        """
+        items = dict((('O', 'KDDC', 'SV', 'W', j), j) for j in range(1000))
+        first = hazards.store._SharedMap().updated(items.items())
+        self.assertEqual(len(first), 1000)
+        self.assertEqual(sorted(first.values()), list(range(1000)))
+
+        removed = hazards.store._REMOVED
+        changes = [(('O', 'KDDC', 'SV', 'W', j), removed)
+                   for j in range(0, 1000, 2)]
+        changes.append((('O', 'KTOP', 'TO', 'W', 1), -1))
+        second = first.updated(changes)
+        self.assertEqual(len(second), 501)
+        self.assertEqual(second[('O', 'KTOP', 'TO', 'W', 1)], -1)
+        self.assertNotIn(('O', 'KDDC', 'SV', 'W', 0), second)
+        self.assertEqual(second.get(('O', 'KDDC', 'SV', 'W', 1)), 1)
+        for key, value in items.items():
+            self.assertEqual(first[key], value)
+        self.assertNotIn(('O', 'KTOP', 'TO', 'W', 1), first)
+
+    def test_concurrent_readers(self):
+        store = EventStore(max_bulletins=None)
+        stop = threading.Event()
+        errors = []
+
+        def read():
+            while not stop.is_set():
+                for event in store.snapshot():
+                    if len(event) != len(event.history):
+                        errors.append(event)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        try:
+            for hzf in self.files:
+                store.add_file(hzf)
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(store), 0)
+
+
+class TestPipeline(unittest.TestCase):
+    """
+    Staged ingest through bounded queues.
+    """
+    def setUp(self):
+        self.dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                                    'watch_warn', 'svrlcl')
+        tracker = EventTracker(archive=self._archive(), max_bulletins=None)
+        for entry in corpus.select_entries(corpus.iter_entries(self.dirname)):
+            tracker.add_file(HazardsFile(entry.name))
+        self.expected = self.archived
+
+    def _archive(self):
+        self.archived = []
+
+        def archive(event):
+            self.archived.append((event.vtec_code.office,
+                                  event.vtec_code.event_tracking_id,
+                                  [item.action for item in event.history]))
+        return archive
+
+    def run_pipeline(self, **kwargs):
+        tracker = EventTracker(archive=self._archive(), max_bulletins=None)
+        pipeline = hazards.pipeline.Pipeline(tracker.add_product, **kwargs)
+        count = pipeline.run(self.dirname)
+        self.assertEqual(len(tracker), 0)
+        self.assertEqual(self.archived, self.expected)
+        return pipeline, count
+
+    def test_threads(self):
+        pipeline, count = self.run_pipeline(workers={'read': 2, 'split': 2,
+                                                     'parse': 4},
+                                            maxsize=2)
+        metrics = dict((m.stage, m) for m in pipeline.metrics())
+        nfiles = len([name for name in os.listdir(self.dirname)
+                      if not name.startswith('.')])
+        self.assertEqual(metrics['read'].items, nfiles)
+        self.assertEqual(metrics['split'].items, nfiles)
+        self.assertEqual(metrics['aggregate'].items, count)
+        self.assertTrue(metrics['parse'].items >= count)
+        self.assertEqual(metrics['parse'].workers, 4)
+        for m in metrics.values():
+            self.assertEqual(m.queue_depth, 0)
+        self.assertEqual(len(pipeline.quarantine), 0)
+
+    def test_processes(self):
+        pipeline, count = self.run_pipeline(workers={'parse': 2},
+                                            processes=['parse'])
+        self.assertTrue(count > 0)
+        self.assertTrue(pipeline.metrics()[2].processes)
+
+    def test_unreadable_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, '2015071900.svrlcl.gz'), 'wb') as f:
+            f.write(b'not gzipped')
+        src = os.path.join(self.dirname, '2015071919.svrlcl')
+        shutil.copy(src, tmpdir)
+
+        products = []
+        pipeline = hazards.pipeline.Pipeline(products.append)
+        self.assertEqual(pipeline.run(tmpdir), len(HazardsFile(src)))
+        self.assertEqual(len(products), len(HazardsFile(src)))
+        self.assertEqual(len(pipeline.quarantine), 1)
+        record = list(pipeline.quarantine)[0]
+        self.assertTrue(record.filename.endswith('2015071900.svrlcl.gz'))
+
+    def test_bad_stage(self):
+        with self.assertRaises(ValueError):
+            hazards.pipeline.Pipeline(print, processes=['read'])
+        with self.assertRaises(ValueError):
+            hazards.pipeline.Pipeline(print, workers={'aggregate': 2})
+        with self.assertRaises(ValueError):
+            hazards.pipeline.Pipeline(print, processes=['parse'],
+                                      priorities=hazards.hazards.PRIORITIES)
+        with self.assertRaises(ValueError):
+            hazards.pipeline.Pipeline(print, priorities={('XX', 'W'): 0})
+
+    def test_product_priority(self):
+        path = os.path.join('tests', 'data', 'torn_warn', '2015062501.torn')
+        with open(path, 'rb') as f:
+            raw_item = next(hazards.hazards.split_products(f.read()))[1]
+        self.assertEqual(hazards.hazards.peek_product(raw_item),
+                         ('TOR', {('TO', 'W')}))
+        self.assertEqual(hazards.hazards.product_priority(raw_item), 0)
+        self.assertEqual(hazards.hazards.product_priority(raw_item,
+                                                          {'TOR': 5}), 5)
+        self.assertEqual(hazards.hazards.product_priority(raw_item, {}),
+                         hazards.hazards.ROUTINE_PRIORITY)
+
+    def test_priority_inbox(self):
+        inbox = hazards.pipeline._PriorityInbox(10)
+        inbox.put(None)
+        for index, j, priority in [(0, 0, 100), (0, 1, 0), (1, 0, 100),
+                                   (1, 1, 0)]:
+            inbox.put(('raw', index, j, priority))
+        inbox.put(('count', 1, (100, 0)))
+        order = [inbox.get() for _ in range(6)]
+        self.assertEqual(order[0][0], 'count')
+        self.assertEqual([item[1:3] for item in order[1:5]],
+                         [(0, 1), (1, 1), (0, 0), (1, 0)])
+        self.assertIsNone(order[5])
+
+    def test_priority_inbox_full(self):
+        """
+        Urgent products get in even when the inbox is full.
+        """
+        inbox = hazards.pipeline._PriorityInbox(1)
+        inbox.put(('raw', 0, 0, 100))
+        inbox.put(('raw', 0, 1, 0), timeout=0.1)
+        self.assertTrue(inbox.full())
+        with self.assertRaises(queue.Full):
+            inbox.put(('raw', 0, 2, 100), timeout=0.1)
+        self.assertEqual(inbox.get()[1:3], (0, 1))
+        self.assertEqual(inbox.get()[1:3], (0, 0))
+
+    def test_event_order(self):
+        """
+        An urgent product waits for the earlier products of its event.
+        """
+        Product = collections.namedtuple('Product', ['name', 'ingest_times'])
+        key = ('O', 'KTOP', 'TO', 'W', 1)
+        other = ('O', 'KTOP', 'SV', 'W', 2)
+        inbox = queue.Queue()
+        inbox.put(('count', 0, ((100, frozenset([key])),
+                                (0, frozenset([other])),
+                                (0, frozenset([key])),
+                                (100, frozenset()))))
+        for j in [1, 2, 3, 0]:
+            inbox.put(('product', 0, j, Product(j, {})))
+        inbox.put(None)
+
+        order = []
+        pipeline = hazards.pipeline.Pipeline(
+            lambda product: order.append(product.name))
+        self.assertEqual(pipeline._aggregate(inbox, 1), 4)
+        self.assertEqual(order, [1, 0, 3, 2])
+
+    def test_priorities(self):
+        """
+        Warnings in one directory and watches in another, the events come
+        out the same either way.
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        torn = os.path.join('tests', 'data', 'torn_warn')
+        for dirname in [torn, self.dirname]:
+            for name in os.listdir(dirname):
+                if not name.startswith('.'):
+                    shutil.copy(os.path.join(dirname, name), tmpdir)
+
+        def events(tracker, archived):
+            return sorted(archived + [(event.vtec_code.office,
+                                       event.vtec_code.event_tracking_id,
+                                       [x.action for x in event.history])
+                                      for event in tracker])
+
+        tracker = EventTracker(archive=self._archive(), max_bulletins=None)
+        for entry in corpus.select_entries(corpus.iter_entries(tmpdir)):
+            tracker.add_file(HazardsFile(entry.name))
+        expected = events(tracker, self.archived)
+
+        tracker = EventTracker(archive=self._archive(), max_bulletins=None)
+        pipeline = hazards.pipeline.Pipeline(
+            tracker.add_product, workers={'parse': 3},
+            priorities=hazards.hazards.PRIORITIES)
+        pipeline.run(tmpdir)
+        self.assertEqual(events(tracker, self.archived), expected)
+
+
+class TestLatency(unittest.TestCase):
+    """
+    Latency from issuance to each stage of ingest.
+    """
+    def setUp(self):
+        self.dirname = os.path.join('tests', 'data', 'torn_warn')
+        self.path = os.path.join(self.dirname, '2015062501.torn')
+
+    def test_ingest_times(self):
+        product = HazardsFile(self.path)[0]
+        times = product.ingest_times
+        self.assertEqual(sorted(times), ['framed', 'parsed', 'seen'])
+        self.assertTrue(times['seen'] <= times['framed'] <= times['parsed'])
+
+    def test_histograms(self):
+        product = HazardsFile(self.path)[0]
+        issued = product.wmo_issuance_time
+        product.ingest_times = {'aggregated':
+                                issued + dt.timedelta(seconds=90)}
+        recorder = latency.LatencyRecorder(buckets=[60, 120])
+        recorder.observe(product)
+        recorder.observe(product)
+
+        histograms = recorder.histograms()
+        labels = latency.LatencyLabels('wmo', 'aggregated', 'TOR', 'TO.W')
+        self.assertEqual(histograms[labels].counts, [0, 2, 0])
+        self.assertEqual(histograms[labels].sum, 180.0)
+        mnd = [x for x in histograms if x.since == 'mnd']
+        self.assertEqual([(x.stage, x.product, x.phenomena) for x in mnd],
+                         [('aggregated', 'TOR', 'TO.W')])
+
+        lines = recorder.exposition().splitlines()
+        self.assertEqual(lines[1],
+                         '# TYPE hazards_ingest_latency_seconds histogram')
+        prefix = ('hazards_ingest_latency_seconds_bucket{since="wmo",'
+                  'stage="aggregated",product="TOR",phenomena="TO.W",')
+        self.assertIn(prefix + 'le="60"} 0', lines)
+        self.assertIn(prefix + 'le="120"} 2', lines)
+        self.assertIn(prefix + 'le="+Inf"} 2', lines)
+        self.assertIn('hazards_ingest_latency_seconds_count{since="wmo",'
+                      'stage="aggregated",product="TOR",phenomena="TO.W"} 2',
+                      lines)
+
+    def test_pipeline(self):
+        products = []
+        recorder = latency.LatencyRecorder()
+        pipeline = hazards.pipeline.Pipeline(products.append,
+                                             latency=recorder)
+        pipeline.run(self.dirname)
+        for product in products:
+            self.assertEqual(sorted(product.ingest_times),
+                             sorted(hazards.hazards.INGEST_STAGES))
+        stages = set(labels.stage for labels in recorder.histograms())
+        self.assertEqual(stages, set(hazards.hazards.INGEST_STAGES))
+        count = sum(histogram.count
+                    for labels, histogram in recorder.histograms().items()
+                    if labels.since == 'wmo' and labels.stage == 'parsed')
+        self.assertEqual(count, len(products))
+
+
+class TestArchive(unittest.TestCase):
+    """
+    Columnar archive of historical events.
+    """
+    def setUp(self):
+        self.source = os.path.join('tests', 'data', 'torn_warn')
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.events = []
+        tracker = EventTracker(archive=self.events.append,
+                               max_bulletins=None)
+        for entry in corpus.select_entries(corpus.iter_entries(self.source)):
+            tracker.add_file(HazardsFile(entry.name))
+        self.events.extend(tracker)
+
+    def test_round_trip(self):
+        nevents = archive.write_archive(self.source, self.tmpdir)
+        self.assertEqual(nevents, len(self.events))
+
+        reader = archive.ArchiveReader(self.tmpdir)
+        self.assertTrue(reader.compressed)
+        events = reader.table('events')
+        segments = reader.table('segments')
+        ugc = reader.table('ugc')
+        points = reader.table('points')
+        self.assertEqual(len(events['office']), nevents)
+        self.assertEqual(len(segments['event']),
+                         sum(len(event) for event in self.events))
+
+        # Follow the references from an event down to its geometry.
+        event = [x for x in self.events
+                 if x.vtec_code.office == 'KBOU' and
+                 x.vtec_code.event_tracking_id == 44][0]
+        j = np.flatnonzero((events['office'] == 'KBOU') &
+                           (events['event_tracking_id'] == 44))[0]
+        self.assertEqual(events['state'][j], event.state)
+        self.assertEqual(events['nbulletins'][j], len(event.history))
+        start = events['segment_start'][j]
+        self.assertEqual(events['segment_count'][j], len(event))
+        for k, bulletin in enumerate(event):
+            row = start + k
+            self.assertEqual(segments['event'][row], j)
+            self.assertEqual(segments['action'][row],
+                             event.history[k].action)
+            first = segments['ugc_start'][row]
+            codes = ugc['code'][first:first + segments['ugc_count'][row]]
+            self.assertEqual(list(codes), bulletin.ugc_codes)
+            self.assertTrue(np.all(ugc['segment'][first:first + len(codes)]
+                                   == row))
+            first = segments['point_start'][row]
+            last = first + segments['point_count'][row]
+            np.testing.assert_array_equal(
+                np.column_stack([points['lon'][first:last],
+                                 points['lat'][first:last]]),
+                np.array(bulletin.polygon, dtype=np.float64))
+
+    def test_wire_decoded(self):
+        # The polygons of decoded segments are arrays.
+        events = []
+        tracker = EventTracker(archive=events.append, max_bulletins=None)
+        for entry in corpus.select_entries(corpus.iter_entries(self.source)):
+            for product in HazardsFile(entry.name):
+                buf = wire.encode_product(product)
+                tracker.add_product(wire.decode_product(buf))
+        events.extend(tracker)
+        with archive.ArchiveWriter(self.tmpdir) as writer:
+            for event in events:
+                writer.add(event)
+
+        reader = archive.ArchiveReader(self.tmpdir)
+        segments = reader.table('segments')
+        points = reader.table('points')
+        self.assertEqual(len(segments['event']),
+                         sum(len(event) for event in self.events))
+        self.assertEqual(len(points['lon']),
+                         sum(len(bulletin.polygon) for event in self.events
+                             for bulletin in event))
+
+    def test_select_and_memory_map(self):
+        archive.write_archive(self.source, self.tmpdir, compress=False)
+        reader = archive.ArchiveReader(self.tmpdir)
+        self.assertFalse(reader.compressed)
+
+        parts = reader.select(since=dt.date(2015, 6, 26),
+                              until='2015-06-26')
+        self.assertEqual(set(part.day for part in parts), {'2015-06-26'})
+        parts = reader.select(offices=['KLSX'])
+        self.assertEqual([part.day for part in parts],
+                         ['2015-06-26', '2015-06-28', '2015-06-29'])
+
+        lst = list(reader.read('events', columns=['office', 'state'],
+                               offices=['KLSX']))
+        self.assertEqual(len(lst), 3)
+        part, columns = lst[1]
+        self.assertEqual(sorted(columns), ['office', 'state'])
+        self.assertIsInstance(columns['office'], np.memmap)
+        self.assertEqual(len(columns['office']), part.rows['events'])
+
+        with self.assertRaises(ValueError):
+            next(reader.read('events', columns=['nothing']))
+
+    def test_append(self):
+        half = len(self.events) // 2
+        with archive.ArchiveWriter(self.tmpdir) as writer:
+            for event in self.events[:half]:
+                writer.add(event)
+        with archive.ArchiveWriter(self.tmpdir) as writer:
+            for event in self.events[half:]:
+                writer.add(event)
+
+        reader = archive.ArchiveReader(self.tmpdir)
+        names = set(os.path.basename(part.path) for part in reader.parts)
+        self.assertEqual(names, {'part-00000', 'part-00001'})
+        events = reader.table('events')
+        segments = reader.table('segments')
+        self.assertEqual(len(events['office']), len(self.events))
+
+        # Shifted references still agree across the parts.
+        for j in range(len(events['office'])):
+            start = events['segment_start'][j]
+            stop = start + events['segment_count'][j]
+            self.assertTrue(np.all(segments['event'][start:stop] == j))
+
+        with self.assertRaises(archive.ArchiveError):
+            archive.ArchiveWriter(self.tmpdir, compress=False)
+
+    def test_missing(self):
+        with self.assertRaises(archive.ArchiveError):
+            archive.ArchiveReader(self.tmpdir)
+
+
+class TestReplay(unittest.TestCase):
+    """
+    Replay of an archive in issuance order.
+    """
+    def setUp(self):
+        self.dirname = os.path.join('tests', 'data', 'torn_warn')
+
+    def test_order(self):
+        products = []
+        stats = replay.Replay(self.dirname, sink=products.append).run()
+        times = [product.wmo_issuance_time for product in products]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(stats.products, len(products))
+        self.assertEqual(stats.segments,
+                         sum(len(product) for product in products))
+        self.assertEqual(len(stats.latencies), len(products))
+        self.assertEqual(stats.replayed, times[-1] - times[0])
+
+        # The same products as reading the files in turn.
+        expected = sum(len(HazardsFile(entry.name))
+                       for entry in corpus.iter_entries(self.dirname))
+        self.assertEqual(len(products), expected)
+
+    def test_events(self):
+        tracker = EventTracker()
+        for entry in corpus.select_entries(corpus.iter_entries(self.dirname)):
+            tracker.add_file(HazardsFile(entry.name))
+
+        player = replay.Replay(self.dirname)
+        player.run()
+        self.assertEqual(
+            sorted(event_key(event.vtec_code) for event in player.tracker),
+            sorted(event_key(event.vtec_code) for event in tracker))
+
+    def test_paced(self):
+        """
+        At 3600 times real time, an hour of bulletins takes a second.
+        """
+        now = [0.0]
+
+        def clock():
+            return now[0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        player = replay.Replay(self.dirname, sink=lambda product: None,
+                               speed=3600, clock=clock, sleep=sleep)
+        stats = player.run()
+        span = stats.replayed.total_seconds() / 3600
+        self.assertAlmostEqual(stats.wall_seconds, span)
+        self.assertEqual(stats.percentiles('latencies', qs=[100]), [0.0])
+        self.assertIn('{} products'.format(stats.products), stats.report())
+
+        with self.assertRaises(ValueError):
+            replay.Replay(self.dirname, speed=0)
+
+    def test_command_line(self):
+        with patch('sys.argv', ['', self.dirname]):
+            with patch('sys.stdout', new=StringIO()) as fake_stdout:
+                hazards.command_line.hzreplay()
+                actual = fake_stdout.getvalue()
+        self.assertIn('products/s', actual)
+        self.assertIn('live events', actual)
+
+
+class TestRaster(unittest.TestCase):
+    """
+    Warning polygons rasterized onto a grid.
+    """
+    def setUp(self):
+        self.grid = raster.RasterGrid((95, 30, 110, 50), 0.05)
+        self.tracker = EventTracker(changelog=True)
+        dirname = os.path.join('tests', 'data', 'torn_warn')
+        self.paths = [entry.name for entry in
+                      corpus.select_entries(corpus.iter_entries(dirname))]
+
+    def test_grid(self):
+        self.assertEqual(self.grid.shape, (400, 300))
+        rows, cols = self.grid.cells([95.01, 109.99, 94], [30.01, 49.99, 40])
+        self.assertEqual(list(rows), [0, 399, -1])
+        self.assertEqual(list(cols), [0, 299, -1])
+        areas = self.grid.cell_areas()
+        self.assertTrue(areas[0, 0] > areas[-1, 0])
+
+    def test_masks(self):
+        masks = raster.WarningRaster(self.grid)
+        for path in self.paths:
+            self.tracker.add_file(HazardsFile(path))
+            masks.apply(self.tracker.changes())
+
+        # More events than fit in one word.
+        self.assertTrue(len(masks) > 64)
+        self.assertEqual(masks.bits.shape[0], 2)
+
+        x, y = self.grid.centers()
+        for event in self.tracker:
+            key = event_key(event.vtec_code)
+            polygon = event[-1].polygon
+            expected = geometry.points_in_polygon(polygon, x, y)
+            np.testing.assert_array_equal(masks.mask(key), expected)
+            if expected.any():
+                i, j = np.argwhere(expected)[0]
+                self.assertIn(key, masks.lookup(x[0, j], y[i, 0]))
+
+        coverage = masks.coverage()
+        self.assertEqual(coverage[('O', 'KBOU', 'TO', 'W', 44)], 22)
+        self.assertTrue(masks.covered() <= sum(coverage.values()))
+        area = masks.coverage(self.grid.cell_areas())
+        self.assertTrue(0 < area[('O', 'KBOU', 'TO', 'W', 44)] < 22 * 31)
+
+        bits = masks.lookup_bits([97.5, 0], [47.7, 0])
+        self.assertEqual(masks.keys(bits[0]), masks.lookup(97.5, 47.7))
+        self.assertEqual(masks.keys(bits[1]), [])
+
+    def test_incremental(self):
+        masks = raster.WarningRaster(self.grid)
+        key = ('O', 'KXXX', 'TO', 'W', 1)
+        square = [(100, 40), (100, 41), (101, 41), (101, 40)]
+        self.assertTrue(masks.update(key, square))
+        self.assertFalse(masks.update(key, list(square)))
+        self.assertEqual(masks.coverage()[key], 400)
+        self.assertEqual(masks.lookup(100.5, 40.5), [key])
+
+        # The event shrinks to the southern half.
+        half = [(100, 40), (100, 40.5), (101, 40.5), (101, 40)]
+        self.assertTrue(masks.update(key, half))
+        self.assertEqual(masks.coverage()[key], 200)
+        self.assertEqual(masks.lookup(100.5, 40.75), [])
+        self.assertEqual(masks.covered(), 200)
+
+        other = ('O', 'KXXX', 'SV', 'W', 2)
+        masks.update(other, square)
+        self.assertEqual(sorted(masks.lookup(100.5, 40.25)),
+                         sorted([key, other]))
+
+        self.assertTrue(masks.remove(key))
+        self.assertFalse(masks.remove(key))
+        self.assertEqual(masks.lookup(100.5, 40.25), [other])
+        self.assertEqual(masks.covered(), 400)
+        self.assertEqual(len(masks), 1)
+
+
+class TestExposure(unittest.TestCase):
+    """
+    Membership of many assets in the polygons of events.
+    """
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.uniform(95, 110, 20000)
+        self.y = rng.uniform(30, 50, 20000)
+        dirname = os.path.join('tests', 'data', 'torn_warn')
+        self.paths = [entry.name for entry in
+                      corpus.select_entries(corpus.iter_entries(dirname))]
+
+    def test_membership(self):
+        tracker = EventTracker()
+        for path in self.paths:
+            tracker.add_file(HazardsFile(path))
+        events = list(tracker)
+
+        membership = exposure.exposure(self.x, self.y, events)
+        self.assertEqual(membership.shape, (len(self.x), len(events)))
+        self.assertEqual(len(membership.rows), len(membership.cols))
+        self.assertTrue(len(membership.rows) > 0)
+
+        dense = np.zeros(membership.shape, dtype=bool)
+        dense[membership.rows, membership.cols] = True
+        for col, key in enumerate(membership.keys):
+            event = [x for x in events if event_key(x.vtec_code) == key][0]
+            expected = geometry.points_in_polygon(event[-1].polygon,
+                                                  self.x, self.y)
+            np.testing.assert_array_equal(dense[:, col], expected)
+
+    def test_incremental(self):
+        assets = exposure.AssetExposure(self.x, self.y)
+        tracker = EventTracker(changelog=True)
+        counts = []
+        for path in self.paths:
+            tracker.add_file(HazardsFile(path))
+            counts.append(assets.apply(tracker.changes()))
+        self.assertEqual(len(assets), len(tracker))
+        self.assertTrue(sum(counts) >= len(tracker))
+
+        key = ('O', 'KXXX', 'TO', 'W', 1)
+        square = [(100, 40), (100, 41), (101, 41), (101, 40)]
+        self.assertTrue(assets.update(key, square))
+        self.assertFalse(assets.update(key, list(square)))
+        index = assets.assets(key)
+        expected = np.flatnonzero((self.x > 100) & (self.x < 101) &
+                                  (self.y > 40) & (self.y < 41))
+        np.testing.assert_array_equal(index, expected)
+        self.assertIn(key, assets.events(index[0]))
+
+        self.assertTrue(assets.remove(key))
+        self.assertEqual(len(assets.assets(key)), 0)
+        self.assertNotIn(key, assets.events(index[0]))
+
+        with self.assertRaises(ValueError):
+            exposure.AssetExposure([1, 2], [1])
+
+
+class TestStormTrack(unittest.TestCase):
+    """
+    Storm tracks extrapolated from TIME...MOT...LOC.
+    """
+    def setUp(self):
+        # Moving east at 30 knots from 100W 40N.
+        self.tml = TimeMotionLocation(time=dt.datetime(2015, 6, 24, 23, 0),
+                                      direction=270, speed=30,
+                                      location=[(100.0, 40.0)])
+        self.speed = 30 * 1.852
+        self.scale = math.pi * 6371.0 / 180.0
+
+    def test_project(self):
+        x, y = stormtrack.project(self.tml, [0, 1])
+        self.assertEqual(x.shape, (2, 1))
+        self.assertAlmostEqual(x[0, 0], 100.0)
+        expected = 100.0 - self.speed / (self.scale *
+                                         math.cos(math.radians(40)))
+        self.assertAlmostEqual(x[1, 0], expected)
+        self.assertAlmostEqual(y[1, 0], 40.0)
+
+    def test_closest_approach(self):
+        x = [99.5, 99.5, 100.5]
+        y = [40.0, 40.05, 40.0]
+        approach = stormtrack.closest_approach(self.tml, x, y, radius=10)
+
+        east = 0.5 * self.scale * math.cos(math.radians(40))
+        hours = east / self.speed
+        expected = np.datetime64('2015-06-24T23:00:00', 's')
+        expected += np.timedelta64(int(round(hours * 3600)), 's')
+        self.assertEqual(approach.time[0], expected)
+        self.assertAlmostEqual(approach.distance[0], 0.0, places=6)
+        self.assertAlmostEqual(approach.distance[1], 0.05 * self.scale,
+                               places=6)
+        self.assertTrue(approach.arrival[0] < approach.arrival[1])
+        self.assertTrue(approach.arrival[1] < approach.time[1])
+
+        # The storm is moving away from the last one.
+        self.assertEqual(approach.time[2],
+                         np.datetime64('2015-06-24T23:00:00', 's'))
+        self.assertAlmostEqual(approach.distance[2], east, places=6)
+        self.assertTrue(np.isnat(approach.arrival[2]))
+
+    def test_incremental(self):
+        dirname = os.path.join('tests', 'data', 'torn_warn')
+        rng = np.random.RandomState(0)
+        x = rng.uniform(94, 106, 10000)
+        y = rng.uniform(38, 44, 10000)
+        tracks = stormtrack.StormTracks(x, y, radius=20)
+        tracker = EventTracker(changelog=True)
+        for entry in corpus.select_entries(corpus.iter_entries(dirname)):
+            tracker.add_file(HazardsFile(entry.name))
+            tracks.apply(tracker.changes())
+        self.assertTrue(len(tracks) > 0)
+
+        arrival, cols, keys = tracks.earliest()
+        self.assertEqual(len(keys), len(tracks))
+        self.assertTrue((cols >= 0).any())
+        self.assertTrue(np.isnat(arrival[cols < 0]).all())
+        for j in np.flatnonzero(cols >= 0)[:20]:
+            approach = tracks.approach(keys[cols[j]])
+            self.assertEqual(arrival[j], approach.arrival[j])
+            self.assertTrue(approach.distance[j] <= 20)
+
+        key = ('O', 'KXXX', 'TO', 'W', 1)
+        self.assertTrue(tracks.update(key, self.tml))
+        self.assertFalse(tracks.update(key, self.tml))
+        decoded = self.tml._replace(location=np.array([[100.0, 40.0]]))
+        self.assertFalse(tracks.update(key, decoded))
+        self.assertTrue(tracks.update(key, None))
+        self.assertNotIn(key, tracks)
+
+
+class TestUgcSet(unittest.TestCase):
+    """
+    Compact sets of UGC codes.
+    """
+    def test_algebra(self):
+        a = UgcSet(['KSC075', 'KSC001', 'KSZ075', 'OKC999'])
+        b = UgcSet(['KSC075', 'KSZ076', 'OKC999', 'TXC000'])
+        self.assertEqual(len(a), 4)
+        self.assertEqual(list(a), ['KSC001', 'KSC075', 'KSZ075', 'OKC999'])
+        self.assertIn('KSZ075', a)
+        self.assertNotIn('KSZ001', a)
+        self.assertNotIn('bogus', a)
+
+        for op in ['__or__', '__and__', '__sub__', '__xor__']:
+            expected = getattr(set(a), op)(set(b))
+            self.assertEqual(set(getattr(a, op)(b)), expected)
+        self.assertEqual(a.union(b), a | b)
+        self.assertEqual(a.intersection(b), UgcSet(['KSC075', 'OKC999']))
+        self.assertEqual(a.difference(b, a), UgcSet())
+        self.assertTrue((a & b) <= a)
+        self.assertTrue(a >= (a - b))
+        self.assertTrue((a - b).isdisjoint(b))
+        self.assertFalse(a.isdisjoint(b))
+        self.assertEqual(a.states()[('KS', 'C')], [1, 75])
+
+        with self.assertRaises(ValueError):
+            UgcSet(['KSX075'])
+
+    def test_serialize(self):
+        a = UgcSet(['KSC075', 'KSC001', 'KSZ075', 'OKC999', 'TXZ000'])
+        buf = a.to_bytes()
+        self.assertEqual(UgcSet.from_bytes(buf), a)
+        self.assertEqual(UgcSet.from_bytes(UgcSet().to_bytes()), UgcSet())
+        self.assertTrue(len(buf) < 10 * len(a) + 130)
+        with self.assertRaises(ValueError):
+            UgcSet.from_bytes(buf[:-1])
+        with self.assertRaises(ValueError):
+            UgcSet.from_bytes(buf + b'\x00')
+
+    def test_segment(self):
+        path = os.path.join('tests', 'data', 'torn_warn', '2015062423.torn')
+        segment = HazardsFile(path)[0].segments[0]
+        ugcs = UgcSet.from_segment(segment)
+        self.assertEqual(list(ugcs), segment.ugc_codes)
+
+    def test_mixed_segment(self):
+        """
+        A segment listing both counties and zones keeps them apart.
+        """
+        txt = ('KSC001-003-KSZ005>007-MOC011-\n231200-\n'
+               '/O.NEW.KTOP.SV.A.0001.150723T0000Z-150723T1200Z/\n\n'
+               'TEXT\n\n$$\n')
+        segment = Segment(txt, base_date=dt.datetime(2015, 7, 23, 0, 0, 0))
+        self.assertEqual(segment.ugc_groups, {('KS', 'C'): [1, 3],
+                                              ('KS', 'Z'): [5, 6, 7],
+                                              ('MO', 'C'): [11]})
+        self.assertEqual(segment.states, {'KS': [1, 3, 5, 6, 7],
+                                          'MO': [11]})
+        expected = ['KSC001', 'KSC003', 'KSZ005', 'KSZ006', 'KSZ007',
+                    'MOC011']
+        self.assertEqual(segment.ugc_codes, expected)
+        self.assertEqual(list(UgcSet.from_segment(segment)), expected)
+        self.assertEqual(Segment.decode(segment.encode()).ugc_codes,
+                         expected)
+
+    def test_event_changes(self):
+        dirname = os.path.join('tests', 'data', 'noaaport', 'nwx',
+                               'watch_warn', 'wcn')
+        count = 0
+        for event in fetch_events(dirname):
+            changes = event.ugc_changes()
+            self.assertEqual(len(changes), len(event) - 1)
+            codes = [set(bulletin.ugc_codes) for bulletin in event]
+            for j, (added, removed) in enumerate(changes):
+                self.assertEqual(set(added), codes[j + 1] - codes[j])
+                self.assertEqual(set(removed), codes[j] - codes[j + 1])
+                count += len(added) + len(removed)
+        self.assertTrue(count > 0)
+
+
 if __name__ == '__main__':
     unittest.main()